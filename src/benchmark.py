@@ -0,0 +1,170 @@
+import click
+import demoji
+import emoji
+import numpy as np
+import pandas as pd
+import preprocessor as tw_preprocessor
+import random
+import time
+
+from nltk import wordpunct_tokenize
+from nltk.corpus import stopwords
+from nltk.stem import SnowballStemmer
+from report_generator import pre_process_data, put_name_week_day_in_spanish
+from utils.text_normalizer import TweetTextNormalizer
+
+
+tw_preprocessor.set_options(tw_preprocessor.OPT.URL,
+                            tw_preprocessor.OPT.MENTION,
+                            tw_preprocessor.OPT.HASHTAG,
+                            tw_preprocessor.OPT.RESERVED,
+                            tw_preprocessor.OPT.NUMBER,
+                            tw_preprocessor.OPT.EMOJI)
+
+
+SAMPLE_WORDS = ['coronavirus', 'confinamiento', 'sanidad', 'hospitales', 'los',
+                'de', 'la', 'que', 'en', 'mascarillas', 'vacuna', 'gobierno',
+                'casos', 'nuevos', 'contagios', 'por', 'para', 'una', 'con',
+                'madrid', 'barcelona', 'quedateencasa', 'médicos', 'salud']
+SAMPLE_EXTRAS = ['@usuario', 'https://t.co/abc123', '#COVID19', '😷', '🇪🇸',
+                 '2020', 'RT', '!', '.', ',']
+
+
+def generate_tweets(num_tweets, seed=0):
+    random.seed(seed)
+    tweets = []
+    for _ in range(num_tweets):
+        words = random.choices(SAMPLE_WORDS, k=random.randint(8, 30)) + \
+                random.choices(SAMPLE_EXTRAS, k=random.randint(1, 5))
+        random.shuffle(words)
+        tweets.append(' '.join(words))
+    return tweets
+
+
+def legacy_normalize_tweet(tweet_txt, stemming, stemmer):
+    # per-tweet normalization as it was done in process_tweets
+    processed_txt = tw_preprocessor.clean(tweet_txt)
+    processed_txt = demoji.replace(processed_txt).replace('\u200d️','').strip()
+    processed_txt = emoji.get_emoji_regexp().sub(u'', processed_txt)
+    tokens = [token.lower() for token in wordpunct_tokenize(processed_txt)]
+    stop_words = stopwords.words('spanish')
+    punct_signs = ['.', '[', ']', ',', ';', ')', '),', '(']
+    stop_words.extend(punct_signs)
+    words = [token for token in tokens if token not in stop_words]
+    if stemming:
+        stemmers = [stemmer.stem(word) for word in words]
+        return ' '.join([stem for stem in stemmers if stem.isalpha() and len(stem) > 1])
+    else:
+        return ' '.join(word for word in words)
+
+
+def legacy_pre_process_data(df):
+    # pre_process_data as it was before being vectorised
+    df_columns = list(df.columns)
+    if 'created_at' in df_columns:
+        df['created_at'] = pd.to_datetime(df['created_at'])
+    if 'created_at_date' in df_columns:
+        df['created_at_date'] = pd.to_datetime(df['created_at_date']).dt.date
+        df = df.rename(columns={'created_at_date':'date'})
+    elif 'date' in df_columns:
+        df['date'] = pd.to_datetime(df['date']).dt.date
+    if 'date_hour' not in df_columns:
+        df['date_hour'] = df['created_at'].dt.strftime('%Y-%m-%d %H')
+    languages_no_to_aggregate = ['es', 'ca', 'eu', 'gl', 'en', 'pt', 'fr', 'it']
+    df['lang_org'] = df['lang']
+    df.loc[~df.lang.isin(languages_no_to_aggregate),'lang'] = 'otro'
+    if 'day_week' not in list(df_columns):
+        df['day_week'] = df['created_at'].dt.strftime('%A %d-%m-%Y')
+    df.loc[:,'day_week'] = df.loc[:,'day_week'].apply(put_name_week_day_in_spanish)
+    if 'hour' not in list(df_columns):
+        df['hour'] = df['created_at'].dt.strftime('%H')    
+    df.loc[df['type']=='rt', 'type'] = 'retweet'
+    df.loc[df['type']=='og', 'type'] = 'original'
+    df.loc[df['type']=='qt', 'type'] = 'quote'
+    df.loc[df['type']=='rp', 'type'] = 'reply'
+    return df
+
+
+def generate_tweets_df(num_rows, seed=0):
+    rng = np.random.RandomState(seed)
+    start = pd.Timestamp('2020-03-01', tz='UTC').value // 10**9
+    created_at = pd.to_datetime(start + rng.randint(0, 60*86400, num_rows), 
+                                unit='s', utc=True)
+    return pd.DataFrame({
+        'id': np.arange(num_rows),
+        'created_at': created_at,
+        'created_at_date': created_at.strftime('%Y-%m-%d'),
+        'lang': rng.choice(['es', 'en', 'ca', 'und', 'de', 'pt'], num_rows),
+        'type': rng.choice(['rt', 'og', 'qt', 'rp'], num_rows),
+        'comunidad_autonoma': rng.choice(['Madrid', 'Cataluña', 'desconocido'], 
+                                         num_rows),
+        'sentiment_score': rng.uniform(-1, 1, num_rows)
+    })
+
+
+def time_per_item(fn, items):
+    start_time = time.perf_counter()
+    results = [fn(item) for item in items]
+    elapsed_secs = time.perf_counter() - start_time
+    return results, elapsed_secs / len(items)
+
+
+@click.group()
+def benchmark():
+    pass
+
+
+@benchmark.command()
+@click.option('--num_tweets', help='Number of synthetic tweets', default=20000,
+              type=int)
+@click.option('--stemming', help='Stem words', default=False, is_flag=True)
+def text_normalizer(num_tweets, stemming):
+    """
+    Compare the per-tweet cost of the legacy normalization of process_tweets
+    with TweetTextNormalizer
+    """
+    tweets = generate_tweets(num_tweets)
+    stemmer = SnowballStemmer('spanish')
+    legacy_results, legacy_cost = time_per_item(
+        lambda tweet: legacy_normalize_tweet(tweet, stemming, stemmer), tweets)
+    normalizer = TweetTextNormalizer(stemmer)
+    new_results, new_cost = time_per_item(
+        lambda tweet: normalizer.normalize_tweet(tweet, 'es', stemming), tweets)
+    if legacy_results != new_results:
+        raise Exception('The normalizer does not produce the legacy output')
+    print('Tweets: {:,}'.format(num_tweets))
+    print('Legacy normalization: {:.1f} us/tweet'.format(legacy_cost * 1e6))
+    print('TweetTextNormalizer: {:.1f} us/tweet'.format(new_cost * 1e6))
+    print('Speed-up: {:.1f}x'.format(legacy_cost / new_cost))
+
+
+
+@benchmark.command()
+@click.option('--num_rows', help='Number of synthetic tweets', default=1000000,
+              type=int)
+def pre_process(num_rows):
+    """
+    Compare the legacy pre_process_data with the vectorised one
+    """
+    tweets_df = generate_tweets_df(num_rows)
+    start_time = time.perf_counter()
+    legacy_df = legacy_pre_process_data(tweets_df.copy())
+    legacy_secs = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    new_df = pre_process_data(tweets_df.copy())
+    new_secs = time.perf_counter() - start_time
+    # hours are integers now, the rest of columns have the same values
+    legacy_df['hour'] = legacy_df['hour'].astype(int)
+    for column in legacy_df.columns:
+        if not legacy_df[column].equals(new_df[column].astype(legacy_df[column].dtype)):
+            raise Exception('Column {} differs from the legacy output'.format(column))
+    print('Rows: {:,}'.format(num_rows))
+    print('Legacy pre_process_data: {0:.2f} s, {1:.1f} MB'.format(
+        legacy_secs, legacy_df.memory_usage(deep=True).sum() / 2**20))
+    print('Vectorised pre_process_data: {0:.2f} s, {1:.1f} MB'.format(
+        new_secs, new_df.memory_usage(deep=True).sum() / 2**20))
+    print('Speed-up: {:.1f}x'.format(legacy_secs / new_secs))
+
+
+if __name__ == '__main__':
+    benchmark()
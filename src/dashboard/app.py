@@ -6,19 +6,36 @@ import dash_core_components as dcc
 import dash_html_components as html
 import datetime
 import json
-import numpy as np
+import os
 import pandas as pd
 import pathlib
 import plotly.express as px
 import plotly.graph_objects as go
+import pyarrow.parquet as pq
+import sys
+import threading
 
 from dash.dependencies import Input, Output, ClientsideFunction
+from functools import lru_cache, wraps
 from urllib.request import urlopen
 
+# the dashboard runs from src/dashboard, its utils are in src
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from utils.dashboard_cubes import DASHBOARD_COLUMNS, build_cubes, count_users, \
+                                  get_cubes_build_dir, read_cubes, \
+                                  table_to_data
+
 
 # get relative data folder
 ROOT_PATH = pathlib.Path(pathlib.Path(__file__).resolve()).parents[2]
 DATA_PATH = ROOT_PATH.joinpath("reports","5_2304290420","data", "dataset_reporte_5_2304290420.csv").resolve()
+# dataset exported with export-parquet, used instead of the csv if it exists
+PARQUET_DATA_PATH = ROOT_PATH.joinpath("reports","5_2304290420","data", "dataset_reporte_5_2304290420").resolve()
+# cubes exported with export-dashboard, preferred over the other datasets
+CUBES_DATA_PATH = ROOT_PATH.joinpath("reports","5_2304290420","data", "dashboard_cubes_5_2304290420").resolve()
+START_DATE, END_DATE = '2020-03-24', '2020-04-29'
+# number of selections of dates ranges whose results are kept in memory
+CACHE_SIZE = 64
 
 
 app = dash.Dash(
@@ -31,7 +48,81 @@ server = app.server
 app.config.suppress_callback_exceptions = True
 
 
-df = pd.read_csv(DATA_PATH)
+def get_data_path():
+    if CUBES_DATA_PATH.is_dir():
+        return CUBES_DATA_PATH
+    elif PARQUET_DATA_PATH.is_dir():
+        return PARQUET_DATA_PATH
+    else:
+        return DATA_PATH
+
+
+def get_data_signature(data_path):
+    # a new export of the cubes publishes a new build directory, while a new
+    # report build replaces the files, which changes their inodes or their
+    # modification times
+    if data_path == CUBES_DATA_PATH:
+        return (str(data_path), get_cubes_build_dir(str(data_path)))
+    stat = os.stat(str(data_path))
+    return (str(data_path), stat.st_ino, stat.st_mtime_ns)
+
+
+def load_cubes(data_path):
+    if data_path == CUBES_DATA_PATH:
+        # the cubes were built at export time, so the tweets are not read
+        return read_cubes(str(data_path))
+    elif data_path == PARQUET_DATA_PATH:
+        # read only the columns used by the dashboard and the partitions of 
+        # the dates of the report
+        table = pq.read_table(str(data_path), columns=DASHBOARD_COLUMNS,
+                              filters=[('created_at_date', '>=', START_DATE),
+                                       ('created_at_date', '<=', END_DATE)])
+        return build_cubes(table_to_data(table))
+    else:
+        return build_cubes(pd.read_csv(data_path))
+
+
+# cubes are loaded on the first request and reloaded when the data files change
+data_state = {'signature': None, 'cubes': None}
+data_lock = threading.Lock()
+cached_functions = []
+
+
+def memoise(fn):
+    """
+    Cache the results of fn by its arguments until the data is reloaded
+    """
+    cached_fn = lru_cache(maxsize=CACHE_SIZE)(fn)
+    cached_functions.append(cached_fn)
+
+    @wraps(fn)
+    def wrapper(*args):
+        # load the data, or reload it if the file changed, before looking
+        # up the cache
+        get_cubes()
+        return cached_fn(*args)
+    return wrapper
+
+
+def get_cubes():
+    data_path = get_data_path()
+    try:
+        signature = get_data_signature(data_path)
+        if signature != data_state['signature']:
+            with data_lock:
+                if signature != data_state['signature']:
+                    data_state['cubes'] = load_cubes(data_path)
+                    data_state['signature'] = signature
+                    for cached_fn in cached_functions:
+                        cached_fn.cache_clear()
+    except OSError as e:
+        # the data is missing or being replaced, keep serving the cubes
+        # that were already loaded
+        if data_state['cubes'] is None:
+            raise
+        server.logger.warning('Could not reload the data of {}, the loaded '\
+                              'data is kept. Error: {}'.format(data_path, e))
+    return data_state['cubes']
 
 
 dates_range_list = [
@@ -98,12 +189,40 @@ def generate_controls():
     )
 
 
-def prepare_sentiment_df():
-    thresholds = {'low': -0.1, 'high': 0.1}
-    sa_df = df.loc[:, ['id', 'date', 'sentiment']]
-    sa_df.loc[:, 'sentiment'] = pd.to_numeric(sa_df.loc[:, 'sentiment'])
-    sa_df.loc[:, 'sentiment_label'] = np.where(sa_df.loc[:, 'sentiment'] > thresholds['high'], 'positivo', np.where(sa_df.loc[:, 'sentiment'] < thresholds['low'], 'negativo', 'neutral'))
-    return sa_df
+def count_users_of(date_hour_users):
+    """
+    Estimate the unique users of the rows of the users cube by merging
+    their sketches
+    """
+    return count_users(get_cubes()['users_sketches'][date_hour_users.index.values])
+
+
+def get_dates_range_key(dates_range_select):
+    """
+    Return the dates ranges selected in the dropdown as a sorted tuple,
+    which is the key of the cached results. No selection means all the
+    dates ranges
+    """
+    if not dates_range_select:
+        dates_range_select = dates_range_list
+    elif isinstance(dates_range_select, str):
+        dates_range_select = [dates_range_select]
+    return tuple(sorted(set(dates_range_select)))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def get_dates_in_ranges(dates_range_key):
+    dates = set()
+    for dates_range in dates_range_key:
+        start_date, end_date = [pd.to_datetime(date, format='%d-%m-%Y')
+                                for date in dates_range.split(' a ')]
+        dates.update(pd.date_range(start_date, end_date).strftime('%Y-%m-%d'))
+    return sorted(dates)
+
+
+def filter_by_dates(cube_name, dates_range_key):
+    cube = get_cubes()[cube_name]
+    return cube[cube['date'].isin(get_dates_in_ranges(dates_range_key))]
 
 
 def get_sentiment_colors():
@@ -115,55 +234,67 @@ def get_sentiment_colors():
     return sentiment_colors
 
 
+@memoise
+def count_tweets_by_type(dates_range_key):
+    tweets_types = filter_by_dates('date_hour_type', dates_range_key)
+    return tweets_types.groupby('type')['count'].sum().to_dict()
+
+
+@memoise
+def count_unique_users(dates_range_key):
+    return count_users_of(filter_by_dates('date_hour_users', dates_range_key))
+
+
 @app.callback(Output("tweets", "children"), [Input("dates_range_select", "value")])
 def update_num_tweets(dates_range_select):    
-    return '{:,}'.format(df.shape[0])
+    tweets_types = count_tweets_by_type(get_dates_range_key(dates_range_select))
+    return '{:,}'.format(sum(tweets_types.values()))
 
 
 @app.callback(Output("users", "children"), [Input("dates_range_select", "value")])
 def update_num_users(dates_range_select):    
-    return '{:,}'.format(df.groupby('user_screen_name').ngroups)
+    return '{:,}'.format(count_unique_users(get_dates_range_key(dates_range_select)))
 
 
 @app.callback(Output("rts", "children"), [Input("dates_range_select", "value")])
 def update_num_rts(dates_range_select):
-    tweets_types = df.groupby('type', as_index=False)['id'].count()
-    num_rts = tweets_types.loc[tweets_types['type']=='rt','id'].values[0]
-    return '{:,}'.format(num_rts)
+    tweets_types = count_tweets_by_type(get_dates_range_key(dates_range_select))
+    return '{:,}'.format(tweets_types.get('rt', 0))
 
 
 @app.callback(Output("ogs", "children"),[Input("dates_range_select", "value")])
 def update_num_ogs(dates_range_select):
-    tweets_types = df.groupby('type', as_index=False)['id'].count()
-    num_ogs = tweets_types.loc[tweets_types['type']=='og','id'].values[0]
-    return '{:,}'.format(num_ogs)
+    tweets_types = count_tweets_by_type(get_dates_range_key(dates_range_select))
+    return '{:,}'.format(tweets_types.get('og', 0))
 
 
 @app.callback(Output("rps", "children"),[Input("dates_range_select", "value")])
 def update_num_rps(dates_range_select):
-    tweets_types = df.groupby('type', as_index=False)['id'].count()
-    num_rps = tweets_types.loc[tweets_types['type']=='rp','id'].values[0]
-    return '{:,}'.format(num_rps)
+    tweets_types = count_tweets_by_type(get_dates_range_key(dates_range_select))
+    return '{:,}'.format(tweets_types.get('rp', 0))
 
 
 @app.callback(Output("qts", "children"),[Input("dates_range_select", "value")])
 def update_num_qts(dates_range_select):
-    tweets_types = df.groupby('type', as_index=False)['id'].count()
-    num_qts = tweets_types.loc[tweets_types['type']=='qt','id'].values[0]
-    return '{:,}'.format(num_qts)
+    tweets_types = count_tweets_by_type(get_dates_range_key(dates_range_select))
+    return '{:,}'.format(tweets_types.get('qt', 0))
 
 
-def create_tweets_evolution_figure():
+@memoise
+def create_tweets_evolution_figure(dates_range_key):
     current_layout = copy.deepcopy(layout)
 
-    tweets_by_date = df.groupby(['date_hour', 'type'], as_index=False)['id'].count().\
-                     sort_values('date_hour', ascending=True)
+    tweets_by_date = filter_by_dates('date_hour_type', dates_range_key).\
+                     groupby(['date_hour', 'type'])['count'].sum().\
+                     unstack(fill_value=0).\
+                     reindex(columns=['rt', 'og', 'rp', 'qt'], fill_value=0).\
+                     sort_index()
 
-    index = tweets_by_date['date_hour'].unique()
-    rts = tweets_by_date.loc[tweets_by_date['type']=='rt','id'].values
-    ogs = tweets_by_date.loc[tweets_by_date['type']=='og','id'].values
-    rps = tweets_by_date.loc[tweets_by_date['type']=='rp','id'].values
-    qts = tweets_by_date.loc[tweets_by_date['type']=='qt','id'].values
+    index = tweets_by_date.index.values
+    rts = tweets_by_date['rt'].values
+    ogs = tweets_by_date['og'].values
+    rps = tweets_by_date['rp'].values
+    qts = tweets_by_date['qt'].values
 
     color_scale = px.colors.sequential.Blues_r
 
@@ -235,22 +366,14 @@ def create_tweets_evolution_figure():
     return fig
 
 
-def create_dist_lang_figure():
+@memoise
+def create_dist_lang_figure(dates_range_key):
     layout_pie = copy.deepcopy(layout)
 
-    languages_no_to_aggregate = ['es', 'ca', 'eu', 'gl', 'en', 'pt', 'fr', 'it']
-    df['lang_org'] = df['lang']
-    df.loc[~df.lang.isin(languages_no_to_aggregate),'lang'] = 'otro'
-    tweets_by_group = df.groupby('lang', as_index=False)['id'].count().sort_values('id', ascending=False)
-    values = [
-        tweets_by_group.loc[tweets_by_group['lang']=='es','id'].values[0],
-        tweets_by_group.loc[tweets_by_group['lang']=='ca','id'].values[0],
-        tweets_by_group.loc[tweets_by_group['lang']=='en','id'].values[0],
-        tweets_by_group.loc[tweets_by_group['lang']=='otro','id'].values[0],
-        tweets_by_group.loc[tweets_by_group['lang']=='pt','id'].values[0],
-        tweets_by_group.loc[tweets_by_group['lang']=='eu','id'].values[0],
-        tweets_by_group.loc[tweets_by_group['lang']=='gl','id'].values[0],
-    ]
+    tweets_by_group = filter_by_dates('date_lang', dates_range_key).\
+                      groupby('lang')['count'].sum()
+    values = tweets_by_group.reindex(['es', 'ca', 'en', 'otro', 'pt', 'eu', 'gl'],
+                                     fill_value=0).values.tolist()
 
     color_scale = px.colors.sequential.Blues_r
     colors = []
@@ -289,11 +412,13 @@ def create_dist_lang_figure():
     return figure
 
 
-def create_location_map():
+def create_location_map(dates_range_key):
     with urlopen('https://raw.githubusercontent.com/deldersveld/topojson/master/countries/spain/spain-comunidad.json') as response:
         ccaas = json.load(response)
 
-    fig = px.choropleth(df, geojson=ccaas['objects'], 
+    tweets_by_group = filter_by_dates('date_ccaa', dates_range_key).\
+                      groupby('comunidad_autonoma', as_index=False)['count'].sum()
+    fig = px.choropleth(tweets_by_group, geojson=ccaas['objects'],
                         range_color=(0, 12)
                         )
     fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
@@ -301,11 +426,13 @@ def create_location_map():
     return fig
 
 
-def create_dist_users():
+@memoise
+def create_dist_users(dates_range_key):
     layout_dist_users = copy.deepcopy(layout)
 
-    users_by_date = df.groupby(['date'])['user_screen_name'].nunique().reset_index().sort_values('date', ascending=True)
-    users_by_date.rename(columns={'user_screen_name': 'unique_users'}, inplace=True)
+    users_by_date = filter_by_dates('date_hour_users', dates_range_key).\
+                    groupby('date').apply(count_users_of).\
+                    reset_index(name='unique_users').sort_values('date', ascending=True)
 
     color_scale = px.colors.sequential.Blues_r
 
@@ -327,12 +454,12 @@ def create_dist_users():
     return figure
 
 
-def create_dist_sentiments():
+@memoise
+def create_dist_sentiments(dates_range_key):
     layout_dist_users = copy.deepcopy(layout)
     sentiment_colors = get_sentiment_colors()
-    sa_df = prepare_sentiment_df()
-    dist_sentiments = sa_df.groupby('sentiment_label', as_index=False).size().to_frame(name='count').reset_index()
-    dist_sentiments['prop'] = dist_sentiments['count']/sa_df.shape[0]
+    dist_sentiments = filter_by_dates('date_sentiment', dates_range_key).\
+                      groupby('sentiment_label', as_index=False)['count'].sum()
 
     labels = [label.title() for label in dist_sentiments['sentiment_label'].values]
 
@@ -368,15 +495,17 @@ def create_dist_sentiments():
     return figure
 
 
-def create_dist_locations():
+@memoise
+def create_dist_locations(dates_range_key):
     layout_dist_locations = copy.deepcopy(layout)
 
-    tweets_by_group = df.groupby('comunidad_autonoma', as_index=False)['id'].count().\
-                      sort_values('id', ascending=True)
+    tweets_by_group = filter_by_dates('date_ccaa', dates_range_key).\
+                      groupby('comunidad_autonoma', as_index=False)['count'].sum().\
+                      sort_values('count', ascending=True)
     tweets_by_group = tweets_by_group[tweets_by_group['comunidad_autonoma']!='desconocido']
 
     ccaas = tweets_by_group['comunidad_autonoma'].values.tolist()
-    num_tweets = tweets_by_group['id'].values.tolist()
+    num_tweets = tweets_by_group['count'].values.tolist()
 
     color_scale = px.colors.sequential.Blues_r
 
@@ -395,39 +524,19 @@ def create_dist_locations():
 
     return fig
 
-def create_dist_unique_users_weekday_figure():
+
+@memoise
+def create_dist_unique_users_weekday_figure(dates_range_key):
     current_layout = copy.deepcopy(layout)
     color_scale = px.colors.sequential.Blues_r
 
-    if 'day_week' not in list(df.columns):
-        df['created_at'] = pd.to_datetime(df['created_at'])
-        df['day_week'] = df['created_at'].dt.strftime('%A')
-        df.loc[df['day_week']=='Sunday','day_week'] = 'Domingo'
-        df.loc[df['day_week']=='Monday','day_week'] = 'Lunes'
-        df.loc[df['day_week']=='Tuesday','day_week'] = 'Martes'
-        df.loc[df['day_week']=='Wednesday','day_week'] = 'Miércoles'
-        df.loc[df['day_week']=='Thursday','day_week'] = 'Jueves'
-        df.loc[df['day_week']=='Friday','day_week'] = 'Viernes'
-        df.loc[df['day_week']=='Saturday','day_week'] = 'Sábado'
-    
-    if 'hour' not in list(df.columns):
-        df['hour'] = df['created_at'].dt.strftime('%H')
-
-    users_by_day_hour = df.groupby(['day_week','hour'])['user_screen_name'].nunique().reset_index().sort_values('day_week', ascending=True)
-    users_by_day_hour.rename(columns={'user_screen_name': 'unique_users'}, inplace=True)
+    users_by_day_hour = filter_by_dates('date_hour_users', dates_range_key).\
+                        groupby(['day_week', 'hour']).apply(count_users_of)
 
     x_axis = [datetime.time(i).strftime('%H') for i in range(24)]
     y_axis = ['Jueves', 'Viernes', 'Sábado', 'Domingo', 'Lunes', 'Martes', 'Miércoles']
-    z = np.zeros((7, 24))
-    for ind_y, day in enumerate(y_axis):
-        filtered_day = users_by_day_hour.loc[users_by_day_hour['day_week']==day]
-        for ind_x, hour in enumerate(x_axis):
-            vals = filtered_day.loc[filtered_day['hour']==hour,'unique_users'].values
-            if len(vals) > 0:
-                num_tweets = int(vals[0])
-            else:
-                num_tweets = 0
-            z[ind_y][ind_x] = num_tweets            
+    z = users_by_day_hour.unstack(fill_value=0).\
+        reindex(index=y_axis, columns=x_axis, fill_value=0).values
 
     data = [
         dict(
@@ -455,17 +564,21 @@ def create_dist_unique_users_weekday_figure():
     return figure
 
 
-def create_sentiment_evolution_figure():
+@memoise
+def create_sentiment_evolution_figure(dates_range_key):
     current_layout = copy.deepcopy(layout)
     sentiment_colors = get_sentiment_colors()
 
-    sa_df = prepare_sentiment_df()
-    tweets_by_group = sa_df.groupby(['date', 'sentiment_label'], as_index=False)['id'].count().sort_values('date', ascending=True)
+    tweets_by_group = filter_by_dates('date_sentiment', dates_range_key).\
+                      groupby(['date', 'sentiment_label'])['count'].sum().\
+                      unstack(fill_value=0).\
+                      reindex(columns=['positivo', 'negativo', 'neutral'], fill_value=0).\
+                      sort_index()
 
-    dates = tweets_by_group['date'].unique()
-    positives = tweets_by_group.loc[tweets_by_group['sentiment_label']=='positivo','id'].values
-    negatives = tweets_by_group.loc[tweets_by_group['sentiment_label']=='negativo','id'].values
-    neutrals = tweets_by_group.loc[tweets_by_group['sentiment_label']=='neutral','id'].values
+    dates = tweets_by_group.index.values
+    positives = tweets_by_group['positivo'].values
+    negatives = tweets_by_group['negativo'].values
+    neutrals = tweets_by_group['neutral'].values
 
     data = [
         dict(
@@ -498,6 +611,45 @@ def create_sentiment_evolution_figure():
     return figure
 
 
+# Figures are cached by the selected dates ranges, so selecting again a
+# previous combination of ranges doesn't recompute them
+@app.callback(Output("evo_tweets", "figure"), [Input("dates_range_select", "value")])
+def update_tweets_evolution_figure(dates_range_select):
+    return create_tweets_evolution_figure(get_dates_range_key(dates_range_select))
+
+
+@app.callback(Output("tweets_dist", "figure"), [Input("dates_range_select", "value")])
+def update_dist_locations(dates_range_select):
+    return create_dist_locations(get_dates_range_key(dates_range_select))
+
+
+@app.callback(Output("lang_dist", "figure"), [Input("dates_range_select", "value")])
+def update_dist_lang_figure(dates_range_select):
+    return create_dist_lang_figure(get_dates_range_key(dates_range_select))
+
+
+@app.callback(Output("unique_users_day_hour_dist", "figure"),
+              [Input("dates_range_select", "value")])
+def update_dist_unique_users_weekday_figure(dates_range_select):
+    return create_dist_unique_users_weekday_figure(get_dates_range_key(dates_range_select))
+
+
+@app.callback(Output("unique_users_date_dist", "figure"),
+              [Input("dates_range_select", "value")])
+def update_dist_users(dates_range_select):
+    return create_dist_users(get_dates_range_key(dates_range_select))
+
+
+@app.callback(Output("evo_sentiments", "figure"), [Input("dates_range_select", "value")])
+def update_sentiment_evolution_figure(dates_range_select):
+    return create_sentiment_evolution_figure(get_dates_range_key(dates_range_select))
+
+
+@app.callback(Output("sentiments_dist", "figure"), [Input("dates_range_select", "value")])
+def update_dist_sentiments(dates_range_select):
+    return create_dist_sentiments(get_dates_range_key(dates_range_select))
+
+
 # App layout
 app.layout = html.Div(
     [
@@ -593,11 +745,7 @@ app.layout = html.Div(
                             className="row flex-display",
                         ),
                         html.Div(
-                            [dcc.Graph(
-                                id='evo_tweets',
-                                figure=create_tweets_evolution_figure()
-                                )
-                            ],
+                            [dcc.Graph(id='evo_tweets')],
                             id="evo_tweets_container",
                             className="pretty_container",
                         ),
@@ -611,11 +759,11 @@ app.layout = html.Div(
         html.Div(
             [
                 html.Div(
-                    [dcc.Graph(id="tweets_dist", figure=create_dist_locations())],
+                    [dcc.Graph(id="tweets_dist")],
                     className="pretty_container seven columns",
                 ),
                 html.Div(
-                    [dcc.Graph(id="lang_dist", figure=create_dist_lang_figure())],
+                    [dcc.Graph(id="lang_dist")],
                     className="pretty_container five columns",
                 ),
             ],
@@ -624,11 +772,11 @@ app.layout = html.Div(
         html.Div(
             [
                 html.Div(
-                    [dcc.Graph(id="unique_users_day_hour_dist", figure=create_dist_unique_users_weekday_figure())],
+                    [dcc.Graph(id="unique_users_day_hour_dist")],
                     className="pretty_container seven columns",
                 ),
                 html.Div(
-                    [dcc.Graph(id="unique_users_date_dist", figure=create_dist_users())],
+                    [dcc.Graph(id="unique_users_date_dist")],
                     className="pretty_container five columns",
                 ),
             ],
@@ -637,11 +785,11 @@ app.layout = html.Div(
         html.Div(
             [
                 html.Div(
-                    [dcc.Graph(id="evo_sentiments", figure=create_sentiment_evolution_figure())],
+                    [dcc.Graph(id="evo_sentiments")],
                     className="pretty_container seven columns",
                 ),
                 html.Div(
-                    [dcc.Graph(id="sentiments_dist", figure=create_dist_sentiments())],
+                    [dcc.Graph(id="sentiments_dist")],
                     className="pretty_container five columns",
                 ),
             ],
@@ -1,22 +1,29 @@
 import csv
-import demoji
-import emoji
+import gzip
 import json
 import logging
 import nltk
 import pathlib
 import os
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-from collections import defaultdict
+from collections import deque
 from datetime import datetime
-from nltk import wordpunct_tokenize
-from nltk.corpus import stopwords
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 from nltk.stem import SnowballStemmer
-from random import seed, random
+from random import seed, random, Random
 import preprocessor as tw_preprocessor
+from utils.dashboard_cubes import DASHBOARD_COLUMNS, build_cubes, table_to_data, \
+        write_cubes
 from utils.db_manager import DBManager
 from utils.sentiment_analyzer import SentimentAnalyzer
-from utils.utils import exists_user, check_user_profile_image, week_of_month
+from utils.utils import exists_user, week_of_month, get_date_partitions, \
+                        get_file_sha256, validate_profile_image
+from utils.image_store import ProfileImageStore
+from utils.text_normalizer import TweetTextNormalizer
 
 
 logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('tw_coronavirus.log')),
@@ -121,6 +128,7 @@ def export_sentiment_scores_from_ids(file_tweet_ids, collection, config_fn):
 
 def save_tweets_in_csv_file(tweets, output_fn, headers):
     logging.info(f'Saving tweets in the CSV file {output_fn}')
+    saved_tweets = 0
     with open(output_fn, 'w') as csv_file:
         csv_writer = csv.DictWriter(csv_file, fieldnames=headers)
         csv_writer.writeheader()
@@ -156,6 +164,8 @@ def save_tweets_in_csv_file(tweets, output_fn, headers):
                         dict_row.update({'original_tweet': ''})
 
             csv_writer.writerow(dict_row)            
+            saved_tweets += 1
+    return saved_tweets
 
 
 def export_tweets(collection, output_path, config_fn=None, start_date=None, 
@@ -207,16 +217,279 @@ def export_tweets(collection, output_path, config_fn=None, start_date=None,
     output_fn = output_path + output_fn
     output_header = ['id', 'type', 'date', 'user', 'text', 'retweets', \
                      'favorites', 'replies', 'original_tweet']
-    save_tweets_in_csv_file(tweets, output_fn, output_header)
+    saved_tweets = save_tweets_in_csv_file(tweets, output_fn, output_header)
+    return output_fn, saved_tweets
+
+
+TWEETS_PARQUET_SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('type', pa.dictionary(pa.int32(), pa.string())),
+    ('date', pa.date32()),
+    ('created_at', pa.timestamp('s')),
+    ('lang', pa.dictionary(pa.int32(), pa.string())),
+    ('user_screen_name', pa.string()),
+    ('user_location', pa.string()),
+    ('sentiment_score', pa.float64()),
+    ('comunidad_autonoma', pa.dictionary(pa.int32(), pa.string())),
+    ('provincia', pa.dictionary(pa.int32(), pa.string())),
+    ('retweet_count', pa.int64()),
+    ('favorite_count', pa.int64())
+])
+
+
+def tweet_to_parquet_row(reduced_tweet):
+    created_at = reduced_tweet.get('created_at')
+    if isinstance(created_at, str):
+        created_at = datetime.strptime(created_at, '%a %b %d %H:%M:%S %z %Y').\
+                     replace(tzinfo=None)
+    row = {
+        'date': datetime.strptime(reduced_tweet['created_at_date'], '%Y-%m-%d').date(),
+        'created_at': created_at
+    }
+    for field in TWEETS_PARQUET_SCHEMA.names:
+        if field not in row:
+            row[field] = reduced_tweet.get(field)
+    if row['id'] is not None:
+        row['id'] = int(row['id'])
+    return row
+
+
+def rows_to_parquet_table(rows):
+    arrays = []
+    for field in TWEETS_PARQUET_SCHEMA:
+        values = [row[field.name] for row in rows]
+        if pa.types.is_dictionary(field.type):
+            array = pa.array(values, type=field.type.value_type).dictionary_encode()
+        else:
+            array = pa.array(values, type=field.type)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=TWEETS_PARQUET_SCHEMA)
+
+
+def save_tweets_in_parquet_dataset(tweets, output_path, row_group_size=100000):
+    """
+    Save tweets, sorted by created_at_date, in a Parquet dataset
+    partitioned by date (output_path/created_at_date=YYYY-MM-DD). Only the
+    file of the current date is open and rows are written in row groups
+    of row_group_size, so memory doesn't grow with the number of tweets.
+    Return the number of saved tweets
+    """
+    writer, current_date, rows = None, None, []
+    saved_tweets = 0
+    try:
+        for tweet in tweets:
+            row = tweet_to_parquet_row(tweet)
+            tweet_date = tweet['created_at_date']
+            if tweet_date != current_date:
+                if writer:
+                    if rows:
+                        writer.write_table(rows_to_parquet_table(rows))
+                        rows = []
+                    writer.close()
+                partition_dir = os.path.join(output_path, 
+                                             f'created_at_date={tweet_date}')
+                if not os.path.exists(partition_dir):
+                    os.makedirs(partition_dir)
+                writer = pq.ParquetWriter(os.path.join(partition_dir, 'part-0.parquet'),
+                                          TWEETS_PARQUET_SCHEMA, 
+                                          compression='snappy')
+                current_date = tweet_date
+            rows.append(row)
+            saved_tweets += 1
+            if len(rows) == row_group_size:
+                writer.write_table(rows_to_parquet_table(rows))
+                rows = []
+                logging.info('Exported {:,} tweets'.format(saved_tweets))
+        if writer and rows:
+            writer.write_table(rows_to_parquet_table(rows))
+    finally:
+        if writer:
+            writer.close()
+    return saved_tweets
+
+
+def export_tweets_to_parquet(collection, output_path, config_fn=None, 
+                             start_date=None, end_date=None, 
+                             row_group_size=100000):
+    """
+    Export tweets to a Parquet dataset partitioned by date that can be
+    read with column projection and filters on created_at_date
+    """
+    dbm = DBManager(collection=collection, config_fn=config_fn)
+    query = {}
+    if start_date and end_date:
+        query.update(
+            {'$and': [
+                {'created_at_date': {'$gte': start_date}},
+                {'created_at_date': {'$lte': end_date}}
+            ]}
+        )
+    elif start_date:
+        query.update(
+            {'created_at_date': {'$gte': start_date}}
+        )
+    elif end_date:
+        query.update(
+            {'created_at_date': {'$lte': end_date}}
+        )
+    projection = {
+        '_id': 0,
+        'id': 1,
+        'user.location': 1,
+        'user.screen_name': 1,
+        'lang': 1,
+        'sentiment.score': 1,
+        'retweeted_status.id': 1,
+        'is_quote_status': 1,
+        'in_reply_to_status_id_str': 1,
+        'created_at_date': 1,
+        'created_at': 1,
+        'comunidad_autonoma': 1,
+        'provincia': 1,
+        'retweet_count': 1,
+        'favorite_count': 1,
+        'type': 1
+    }
+    logging.info('Retrieving tweets...')
+    sort = [{'key': 'created_at_date', 'direction': 1}]
+    tweets = dbm.find_all(query, projection, sort=sort)
+    reduced_tweets = (dbm.reduce_tweet(tweet, projection) for tweet in tweets)
+    saved_tweets = save_tweets_in_parquet_dataset(reduced_tweets, output_path, 
+                                                  row_group_size)
+    logging.info('Process finished, {0:,} tweets were saved into {1}'.\
+                 format(saved_tweets, output_path))
+
+
+def export_dashboard_data(dataset_path, output_dir, start_date=None, 
+                          end_date=None):
+    """
+    Aggregate the tweets of a Parquet dataset exported with export-parquet
+    into the cubes read by the dashboard and publish them in output_dir as
+    uncompressed Arrow IPC files, which the dashboard memory-maps. Return
+    the number of aggregated tweets
+    """
+    filters = []
+    if start_date:
+        filters.append(('created_at_date', '>=', start_date))
+    if end_date:
+        filters.append(('created_at_date', '<=', end_date))
+    table = pq.read_table(dataset_path, columns=DASHBOARD_COLUMNS, 
+                          filters=filters if filters else None)
+    num_tweets = table.num_rows
+    data = table_to_data(table)
+    table = None # free some memory
+    write_cubes(build_cubes(data), output_dir)
+    logging.info('Process finished, {0:,} tweets were aggregated into {1}'.\
+                 format(num_tweets, output_dir))
+    return num_tweets
+
+
+def get_stratum_sizes(sample_size, stratum_counts, rng):
+    """
+    Split the sample among the strata proportionally to their number of
+    tweets. The rows left by rounding go to the strata with the largest
+    remainders, ties are broken at random so small samples are not biased
+    towards the first strata
+    """
+    total = sum(stratum_counts)
+    if total == 0:
+        stratum_counts, total = [1] * len(stratum_counts), len(stratum_counts)
+    exact_sizes = [sample_size * count / total for count in stratum_counts]
+    stratum_sizes = [int(exact_size) for exact_size in exact_sizes]
+    remainder = sample_size - sum(stratum_sizes)
+    by_remainder = sorted(range(len(exact_sizes)), 
+                          key=lambda i: (exact_sizes[i] - stratum_sizes[i], rng.random()),
+                          reverse=True)
+    for i in by_remainder[:remainder]:
+        stratum_sizes[i] += 1
+    return stratum_sizes
+
+
+def get_sentiment_strata(dbm, collection, config_fn=None, lang=None,
+                         stratify_by_lang=False, stats_collection='daily_stats'):
+    """
+    Return the strata (date, and language if requested) of the collection
+    and their number of tweets. They are taken from the daily rollup of 
+    the collection or, if it doesn't have one, from the distinct values 
+    of the indexed fields, and then all the strata count the same
+    """
+    dbm_stats = DBManager(collection=stats_collection, config_fn=config_fn)
+    daily_stats = sorted(dbm_stats.find_all({'collection': collection}, 
+                                            {'_id': 0, 'date': 1, 'total': 1,
+                                             'by_lang': 1}),
+                         key=lambda stats: stats['date'])
+    strata, stratum_counts = [], []
+    if daily_stats:
+        for stats in daily_stats:
+            if lang:
+                if stats['by_lang'].get(lang):
+                    strata.append({'created_at_date': stats['date'], 'lang': lang})
+                    stratum_counts.append(stats['by_lang'][lang])
+            elif stratify_by_lang:
+                for stratum_lang in sorted(stats['by_lang'].keys()):
+                    strata.append({'created_at_date': stats['date'], 
+                                   'lang': stratum_lang})
+                    stratum_counts.append(stats['by_lang'][stratum_lang])
+            else:
+                strata.append({'created_at_date': stats['date']})
+                stratum_counts.append(stats['total'])
+    else:
+        # without filters the distinct values are read from the indexes
+        dates = sorted(dbm.get_distinct('created_at_date'))
+        if lang:
+            strata = [{'created_at_date': date, 'lang': lang} for date in dates]
+        elif stratify_by_lang:
+            dbm.create_index('lang', 'asc')
+            langs = sorted(dbm.get_distinct('lang'))
+            strata = [{'created_at_date': date, 'lang': stratum_lang}
+                      for date in dates for stratum_lang in langs]
+        else:
+            strata = [{'created_at_date': date} for date in dates]
+        stratum_counts = [1] * len(strata)
+    return strata, stratum_counts
+
+
+def get_stratum_sample(dbm, stratum_size, stratum_query, projection, rng=None):
+    """
+    Sample the stratum with $sample or, if a random generator is given,
+    take the tweets that follow a random point of the indexed field 
+    sample_key, so that the sample can be reproduced
+    """
+    if not rng:
+        return dbm.get_sample(stratum_size, stratum_query, projection)
+    start_key = rng.random()
+    sort = [{'key': 'sample_key', 'direction': 1}]
+    tweets = []
+    # wrap around to the beginning of the keys if the end is reached
+    for key_range in [{'$gte': start_key}, {'$lt': start_key}]:
+        pagination = {'page_num': 1, 'page_size': stratum_size - len(tweets)}
+        tweets.extend(dbm.find_all(dict(stratum_query, sample_key=key_range),
+                                   projection, sort, pagination))
+        if len(tweets) >= stratum_size:
+            break
+    return tweets
 
 
 def export_sentiment_sample(sample_size, collection, config_fn=None, 
-                            output_filename=None, lang=None):
+                            output_filename=None, lang=None, 
+                            stratify_by_lang=False, random_seed=None,
+                            stats_collection='daily_stats'):
+    """
+    Export a sample of tweets stratified by date (and optionally by 
+    language), allocated to the strata by their number of tweets. Every
+    stratum is sampled in the database with $match and $sample, so only 
+    the tweets of the sample are read. If random_seed is given the sample
+    is reproducible: tweets get a random sample_key once and every stratum
+    is read from a random point of its index
+    """
     current_path = pathlib.Path(__file__).resolve()
     project_dir = current_path.parents[1]
     dbm = DBManager(collection=collection, config_fn=config_fn)
     query = {
+        'sentiment.score': {'$exists': 1}
     }
+    if lang:
+        query.update({'lang': lang})
     projection = {
         '_id': 0,
         'id': 1,
@@ -226,42 +499,59 @@ def export_sentiment_sample(sample_size, collection, config_fn=None,
         'created_at_date': 1,
         'lang': 1
     }
-    seed(1)
-    logging.info('Retrieving tweets...')
-    tweets = dbm.find_all(query, projection)
-    total_tweets = tweets.count()
-    logging.info('Found {} tweets'.format(total_tweets))
+    # strata are matched by date (and language) before sampling them
+    index_fields = [('created_at_date', 'asc')]
+    if stratify_by_lang or lang:
+        index_fields.append(('lang', 'asc'))
+    if random_seed is not None:
+        dbm.create_index('sample_key', 'asc')
+        logging.info('Adding sample keys...')
+        dbm.add_random_field('sample_key')
+        index_fields.append(('sample_key', 'asc'))
+    if len(index_fields) > 1:
+        dbm.create_compound_index(index_fields)
+    else:
+        dbm.create_index('created_at_date', 'asc')
+    logging.info('Getting strata...')
+    strata, stratum_counts = get_sentiment_strata(dbm, collection, config_fn, 
+                                                  lang, stratify_by_lang, 
+                                                  stats_collection)
+    if not strata:
+        logging.info('Found 0 tweets')
+        return
+    logging.info('Found {} strata'.format(len(strata)))
     if not output_filename:
         output_filename = 'sentiment_analysis_sample.csv'
     output_file = os.path.join(project_dir, 'data', output_filename)
     logging.info('Processing and saving tweets into {}'.format(output_file))
-    sample_size = int(sample_size)
+    rng = Random(random_seed)
+    stratum_sizes = get_stratum_sizes(int(sample_size), stratum_counts, rng)
     saved_tweets = 0
-    tweets_by_date = defaultdict(int)
-    MAX_TWEETS_BY_DATE = 6
     with open(output_file, 'w') as csv_file:
         csv_writer = csv.DictWriter(csv_file, 
                                     fieldnames=['id', 'date', 'user', 'text', 'score'])
         csv_writer.writeheader()
-        for tweet in tweets:
-            if lang and tweet['lang'] != lang:
+        for stratum, stratum_size in zip(strata, stratum_sizes):
+            if stratum_size == 0:
                 continue
-            if random() > 0.5:
-                if tweets_by_date[tweet['created_at_date']] <= MAX_TWEETS_BY_DATE:                                    
-                    saved_tweets += 1
-                    tweets_by_date[tweet['created_at_date']] += 1
-                    csv_writer.writerow(
-                        {
-                            'id': tweet['id'],
-                            'date': tweet['created_at_date'],
-                            'user': tweet['user']['screen_name'],
-                            #'lang': tweet['lang'],
-                            'text': tweet['complete_text'],
-                            'score': tweet['sentiment']['score']
-                        }
-                    )
-            if saved_tweets == sample_size:
-                break
+            stratum_query = dict(query, **stratum)
+            tweets = get_stratum_sample(dbm, stratum_size, stratum_query, 
+                                        projection, 
+                                        rng if random_seed is not None else None)
+            for tweet in tweets:
+                saved_tweets += 1
+                csv_writer.writerow(
+                    {
+                        'id': tweet['id'],
+                        'date': tweet['created_at_date'],
+                        'user': tweet['user']['screen_name'],
+                        #'lang': tweet['lang'],
+                        'text': tweet['complete_text'],
+                        'score': tweet['sentiment']['score']
+                    }
+                )
+    logging.info('Process finished, {0:,} tweets were saved into {1}'.\
+                 format(saved_tweets, output_file))
 
 
 def export_user_sample(sample_size, collection, config_file=None, output_filename=None):
@@ -291,11 +581,29 @@ def export_user_sample(sample_size, collection, config_file=None, output_filenam
                 f.write("{}\n".format(json.dumps(user_obj)))                
 
 
-def do_export_users(collection, config_file=None, output_filename=None):
+def validate_user_picture(img_path):
+    # run by the workers of do_export_users, None means that the picture
+    # is already in the image store
+    if img_path is None:
+        return None
+    if not os.path.exists(img_path):
+        return 'missing', None, None
+    return validate_profile_image(img_path)
+
+
+def do_export_users(collection, config_file=None, output_filename=None, 
+                    workers=4, chunk_size=1000):
+    """
+    Export the users whose profile picture is valid. Users are read in
+    chunks and the pictures that are not in the image store yet are 
+    validated by a pool of processes, keeping the order of the users
+    """
     project_dir = pathlib.Path(__file__).parents[1].resolve()
     if not output_filename:
         output_filename = 'users.jsonl'
     output = os.path.join(project_dir, 'data', output_filename)
+    image_store = ProfileImageStore(os.path.join(project_dir, 'user_pics', 
+                                                 'image_store'))
     dbm = DBManager(collection=collection, config_fn=config_file)
     query = {
         '$and': [ 
@@ -313,35 +621,59 @@ def do_export_users(collection, config_file=None, output_filename=None):
         'img_path': 1
     }
     logging.info('Retrieving users...')
-    users = list(dbm.find_all(query, projection))
-    total_users = len(users)
-    logging.info('Found {} users'.format(total_users))
+    users = dbm.find_all(query, projection)
     accepted_extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.JPG', '.JPEG', '.PNG', '.BMP')
-    with open(output, 'w') as f:
-        for user in users:
-            if 'prediction' in user:
-                logging.info('Found field prediction, ignoring user {}'.format(user['screen_name']))
-                continue
-            if 'img_path' not in user:
-                logging.info('User {} does not have img_path field'.format(user['screen_name']))
-                continue
-            if user['img_path'] == '[no_img]':
-                logging.info('User {} has img_path=[no_img]'.format(user['screen_name']))
-                continue
-            if not user['img_path'].endswith(accepted_extensions):
-                logging.info('User {} has image with extension {}'.format(user['screen_name'], user['img_path']))
-                continue
-            try:
+    processed_users, exported_users = 0, 0
+    with open(output, 'w') as f, Pool(processes=workers) as pool:
+        for users_chunk in get_tweet_chunks(users, chunk_size):
+            candidates = []
+            for user in users_chunk:
+                if 'prediction' in user:
+                    logging.info('Found field prediction, ignoring user {}'.format(user['screen_name']))
+                    continue
+                if 'img_path' not in user:
+                    logging.info('User {} does not have img_path field'.format(user['screen_name']))
+                    continue
+                if user['img_path'] == '[no_img]':
+                    logging.info('User {} has img_path=[no_img]'.format(user['screen_name']))
+                    continue
+                if not user['img_path'].endswith(accepted_extensions):
+                    logging.info('User {} has image with extension {}'.format(user['screen_name'], user['img_path']))
+                    continue
                 img_path = os.path.join(project_dir, user['img_path'])
-                check_user_profile_image(img_path)
-                logging.info('Exporting user: {}'.format(user['screen_name']))
-                f.write("{}\n".format(json.dumps(user)))                
-            except Exception as e:
-                logging.warning('Error when resizing {0}\nThe error message is: {1}\n'.format(img_path, e))
+                candidates.append((user, img_path))
+            pending_paths = []
+            for user, img_path in candidates:
+                if image_store.get_status(user['id'], img_path) is None:
+                    pending_paths.append(img_path)
+                else:
+                    pending_paths.append(None)
+            validations = pool.imap(validate_user_picture, pending_paths, 
+                                    chunksize=16)
+            for (user, img_path), validation in zip(candidates, validations):
+                if validation is None:
+                    status = image_store.get_status(user['id'], img_path)
+                else:
+                    status = image_store.put(user['id'], img_path, *validation)
+                if status == 'ok':
+                    logging.info('Exporting user: {}'.format(user['screen_name']))
+                    f.write("{}\n".format(json.dumps(user)))                
+                    exported_users += 1
+                else:
+                    logging.warning('The picture {0} is not valid ({1})'.format(img_path, status))
+            processed_users += len(users_chunk)
+            image_store.save()
+            logging.info('Processed {0:,} users, exported {1:,}'.\
+                         format(processed_users, exported_users))
+    image_store.save()
     logging.info('Process finished, output was saved into {}'.format(output))
 
 
-def process_tweets(tweets, stemming=False, stemmer=None, banned_accounts=[]):
+def process_tweets(tweets, stemming=False, stemmer=None, banned_accounts=[],
+                   normalizer=None):
+    if not normalizer:
+        normalizer = TweetTextNormalizer(stemmer)
+    banned_accounts = set(banned_accounts)
     processed_tweets = []
     for tweet in tweets:
         logging.info('Processing tweet: {}'.format(tweet['id']))
@@ -352,23 +684,9 @@ def process_tweets(tweets, stemming=False, stemmer=None, banned_accounts=[]):
             tweet_txt = tweet['text']
         if tweet['user']['screen_name'] in banned_accounts:
             continue
-        # remove emojis, urls, mentions
-        processed_txt = tw_preprocessor.clean(tweet_txt)
-        processed_txt = demoji.replace(processed_txt).replace('\u200d️','').strip()
-        processed_txt = emoji.get_emoji_regexp().sub(u'', processed_txt)
-        tokens = [token.lower() for token in wordpunct_tokenize(processed_txt)]        
-        if tweet['lang'] == 'es':
-            stop_words = stopwords.words('spanish')
-            punct_signs = ['.', '[', ']', ',', ';', ')', '),', '(']
-            stop_words.extend(punct_signs)
-            words = [token for token in tokens if token not in stop_words]
-            if stemming:                    
-                stemmers = [stemmer.stem(word) for word in words]
-                processed_txt = ' '.join([stem for stem in stemmers if stem.isalpha() and len(stem) > 1])
-            else:
-                processed_txt = ' '.join(word for word in words)
-        else:
-            processed_txt = ' '.join([token for token in tokens])
+        # remove emojis, urls, mentions, and stopwords
+        processed_txt = normalizer.normalize_tweet(tweet_txt, tweet['lang'], 
+                                                   stemming)
         tweet['text'] = processed_txt
         if 'sentiment' in tweet:
             tweet['sentiment_polarity'] = tweet['sentiment']['score']
@@ -393,8 +711,43 @@ def process_tweets(tweets, stemming=False, stemmer=None, banned_accounts=[]):
     return processed_tweets
 
 
+def get_tweet_chunks(tweets, chunk_size):
+    chunk = list(islice(tweets, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(tweets, chunk_size))
+
+
+def process_tweet_chunks(chunks, process_fn, workers=1):
+    """
+    Apply process_fn to the chunks yielding the results in the same order.
+    With several workers, at most two chunks per worker are in flight
+    so that memory doesn't grow with the number of chunks
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            yield process_fn(chunk)
+        return
+    with Pool(processes=workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(process_fn, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
 def export_tweets_to_json(collection, output_fn, config_fn=None, stemming=False, 
-                          lang=None, banned_accounts=[], exclude_rts=False):    
+                          lang=None, banned_accounts=[], exclude_rts=False,
+                          output_format=None, workers=1, chunk_size=5000,
+                          start_date=None, end_date=None):    
+    """
+    Export processed tweets as they are read from the database. The output
+    format (json or jsonl) is taken from the extension of the output file
+    if not given, files ending in .gz are compressed with gzip. Return the
+    number of exported tweets
+    """
     if exclude_rts:
         query = {
             'type': {'$ne': 'retweet'}
@@ -407,6 +760,10 @@ def export_tweets_to_json(collection, output_fn, config_fn=None, stemming=False,
                 'lang': {'$eq': lang}
             }   
         )     
+    if start_date:
+        query.setdefault('created_at_date', {}).update({'$gte': start_date})
+    if end_date:
+        query.setdefault('created_at_date', {}).update({'$lte': end_date})
     projection = {
         '_id': 0,
         'id': 1, 
@@ -427,29 +784,119 @@ def export_tweets_to_json(collection, output_fn, config_fn=None, stemming=False,
         stemmer = SnowballStemmer('spanish')
     else:
         stemmer = None
-    PAGE_SIZE = 70000
-    page_num = 0
-    records_to_read = True
-    tweets_to_save = []
-    while records_to_read:
-        page_num += 1
-        pagination = {'page_num': page_num, 'page_size': PAGE_SIZE}
-        logging.info('Retrieving tweets...')
-        dbm = DBManager(collection=collection, config_fn=config_fn)
-        tweets = list(dbm.find_all(query, projection, pagination=pagination))
-        total_tweets = len(tweets)
-        logging.info('Found {:,} tweets'.format(total_tweets))
-        if total_tweets == 0:
-            break
-        tweets_to_save.extend(process_tweets(tweets, stemming, stemmer, banned_accounts))
-    with open(output_fn, 'a', encoding='utf-8') as f:
-        f.write('[')
-        for idx, tweet in enumerate(tweets_to_save):            
-            if idx < len(tweets_to_save)-1:
-                f.write('{},\n'.format(json.dumps(tweet, ensure_ascii=False)))
-            else:
-                f.write('{}\n'.format(json.dumps(tweet, ensure_ascii=False)))
-        f.write(']')
+    compress = output_fn.endswith('.gz')
+    if not output_format:
+        base_fn = output_fn[:-3] if compress else output_fn
+        if base_fn.endswith(('.jsonl', '.ndjson')):
+            output_format = 'jsonl'
+        else:
+            output_format = 'json'
+    normalizer = TweetTextNormalizer(stemmer)
+    process_fn = partial(process_tweets, stemming=stemming, stemmer=stemmer,
+                         banned_accounts=banned_accounts, normalizer=normalizer)
+    dbm = DBManager(collection=collection, config_fn=config_fn)
+    logging.info('Retrieving tweets...')
+    tweets = dbm.find_all(query, projection)
+    chunks = get_tweet_chunks(tweets, chunk_size)
+    if compress:
+        f = gzip.open(output_fn, 'wt', encoding='utf-8')
+    else:
+        f = open(output_fn, 'w', encoding='utf-8')
+    saved_tweets = 0
+    with f:
+        if output_format == 'json':
+            f.write('[')
+        for processed_tweets in process_tweet_chunks(chunks, process_fn, workers):
+            for tweet in processed_tweets:
+                tweet_json = json.dumps(tweet, ensure_ascii=False)
+                if output_format == 'json':
+                    if saved_tweets > 0:
+                        f.write(',\n')
+                    f.write(tweet_json)
+                else:
+                    f.write('{}\n'.format(tweet_json))
+                saved_tweets += 1
+            logging.info('Exported {:,} tweets'.format(saved_tweets))
+        if output_format == 'json':
+            f.write('\n]')
+    logging.info('Process finished, {0:,} tweets were saved into {1}'.\
+                 format(saved_tweets, output_fn))
+    return saved_tweets
+
+
+def export_partition(partition, collection, output_path, config_fn, 
+                     output_format, json_kwargs):
+    """
+    Export the tweets of a partition of dates to its own file. It runs
+    in a worker process, so the connection to the database is opened here
+    """
+    start_date, end_date = partition
+    if start_date == end_date:
+        label = start_date
+    else:
+        label = f'{start_date}_{end_date}'
+    if output_format == 'csv':
+        output_fn, saved_tweets = export_tweets(collection, 
+                                                os.path.join(output_path, ''), 
+                                                config_fn, start_date, 
+                                                None if label == start_date else end_date)
+    else:
+        output_fn = os.path.join(output_path, f'tweets_{label}.{output_format}')
+        saved_tweets = export_tweets_to_json(collection, output_fn, config_fn, 
+                                             output_format=output_format,
+                                             start_date=start_date, 
+                                             end_date=end_date, **json_kwargs)
+    return {
+        'file': os.path.basename(output_fn),
+        'start_date': start_date,
+        'end_date': end_date,
+        'rows': saved_tweets,
+        'sha256': get_file_sha256(output_fn)
+    }
+
+
+def export_tweets_partitioned(collection, output_path, start_date, end_date, 
+                              config_fn=None, partition_by='day', workers=4,
+                              output_format='csv', save_manifest=True, 
+                              **json_kwargs):
+    """
+    Split the range of dates in partitions of one day or one week and
+    export every partition to a separate file in parallel, each worker 
+    with its own connection to the database. The manifest 
+    (manifest.json) lists the files with their number of rows and 
+    their sha256 checksum
+    """
+    if output_format not in ['csv', 'json', 'jsonl']:
+        raise Exception('Unknown output format {}, it should be csv, json or jsonl'.\
+                        format(output_format))
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    partitions = get_date_partitions(start_date, end_date, partition_by)
+    logging.info('Exporting {0} partitions using {1} workers'.\
+                 format(len(partitions), workers))
+    export_fn = partial(export_partition, collection=collection, 
+                        output_path=output_path, config_fn=config_fn, 
+                        output_format=output_format, json_kwargs=json_kwargs)
+    exported_files = []
+    with Pool(processes=workers) as pool:
+        for exported_file in pool.imap_unordered(export_fn, partitions):
+            logging.info('Exported {0:,} tweets into {1}'.\
+                         format(exported_file['rows'], exported_file['file']))
+            exported_files.append(exported_file)
+    exported_files.sort(key=lambda exported_file: exported_file['start_date'])
+    if save_manifest:
+        manifest = {
+            'collection': collection,
+            'start_date': start_date,
+            'end_date': end_date,
+            'partition_by': partition_by,
+            'output_format': output_format,
+            'total_rows': sum([f['rows'] for f in exported_files]),
+            'files': exported_files
+        }
+        with open(os.path.join(output_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+    return exported_files
 
 
 def export_user_sample_to_csv(query, sample_size, collection, randomize=True,
@@ -496,6 +943,7 @@ def export_user_sample_to_csv(query, sample_size, collection, randomize=True,
 
 
 def from_corpus_to_json(corpus_fn, output_fn):
+    normalizer = TweetTextNormalizer()
     print('Reading corpus...')
     with open(corpus_fn, 'r') as csv_file:
         csv_reader = csv.DictReader(csv_file, delimiter='\t')
@@ -505,11 +953,7 @@ def from_corpus_to_json(corpus_fn, output_fn):
             tweet_counter += 1
             print('[{0}] Processing tweet {1}'.format(tweet_counter, row['id_str']))
             text = row['complete_text']
-            processed_txt = tw_preprocessor.clean(text)
-            processed_txt = demoji.replace(processed_txt).replace('\u200d️','').strip()
-            processed_txt = emoji.get_emoji_regexp().sub(u'', processed_txt)
-            tokens = [token.lower() for token in wordpunct_tokenize(processed_txt)]
-            processed_txt = ' '.join([token for token in tokens])
+            processed_txt = normalizer.normalize_tweet(text, lang=None)
             id_tweet = int(row['id_str'])
             dict_tweet = {
                 'id': id_tweet,
@@ -172,6 +172,7 @@ def load_user_demographics(input_file, collection, config_fn=None):
     dbm = DBManager(collection=collection, config_fn=config_fn)
     users_to_update = []
     processing_counter = total_segs = 0
+    prediction_date = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
     with open(input_file, 'r') as csv_file:
         csv_reader = csv.DictReader(csv_file)
         rows = list(csv_reader)
@@ -188,6 +189,7 @@ def load_user_demographics(input_file, collection, config_fn=None):
             user_id = row['id']
             del row['id']
             row['prediction'] = 'succeded'
+            row['prediction_date'] = prediction_date
             users_to_update.append(
                 {
                     'filter': {'id_str': user_id},
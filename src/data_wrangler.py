@@ -14,22 +14,31 @@ import time
 import sys
 
 from collections import defaultdict
+from itertools import groupby
 from datetime import date, datetime, timedelta
 from m3inference import M3Twitter
 from m3inference.dataset import M3InferenceDataset
 from m3inference import consts
-from report_generator import pre_process_data
 from pymongo.errors import AutoReconnect, ExecutionTimeout, NetworkTimeout
 from utils.demographic_detector import DemographicDetector
 from utils.embeddings_trainer import EmbeddingsTrainer
-from utils.language_detector import detect_language, do_detect_language
+from utils.hyperloglog import HyperLogLog
+from utils.language_detector import detect_language, do_detect_language, \
+        detect_language_batch
 from utils.location_detector import LocationDetector
+from utils.metric_refresh_scheduler import MetricRefreshScheduler
+from utils.picture_downloader import ProfilePictureDownloader
+from utils.image_store import ProfileImageStore
 from utils.db_manager import DBManager
 from utils.utils import get_tweet_datetime, SPAIN_LANGUAGES, \
         get_covid_keywords, get_spain_places_regex, get_spain_places, \
         calculate_remaining_execution_time, get_config, normalize_text, \
-        exists_user, check_user_profile_image
+        exists_user, get_user_fingerprint
 from utils.sentiment_analyzer import SentimentAnalyzer
+from utils.tweet_hydrator import TweetHydrator
+from utils.tweet_expressions import get_tweet_type_expression, \
+        get_sentiment_label_expression, get_hour_expression, \
+        get_sentiment_accumulators
 from torchvision import transforms
 from twarc import Twarc
 from tqdm import tqdm
@@ -822,35 +831,131 @@ def add_esp_location_flags(collection, config_fn, doc_type='tweet'):
 def get_twm_obj():
     current_path = pathlib.Path(__file__).parent.resolve()
     config = get_config(os.path.join(current_path, 'config.json'))
-    twm = Twarc(config['twitter_api']['consumer_key'], 
-                config['twitter_api']['consumer_secret'],
-                config['twitter_api']['access_token'],
-                config['twitter_api']['access_token_secret'])
+    credentials = get_twitter_credentials(config)[0]
+    twm = Twarc(credentials['consumer_key'], 
+                credentials['consumer_secret'],
+                credentials['access_token'],
+                credentials['access_token_secret'])
     return twm
 
 
+def get_twitter_credentials(config=None):
+    """
+    Return the list of credentials of the Twitter API. The key twitter_api
+    of the configuration file can hold either one set of credentials or
+    a list of them
+    """
+    if not config:
+        current_path = pathlib.Path(__file__).parent.resolve()
+        config = get_config(os.path.join(current_path, 'config.json'))
+    credentials = config['twitter_api']
+    if isinstance(credentials, dict):
+        credentials = [credentials]
+    return credentials
+
+
+def get_last_job_run(job_name, collection, config_fn=None):
+    """
+    Return the date in which the job was last run over the collection or
+    None if it has never been run
+    """
+    dbm = DBManager(collection='job_runs', config_fn=config_fn)
+    job_run = dbm.find_record({'job': job_name, 'collection': collection})
+    if job_run:
+        return job_run['last_run_date']
+    return None
+
+
+def save_job_run(job_name, collection, run_date, config_fn=None):
+    dbm = DBManager(collection='job_runs', config_fn=config_fn)
+    dbm.update_record({'job': job_name, 'collection': collection},
+                      {'last_run_date': run_date}, create_if_doesnt_exist=True)
+
+
+def backfill_metric_refresh_queue(dbm, scheduler, current_date, logger):
+    """
+    Add to the refresh queue the original tweets hydrated before the queue
+    existed, which are not selected as new tweets anymore. Tweets that
+    don't exist anymore (next update in 2080) are left out
+    """
+    query = {
+        'last_metric_update_date': {'$ne': None},
+        'metric_refresh_queued': {'$eq': None},
+        'retweeted_status': {'$exists': 0}
+    }
+    projection = {
+        '_id': 0,
+        'id_str': 1,
+        'created_at_date': 1,
+        'retweet_count': 1,
+        'favorite_count': 1,
+        'last_metric_update_date': 1,
+        'next_metric_update_date': 1
+    }
+    logger.info('Adding tweets refreshed before the queue existed...')
+    tweets, update_queries = [], []
+    total_tweets = 0
+    for tweet in dbm.find_all(query, projection):
+        total_tweets += 1
+        if tweet.get('next_metric_update_date') != '2080-01-01':
+            tweets.append(tweet)
+        update_queries.append(
+            {
+                'filter': {'id_str': tweet['id_str']},
+                'new_values': {'metric_refresh_queued': 1}
+            }
+        )
+        if len(update_queries) >= BATCH_SIZE:
+            scheduler.enqueue_refreshed(tweets, current_date)
+            add_fields(dbm, update_queries)
+            tweets, update_queries = [], []
+    scheduler.enqueue_refreshed(tweets, current_date)
+    if len(update_queries) > 0:
+        add_fields(dbm, update_queries)
+    logger.info('Found {:,} tweets refreshed before the queue existed'.\
+                format(total_tweets))
+
+
 def update_metric_tweets(collection, config_fn=None, source_collection=None,
-                         date=None):
+                         date=None, lookup_url=None, daily_budget=None,
+                         backfill=False):
     current_path = pathlib.Path(__file__).parent.resolve()
     logging_file = os.path.join(current_path, 'tw_coronavirus.log')    
     logger = setup_logger('logger', logging_file)
-    twm = get_twm_obj()
+    credentials = get_twitter_credentials()
+    hydrator = TweetHydrator(credentials, lookup_url=lookup_url)
+    if not daily_budget:
+        # the quota of all tokens during a whole day
+        daily_budget = len(credentials) * TweetHydrator.REQUESTS_PER_WINDOW * \
+                       TweetHydrator.MAX_IDS_PER_REQUEST * \
+                       int(timedelta(days=1).total_seconds() / TweetHydrator.WINDOW_SECS)
+    # every collection of tweets has its own queue
+    scheduler = MetricRefreshScheduler(config_fn=config_fn, 
+                                       collection='metric_refresh_queue_' + collection,
+                                       daily_budget=int(daily_budget))
     dbm = DBManager(collection=collection, config_fn=config_fn)
+    dbm.create_index('retweeted_status.id_str', 'asc')
+    # tweets refreshed since the previous run are propagated to retweets
+    dbm.create_index('last_metric_update_date', 'asc')
     dbm_source = None
     if source_collection:
         dbm_source = DBManager(collection=source_collection, config_fn=config_fn)
     current_date = datetime.today()
     current_date_str = current_date.strftime('%Y-%m-%d')
+    last_run_date = get_last_job_run('update_metric_tweets', collection, 
+                                     config_fn)
     if date:
         query = {
             'created_at_date': date
         }
     else:
+        if backfill or not last_run_date:
+            # first run with the refresh queue
+            backfill_metric_refresh_queue(dbm, scheduler, current_date, logger)
+        # tweets that have not been added to the refresh queue yet
         query = {
-            '$or': [
-                {'last_metric_update_date': {'$eq': None}},
-                {'next_metric_update_date': current_date_str}            
-            ]                    
+            'last_metric_update_date': {'$eq': None},
+            'metric_refresh_queued': {'$eq': None}
         }
     projection = {
         '_id':0,
@@ -858,25 +963,17 @@ def update_metric_tweets(collection, config_fn=None, source_collection=None,
         'created_at_date':1,
         'retweeted_status.id_str': 1
     }
-    #PAGE_SIZE = 500000
-    #page_num = 0
-    #records_to_read = True
-    processing_counter = total_segs = 0
-    #while records_to_read:
-    #    page_num += 1
-    #    pagination = {'page_num': page_num, 'page_size': PAGE_SIZE}
     logger.info('Retrieving tweets...')
     tweet_objs = dbm.find_all(query=query, projection=projection)
     tweets = [tweet_obj for tweet_obj in tweet_objs]
     total_tweets = len(tweets)
     logger.info('Found {:,} tweets'.format(total_tweets))
-#    if total_tweets == 0:
-#        break
     max_batch = BATCH_SIZE if total_tweets > BATCH_SIZE else total_tweets
     processing_counter = total_segs = 0
-    tweet_ids, rts = [], []
-    org_tweets = {}
+    new_tweets = []
     update_queries = []
+    # tweets whose metrics were copied from the source collection
+    copied_ids = set()
     # processing tweets
     logger.info('Processing original tweets...')
     for tweet in tweets:
@@ -899,84 +996,95 @@ def update_metric_tweets(collection, config_fn=None, source_collection=None,
                     'new_values': new_values
                 }                        
             )
+            copied_ids.add(tweet['id_str'])
             logger.info('[{0}/{1}] Found tweet in source collection'.format(processing_counter, total_tweets))
+            if len(update_queries) >= max_batch:
+                add_fields(dbm, update_queries)
+                update_queries = []
             continue
         if 'retweeted_status' not in tweet.keys():
-            tweet_ids.append(tweet['id_str'])
-        else:
-            rts.append({
+            new_tweets.append({
                 'id_str': tweet['id_str'],
-                'parent_id': tweet['retweeted_status']['id_str']
+                'created_at_date': tweet['created_at_date']
             })
-        if len(tweet_ids) == max_batch or processing_counter == (total_tweets-1):
-            logger.info('Hydratating tweets...')
+        update_queries.append(
+            {
+                'filter': {'id_str': tweet['id_str']},
+                'new_values': {'metric_refresh_queued': 1}
+            }
+        )
+        if len(update_queries) >= max_batch:
+            scheduler.enqueue(new_tweets, current_date)
+            new_tweets = []
+            add_fields(dbm, update_queries)
             update_queries = []
-            tweet_date = datetime.strptime(tweet['created_at_date'], '%Y-%m-%d')
-            diff_date = current_date - tweet_date
-            next_update_date = current_date + timedelta(days=diff_date.days)
-            next_update_date_str = next_update_date.strftime('%Y-%m-%d')
-            hydrated_tweet_ids = []
-            for tweet_obj in twm.hydrate(tweet_ids):
-                new_values = {
-                    'retweet_count': tweet_obj['retweet_count'],
-                    'favorite_count': tweet_obj['favorite_count'],
-                    'last_metric_update_date': current_date_str,
-                    'next_metric_update_date': next_update_date_str
-                }
-                org_tweets[tweet_obj['id_str']] = new_values
-                update_queries.append(
-                    {
-                        'filter': {'id_str': tweet_obj['id_str']},
-                        'new_values': new_values
-                    }                        
-                )
-                hydrated_tweet_ids.append(tweet_obj['id_str'])
-            miss_ids = set(tweet_ids) - set(hydrated_tweet_ids)
-            logging.info('Out of the {} tweets searched to be hydrated, {} '\
-                        'do not exist anymore'.format(len(tweet_ids),len(miss_ids)))
-            for miss_id in miss_ids:
-                new_values = {
-                    'last_metric_update_date': current_date_str,
-                    'next_metric_update_date': '2080-01-01'
-                }
-                org_tweets[miss_id] = new_values
-                update_queries.append(
-                    {
-                        'filter': {'id_str': miss_id},
-                        'new_values': new_values
-                    }                        
-                )
-            if len(update_queries) > 0:
-                add_fields(dbm, update_queries)
-            tweet_ids = []
         total_segs = calculate_remaining_execution_time(start_time, total_segs,
                                                         processing_counter, 
                                                         total_tweets)
+    scheduler.enqueue(new_tweets, current_date)
     if len(update_queries) > 0:
         add_fields(dbm, update_queries)
-    # processing rts
-    logger.info('Processing retweets...')
-    update_queries = []
-    processing_counter = total_segs = 0
-    total_tweets = len(rts)
-    for rt in rts:        
-        if rt['parent_id'] in org_tweets:
-            start_time = time.time()
-            processing_counter += 1
+    if date:
+        tweet_ids = [tweet['id_str'] for tweet in tweets 
+                     if 'retweeted_status' not in tweet and \
+                        tweet['id_str'] not in copied_ids]
+    else:
+        tweet_ids = scheduler.get_due_tweets(current_date)
+    logger.info('{0:,} tweets are due to be refreshed'.format(len(tweet_ids)))
+    
+    def save_hydrated_batch(tweet_ids, hydrated_tweets):
+        if hydrated_tweets is None:
+            logger.info('Could not hydrate a batch of {} tweets, they will be '\
+                        'tried again in the next run'.format(len(tweet_ids)))
+            return
+        update_queries = []
+        next_due_dates = scheduler.reschedule(tweet_ids, hydrated_tweets, 
+                                              current_date)
+        for tweet_obj in hydrated_tweets:
+            tweet_id = tweet_obj['id_str']
+            if tweet_id not in next_due_dates:
+                continue
+            new_values = {
+                'retweet_count': tweet_obj['retweet_count'],
+                'favorite_count': tweet_obj['favorite_count'],
+                'last_metric_update_date': current_date_str,
+                'next_metric_update_date': next_due_dates[tweet_id].strftime('%Y-%m-%d')
+            }
             update_queries.append(
                 {
-                    'filter': {'id_str': rt['id_str']},
-                    'new_values': org_tweets[rt['parent_id']]
+                    'filter': {'id_str': tweet_id},
+                    'new_values': new_values
                 }                        
             )
-            if len(update_queries) == max_batch:
-                add_fields(dbm, update_queries)
-                update_queries = []
-            total_segs = calculate_remaining_execution_time(start_time, total_segs,
-                                                            processing_counter, 
-                                                            total_tweets)
-    if len(update_queries) > 0:
-        add_fields(dbm, update_queries)
+        miss_ids = set(tweet_ids) - set(next_due_dates.keys())
+        logger.info('Out of the {} tweets searched to be hydrated, {} '\
+                    'do not exist anymore'.format(len(tweet_ids),len(miss_ids)))
+        for miss_id in miss_ids:
+            new_values = {
+                'last_metric_update_date': current_date_str,
+                'next_metric_update_date': '2080-01-01'
+            }
+            update_queries.append(
+                {
+                    'filter': {'id_str': miss_id},
+                    'new_values': new_values
+                }                        
+            )
+        if len(update_queries) > 0:
+            add_fields(dbm, update_queries)
+
+    logger.info('Hydratating tweets...')
+    stats = hydrator.hydrate(tweet_ids, save_hydrated_batch)
+    logger.info('Hydrated {0:,} tweets, {1:,} do not exist anymore and {2:,} '\
+                'could not be hydrated'.format(stats['hydrated'], 
+                                               stats['missing'], 
+                                               stats['failed']))
+    # propagate metrics to the retweets of the tweets updated since the
+    # previous run, including tweets refreshed by other runs
+    logger.info('Propagating metrics to retweets...')
+    dbm.propagate_metrics_to_retweets(last_run_date)
+    save_job_run('update_metric_tweets', collection, current_date_str, 
+                 config_fn)
 
 
 def do_add_complete_text_flag(collection, config_fn):
@@ -1075,6 +1183,8 @@ def do_update_user_status(collection, config_fn=None, log_fn=None):
     else:
         user_logger = logging
     dbm = DBManager(collection=collection, config_fn=config_fn)
+    image_store = ProfileImageStore(os.path.join(project_dir, 'user_pics', 
+                                                 'image_store'))
     query = {
         'predicted': {'$eq': None}
     }
@@ -1118,13 +1228,12 @@ def do_update_user_status(collection, config_fn=None, log_fn=None):
                     else:
                         img_path_to_save = '/'.join(img_path.split('/')[-2:])
                     if os.path.exists(img_path):
-                        try:
-                            check_user_profile_image(img_path)                            
+                        if image_store.validate(user['id'], img_path) == 'ok':
                             users_to_update.append({
                                 'filter': {'id': int(user['id'])},
                                 'new_values': {'exists': 1, 'img_path': img_path_to_save}
                             })
-                        except:
+                        else:
                             users_to_update.append({
                                 'filter': {'id': int(user['id'])},
                                 'new_values': {'exists': 2}
@@ -1141,12 +1250,14 @@ def do_update_user_status(collection, config_fn=None, log_fn=None):
                     })
         if len(users_to_update) >= max_batch:            
             add_fields(dbm, users_to_update)
+            image_store.save()
             users_to_update = []        
         total_segs = calculate_remaining_execution_time(start_time, total_segs,
                                                         processing_counter, 
                                                         total_users)
-    if len(users_to_update) >= 0:
+    if len(users_to_update) > 0:
         add_fields(dbm, users_to_update)
+    image_store.save()
 
 
 def process_user_batch(users_batch):
@@ -1316,7 +1427,23 @@ def do_update_users_collection(collection, user_collection=None, config_fn=None,
             add_fields(dbm, tweet_update_queries)
 
 
-def do_augment_user_data(collection, config_fn=None, log_fn=None):
+def augment_user(user, m3twitter):
+    fields_to_update = {}
+    augmented_user = m3twitter.transform_jsonl_object(user)
+    fields_to_update['img_path'] = '/'.join(augmented_user['img_path'].split('/')[-2:])
+    if augmented_user['lang'] is None:
+        if 'lang_detected' in user:                    
+            fields_to_update['lang'] = user['lang_detected']
+        else:
+            fields_to_update['lang'] = 'un'
+    else:
+        fields_to_update['lang'] = augmented_user['lang']
+    fields_to_update['exists'] = 1
+    return fields_to_update
+
+
+def do_augment_user_data(collection, config_fn=None, log_fn=None, 
+                         num_workers=16):
     current_path = pathlib.Path(__file__).resolve()
     project_dir = current_path.parents[1]
     user_pics_dir = 'user_pics'
@@ -1324,6 +1451,7 @@ def do_augment_user_data(collection, config_fn=None, log_fn=None):
     if not os.path.exists(user_pics_path):
         os.mkdir(user_pics_path)
     m3twitter = M3Twitter(cache_dir=user_pics_path)
+    downloader = ProfilePictureDownloader(user_pics_path, num_workers=num_workers)
     dbm = DBManager(collection=collection, config_fn=config_fn)
     query = {
         'img_path': {'$eq': None}
@@ -1343,72 +1471,102 @@ def do_augment_user_data(collection, config_fn=None, log_fn=None):
     total_users = len(users)
     logging.info('Fetched {} users'.format(total_users))
     processing_counter = total_segs = 0
-    max_batch = BATCH_SIZE if total_users > BATCH_SIZE else total_users
-    users_to_update = []
-    for user in users:
-        start_time = time.time()
-        processing_counter += 1
-        fields_to_update = {}
-        try:
-            logging.info('Augmenting data of user {}'.format(user['screen_name']))
-            augmented_user = m3twitter.transform_jsonl_object(user)
-            fields_to_update['img_path'] = '/'.join(augmented_user['img_path'].split('/')[-2:])
-            if augmented_user['lang'] is None:
-                if 'lang_detected' in user:                    
-                    fields_to_update['lang'] = user['lang_detected']
-                else:
-                    fields_to_update['lang'] = 'un'
+    for i in range(0, total_users, BATCH_SIZE):
+        batch_users = users[i:i+BATCH_SIZE]
+        # download in parallel the pictures that m3twitter would fetch 
+        # one by one
+        users_to_download = [user for user in batch_users 
+                             if not user.get('default_profile_image') and 
+                             user.get('profile_image_url_https')]
+        logging.info('Downloading {} profile pictures...'.format(len(users_to_download)))
+        downloads = downloader.download_all(users_to_download)
+        users_to_update = []
+        for user in batch_users:
+            start_time = time.time()
+            processing_counter += 1
+            download = downloads.get(user['id_str'])
+            if download and download['status'] == 'failed':
+                # transient error, the user will be processed in the next run
+                logging.info('Could not download the picture of the user {}, '\
+                             'it will be tried again later'.format(user['screen_name']))
+                continue
+            if download and download['status'] == 'missing':
+                logging.info('The picture of the user {} does not exist '\
+                             'anymore'.format(user['screen_name']))
+                fields_to_update = {'img_path': '[no_img]', 'exists': 0}
             else:
-                fields_to_update['lang'] = augmented_user['lang']
-            fields_to_update['exists'] = 1
-        except:
-            logging.info('Could not augment data of user {}'.format(user['screen_name']))
-            fields_to_update['img_path'] = '[no_img]'
-            fields_to_update['exists'] = 0
-        users_to_update.append(
-            {
-                'filter': {'id': int(user['id'])},
-                'new_values': fields_to_update
-            }            
-        )
-        if len(users_to_update) >= max_batch:
+                try:
+                    logging.info('Augmenting data of user {}'.format(user['screen_name']))
+                    fields_to_update = augment_user(user, m3twitter)
+                except:
+                    logging.info('Could not augment data of user {}'.format(user['screen_name']))
+                    fields_to_update = {'img_path': '[no_img]', 'exists': 0}
+            users_to_update.append(
+                {
+                    'filter': {'id': int(user['id'])},
+                    'new_values': fields_to_update
+                }            
+            )
+            total_segs = calculate_remaining_execution_time(start_time, total_segs,
+                                                            processing_counter, 
+                                                            total_users)
+        if len(users_to_update) > 0:
             add_fields(dbm, users_to_update)
-            users_to_update = []
-        total_segs = calculate_remaining_execution_time(start_time, total_segs,
-                                                        processing_counter, 
-                                                        total_users)
-    if len(users_to_update) > 0:
-        add_fields(dbm, users_to_update)
+    downloader.close()
 
 
-def predict_demographics(users_to_predict, demog_detector, dbm):
+def predict_demographics(users_to_predict, demog_detector, dbm, 
+                         fingerprints=None):
     users_to_update = []
-    try:
-        predictions = demog_detector.infer(users_to_predict)        
-        users_to_update = []
-        predicted_user_ids = []
-        for prediction in predictions:
-            user_id = prediction['id']
-            predicted_user_ids.append(user_id)
-            del prediction['id']
-            prediction['prediction'] = 'succeded'
-            users_to_update.append(
-                {
-                    'filter': {'id': int(user_id)},
-                    'new_values': prediction
+    prediction_date = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+    if not fingerprints:
+        fingerprints = {}
+    predictions, failed_user_ids = \
+        demog_detector.infer_isolating_failures(users_to_predict)
+    for prediction in predictions:
+        user_id = prediction['id']
+        del prediction['id']
+        prediction['prediction'] = 'succeded'
+        prediction['prediction_date'] = prediction_date
+        if user_id in fingerprints:
+            prediction['prediction_fingerprint'] = fingerprints[user_id]
+        users_to_update.append(
+            {
+                'filter': {'id': int(user_id)},
+                'new_values': prediction
+            }
+        )
+    for user_id in failed_user_ids:
+        users_to_update.append(
+            {
+                'filter': {'id': int(user_id)},
+                'new_values': {
+                    'prediction': 'failed',
+                    'prediction_error': 'inference_error',
+                    'prediction_fingerprint': fingerprints.get(user_id)
                 }
-            )    
+            }
+        )
+    if len(users_to_update) > 0:
         add_fields(dbm, users_to_update)
-    except:
-        pass # TODO: Take action when prediction fails
+    return len(predictions)
 
 
-def compute_user_demographics(collection, config_fn=None):
+def compute_user_demographics(collection, config_fn=None, batch_size=16,
+                              num_workers=4, num_threads=None):
     current_path = pathlib.Path(__file__).resolve()
     project_dir = current_path.parents[1]
     user_pics_dir = 'user_pics'
     user_pics_path = os.path.join(project_dir, user_pics_dir)
-    demog_detector = DemographicDetector(user_pics_path)
+    # pictures are decoded and resized once, inference reads them from the
+    # memory-mapped image store
+    image_store = ProfileImageStore(os.path.join(user_pics_path, 'image_store'))
+    demog_detector = DemographicDetector(user_pics_path, batch_size=batch_size,
+                                         num_workers=num_workers, 
+                                         num_threads=num_threads,
+                                         image_store=image_store)
+    inference_start_time = time.time()
+    predicted_users = 0
     dbm = DBManager(collection=collection, config_fn=config_fn)
     query = {
         'exists': 1              
@@ -1422,6 +1580,7 @@ def compute_user_demographics(collection, config_fn=None):
         'description': 1,
         'lang': 1,
         'img_path': 1,
+        'prediction_fingerprint': 1
     }
     logging.info('Retriving users...')
     users = list(dbm.find_all(query, projection))
@@ -1431,6 +1590,8 @@ def compute_user_demographics(collection, config_fn=None):
     max_batch = BATCH_SIZE if total_users > BATCH_SIZE else total_users
     users_to_predict = []
     users_no_prediction = []
+    fingerprints = {}
+    unchanged_users = 0
     for user in users:
         if 'img_path' not in user:
             continue
@@ -1441,6 +1602,14 @@ def compute_user_demographics(collection, config_fn=None):
         if 'tw_coronavirus' not in user['img_path']:
             img_path = os.path.join(project_dir, user['img_path'])
         if os.path.exists(img_path):             
+            fingerprint = get_user_fingerprint(user, img_path)
+            if fingerprint == user.get('prediction_fingerprint'):
+                # neither the picture nor the profile changed since the 
+                # last prediction
+                unchanged_users += 1
+                continue
+            fingerprints[user['id_str']] = fingerprint
+            image_store.validate(user['id_str'], img_path)
             users_to_predict.append(
                 {
                     'id': user['id_str'],
@@ -1463,9 +1632,12 @@ def compute_user_demographics(collection, config_fn=None):
                 }
             )
         if len(users_to_predict) >= max_batch:
+            image_store.save()
             logging.info('Doing predictions...')
-            predict_demographics(users_to_predict, demog_detector, dbm)
+            predicted_users += predict_demographics(users_to_predict, demog_detector, dbm,
+                                                    fingerprints)
             users_to_predict = []
+            fingerprints = {}
         if len(users_no_prediction) >= max_batch:
             logging.info('Updating users without profile pic')
             add_fields(dbm, users_no_prediction)
@@ -1473,12 +1645,20 @@ def compute_user_demographics(collection, config_fn=None):
         total_segs = calculate_remaining_execution_time(start_time, total_segs,
                                                         processing_counter, 
                                                         total_users)
+    image_store.save()
     if len(users_to_predict) > 0:
         logging.info('Doing final predictions...')
-        predict_demographics(users_to_predict, demog_detector, dbm)
+        predicted_users += predict_demographics(users_to_predict, demog_detector, dbm,
+                                                fingerprints)
     if len(users_no_prediction) > 0:
         logging.info('Updating users without profile pic')
         add_fields(dbm, users_no_prediction)
+    logging.info('Skipped {0:,} users whose picture and profile did not '\
+                 'change'.format(unchanged_users))
+    elapsed_secs = time.time() - inference_start_time
+    logging.info('Predicted the demographics of {0:,} users at {1:.1f} '\
+                 'users/sec'.format(predicted_users, 
+                                    predicted_users/max(elapsed_secs, 1e-6)))
 
 
 def compute_user_demographics_from_file(input_file, output_filename=None):
@@ -1500,6 +1680,49 @@ def compute_user_demographics_from_file(input_file, output_filename=None):
     demog_detector.save_predictions(predictions, output_filename)
 
 
+def preprocess_user_pictures(collection, config_fn=None):
+    """
+    Validate and resize once the profile pictures of users, storing them
+    in the image store so that later checks don't need to open them again
+    """
+    current_path = pathlib.Path(__file__).resolve()
+    project_dir = current_path.parents[1]
+    image_store = ProfileImageStore(os.path.join(project_dir, 'user_pics', 
+                                                 'image_store'))
+    dbm = DBManager(collection=collection, config_fn=config_fn)
+    query = {
+        '$and': [
+            {'img_path': {'$ne': None}},
+            {'img_path': {'$ne': '[no_img]'}}
+        ]
+    }
+    projection = {
+        '_id': 0,
+        'id_str': 1,
+        'img_path': 1
+    }
+    logging.info('Retriving users...')
+    users = list(dbm.find_all(query, projection))
+    total_users = len(users)
+    logging.info('Fetched {0:,} users'.format(total_users))
+    processing_counter = total_segs = 0
+    statuses = defaultdict(int)
+    for user in users:
+        start_time = time.time()
+        processing_counter += 1
+        img_path = user['img_path']
+        if 'tw_coronavirus' not in img_path:
+            img_path = os.path.join(project_dir, img_path)
+        statuses[image_store.validate(user['id_str'], img_path)] += 1
+        if processing_counter % BATCH_SIZE == 0:
+            image_store.save()
+        total_segs = calculate_remaining_execution_time(start_time, total_segs,
+                                                        processing_counter, 
+                                                        total_users)
+    image_store.save()
+    logging.info('Status of the pictures: {}'.format(dict(statuses)))
+
+
 def check_user_pictures_from_file(input_file):
     current_path = pathlib.Path(__file__).resolve()
     project_dir = current_path.parents[1]
@@ -1542,6 +1765,7 @@ def check_user_pictures(collection, config_fn=None):
     project_dir = current_path.parents[1]
     user_pics_dir = 'user_pics'
     user_pics_path = os.path.join(project_dir, user_pics_dir)
+    image_store = ProfileImageStore(os.path.join(user_pics_path, 'image_store'))
     dbm = DBManager(collection=collection, config_fn=config_fn)
     query = {
         '$and': [
@@ -1573,9 +1797,9 @@ def check_user_pictures(collection, config_fn=None):
                         if 'tw_coronavirus' not in img_path:
                             img_path = os.path.join(project_dir, user['img_path'])
                         if os.path.exists(img_path):
-                            try:
-                                image = PIL.Image.open(img_path)
-                                img_size = image.size
+                            status = image_store.validate(user['id_str'], img_path)
+                            if status in ('ok', 'too_small'):
+                                img_size = image_store.get_original_size(user['id_str'])
                                 if img_size == CORRECT_IMG_SIZE:
                                     ok_users += 1
                                 else:
@@ -1587,7 +1811,7 @@ def check_user_pictures(collection, config_fn=None):
                                             'problem_info': str(img_size)
                                         }
                                     )                                
-                            except:
+                            else:
                                 problem_users += 1
                                 csv_writer.writerow(
                                     {
@@ -1615,6 +1839,7 @@ def check_user_pictures(collection, config_fn=None):
                             }
                         )
                 pbar.update(1)                
+    image_store.save()
     print('Users with ok images: {0:,} ({1}%)'.\
         format(ok_users, round(ok_users/total_users,0)))
     print('\n\n')
@@ -1705,45 +1930,72 @@ def fix_user_lang(collection, config_fn=None):
 
 
 def update_user_demo_tweets(collection_tweets, collection_users, config_fn=None):
+    """
+    Copy the demographics of users into their tweets. A single aggregation
+    joins the users whose prediction changed since the last run with their
+    tweets and merges the demographic fields into them
+    """
     dbm_tweets = DBManager(collection=collection_tweets, config_fn=config_fn)
     dbm_users = DBManager(collection=collection_users, config_fn=config_fn)
-    query = {
-        'exists': 1
-    }
-    projection = {
-        '_id': 0,
-        'id': 1,
-        'prediction': 1,
-        'age_range': 1,
-        'type': 1,
-        'gender': 1
+    dbm_tweets.create_index('user.id', 'asc')
+    current_datetime = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+    last_run_date = get_last_job_run('update_user_demo_tweets', 
+                                     collection_tweets, config_fn)
+    match = {
+        'exists': 1,
+        'prediction': {'$in': ['succeded', 'success']}
     }
-    print('Retriving users...')
-    users = list(dbm_users.find_all(query, projection))
-    total_users = len(users)
-    print('Fetched {0:,} users'.format(total_users))
-    processing_counter = total_segs = 0
-    for user in users:
-        start_time = time.time()
-        processing_counter += 1
-        if 'prediction' in user and \
-            (user['prediction'] == 'succeded' or user['prediction'] == 'success'):
-            print('Updating tweets of the user: {}'.format(user['id']))
-            dbm_tweets.update_record_many(
-                {
-                    'user.id': int(user['id'])
-                },
-                {
-                    'user.prediction': user['prediction'],
-                    'user.age_range': user['age_range'],                        
-                    'user.gender': user['gender'],
-                    'user.type': user['type'],
+    if last_run_date:
+        print('Updating users whose prediction changed since {}'.format(last_run_date))
+        match['prediction_date'] = {'$gte': last_run_date}
+    pipeline = [
+        {'$match': match},
+        {'$project': {
+            '_id': 0,
+            'id': 1,
+            'prediction': 1,
+            'age_range': 1,
+            'type': 1,
+            'gender': 1
+        }},
+        {'$lookup': {
+            'from': collection_tweets,
+            'let': {'user_id': {'$toLong': '$id'}},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$user.id', '$$user_id']}}},
+                {'$project': {'_id': 1}}
+            ],
+            'as': 'tweet'
+        }},
+        {'$unwind': '$tweet'},
+        {'$project': {
+            '_id': '$tweet._id',
+            'prediction': 1,
+            'age_range': 1,
+            'type': 1,
+            'gender': 1
+        }},
+        {'$merge': {
+            'into': collection_tweets,
+            'on': '_id',
+            'whenMatched': [
+                {'$set': {
+                    'user.prediction': '$$new.prediction',
+                    'user.age_range': '$$new.age_range',
+                    'user.gender': '$$new.gender',
+                    'user.type': '$$new.type',
                     'updated_user': 1
-                }
-            )
-        total_segs = calculate_remaining_execution_time(start_time, total_segs,
-                                                        processing_counter, 
-                                                        total_users)
+                }}
+            ],
+            'whenNotMatched': 'discard'
+        }}
+    ]
+    print('Updating demographics of tweets...')
+    start_time = time.time()
+    dbm_users.aggregate(pipeline)
+    save_job_run('update_user_demo_tweets', collection_tweets, current_datetime, 
+                 config_fn)
+    print('Tweets updated in {0:.2f} seconds'.format(time.time()-start_time))
 
 
 def remove_tweets_from_text(search_string, collection, del_collection=None, 
@@ -1830,25 +2082,138 @@ def remove_users(banned_accounts_fn, tweets_collection, users_collection,
             remove_user(account, dbm_tweets, dbm_users) 
 
 
-def is_the_total_tweets_above_median(collection, str_date, time_window_in_days, config_fn=None):
+def compute_daily_stats(dbm, str_date):
+    """
+    Compute in the database the number of tweets of the date by type,
+    language, sentiment label and autonomous community, the hourly counts
+    read by the report and the HyperLogLog sketch of its unique users
+    """
+    match = {'$match': {'created_at_date': str_date}}
+    facets = {
+        'by_type': get_tweet_type_expression(),
+        'by_lang': {'$ifNull': ['$lang', 'und']},
+        'by_sentiment': get_sentiment_label_expression(),
+        'by_ccaa': {'$ifNull': ['$comunidad_autonoma', 'desconocido']}
+    }
+    hour = get_hour_expression()
+    hourly_facets = {
+        'by_hour_type': [{'$group': {
+            '_id': {'hour': hour, 'type': get_tweet_type_expression()},
+            'count': {'$sum': 1}
+        }}],
+        'by_hour_sentiment': [{'$group': dict(
+            {'_id': {'hour': hour, 
+                     'sentiment_label': get_sentiment_label_expression()}},
+            **get_sentiment_accumulators()
+        )}]
+    }
+    pipeline_facets = {
+        facet: [{'$group': {'_id': expression, 'count': {'$sum': 1}}}]
+        for facet, expression in facets.items()
+    }
+    pipeline_facets.update(hourly_facets)
+    pipeline = [match, {'$facet': pipeline_facets}]
+    counts = dbm.aggregate(pipeline)[0]
+    stats = {'date': str_date}
+    for facet in facets.keys():
+        stats[facet] = {doc['_id']: doc['count'] for doc in counts[facet]}
+    # hourly counts are kept as lists of rows, like the tables of the report
+    for facet in hourly_facets.keys():
+        stats[facet] = []
+        for doc in counts[facet]:
+            row = doc.pop('_id')
+            row.update(doc)
+            stats[facet].append(row)
+    stats['total'] = sum(stats['by_type'].values())
+    users_hll = HyperLogLog()
+    users = dbm.aggregate([match, {'$group': {'_id': '$user.screen_name'}}])
+    for user in users:
+        users_hll.add(user['_id'])
+    stats['unique_users'] = users_hll.count()
+    stats['users_hll'] = users_hll.to_bytes()
+    stats['updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return stats
+
+
+def do_update_daily_stats(collection, config_fn=None, stats_collection='daily_stats',
+                          dates=None, days_back=1, rebuild=False):
+    """
+    Update the daily rollup of the collection. If no dates are given,
+    only the days after the last day in the rollup are computed, together
+    with the last days_back days, which could have changed since they
+    were computed
+    """
     dbm = DBManager(collection=collection, config_fn=config_fn)
-    query = {}
+    dbm_stats = DBManager(collection=stats_collection, config_fn=config_fn)
+    dbm_stats.create_compound_index([('collection', 'asc'), ('date', 'asc')], 
+                                    unique=True)
+    dbm.create_index('created_at_date', 'asc')
+    if not dates:
+        query = {}
+        if not rebuild:
+            sort = [{'key': 'date', 'direction': -1}]
+            pagination = {'page_num': 1, 'page_size': 1}
+            last_stats = list(dbm_stats.find_all({'collection': collection}, 
+                                                 {'_id': 0, 'date': 1}, sort, 
+                                                 pagination))
+            if last_stats:
+                last_date = datetime.strptime(last_stats[0]['date'], '%Y-%m-%d')
+                from_date = last_date - timedelta(days=int(days_back))
+                query = {'created_at_date': {'$gte': from_date.strftime('%Y-%m-%d')}}
+        dates = sorted(dbm.get_distinct('created_at_date', query))
+    logging.info('Updating the daily stats of {0:,} dates'.format(len(dates)))
+    for str_date in dates:
+        stats = compute_daily_stats(dbm, str_date)
+        stats['collection'] = collection
+        dbm_stats.update_record({'collection': collection, 'date': str_date}, 
+                                stats, create_if_doesnt_exist=True)
+        logging.info('Updated stats of {0}: {1:,} tweets'.format(str_date, 
+                                                                 stats['total']))
+
+
+def get_unique_users_estimate(collection, start_date, end_date, config_fn=None, 
+                              stats_collection='daily_stats'):
+    """
+    Estimate the unique users between two dates merging the sketches of
+    the daily rollup
+    """
+    dbm_stats = DBManager(collection=stats_collection, config_fn=config_fn)
+    query = {
+        'collection': collection,
+        'date': {'$gte': start_date, '$lte': end_date}
+    }
+    users_hll = HyperLogLog()
+    for stats in dbm_stats.find_all(query, {'_id': 0, 'users_hll': 1}):
+        users_hll.merge(HyperLogLog.from_bytes(stats['users_hll']))
+    return users_hll.count()
+
+
+def is_the_total_tweets_above_median(collection, str_date, time_window_in_days, 
+                                     config_fn=None, stats_collection='daily_stats'):
+    dbm_stats = DBManager(collection=stats_collection, config_fn=config_fn)
+    query = {'collection': collection}
     projection = {
         '_id': 0,
-        'id': 1,
-        'created_at_date': 1
+        'date': 1,
+        'total': 1
     }
     time_window_in_days = int(time_window_in_days)
-    data = dbm.get_tweets_reduced(query, projection)
-    tweets_df = pd.DataFrame(data)
-    tweets_df['created_at_date'] = pd.to_datetime(tweets_df['created_at_date']).dt.date
-    tweets_by_date = tweets_df.groupby('created_at_date', as_index=False)['id'].count()
-    ref_date = max(tweets_by_date['created_at_date']) - timedelta(days=time_window_in_days)
-    median_last_days = tweets_by_date[tweets_by_date['created_at_date'] > ref_date]['id'].median()
+    tweets_by_date = pd.DataFrame(list(dbm_stats.find_all(query, projection)))
+    if tweets_by_date.empty:
+        raise Exception('There are no daily stats of the collection {}, '\
+                        'run update-daily-stats first'.format(collection))
+    tweets_by_date['date'] = pd.to_datetime(tweets_by_date['date']).dt.date
+    ref_date = max(tweets_by_date['date']) - timedelta(days=time_window_in_days)
+    median_last_days = tweets_by_date[tweets_by_date['date'] > ref_date]['total'].median()
     print(f'Median of tweets of the last {time_window_in_days} days: {median_last_days}')
     datetime_obj = datetime.strptime(str_date, '%Y-%m-%d')
     date_obj = date(datetime_obj.year, datetime_obj.month, datetime_obj.day)
-    num_tweets_date = tweets_by_date.loc[tweets_by_date['created_at_date']==date_obj, 'id'].values[0]
+    num_tweets_date = tweets_by_date.loc[tweets_by_date['date']==date_obj, 'total']
+    if num_tweets_date.empty:
+        raise Exception('There are no daily stats of the collection {0} for '\
+                        'the date {1}, run update-daily-stats with --date {1} '\
+                        'first'.format(collection, str_date))
+    num_tweets_date = num_tweets_date.values[0]
     print(f'Number of tweets published in {str_date}: {num_tweets_date}')
     if num_tweets_date > median_last_days:
         return True
@@ -1867,6 +2232,22 @@ def add_status_users(dbm_tweets, users, status):
                                       {'user.exists': status})
 
 
+def add_status_users_bulk(dbm_tweets, users, status):
+    """
+    Set the status of the users in their tweets issuing a single update
+    per batch of users
+    """
+    total_users = len(users)
+    processed_users = 0
+    for i in range(0, total_users, BATCH_SIZE):
+        user_ids = [user['id'] for user in users[i:i+BATCH_SIZE]]
+        processed_users += len(user_ids)
+        ret = dbm_tweets.update_record_many({'user.id': {'$in': user_ids}}, 
+                                            {'user.exists': status})
+        print(f'[{processed_users}/{total_users}] Updated status of users in '\
+              f'{ret.modified_count} tweets')
+
+
 def add_status_inactive_users_in_tweets(tweets_collection, users_collection, 
                                         config_fn=None):
     dbm_tweets = DBManager(collection=tweets_collection, config_fn=config_fn)
@@ -1880,7 +2261,8 @@ def add_status_inactive_users_in_tweets(tweets_collection, users_collection,
     print('Getting inactive users...')
     inactive_users = list(dbm_users.find_all(query, projection))
     print(f'Found {len(inactive_users)} inactive users')
-    add_status_users(dbm_tweets, inactive_users, 0)
+    dbm_tweets.create_index('user.id', 'asc')
+    add_status_users_bulk(dbm_tweets, inactive_users, 0)
     
 
 def add_status_active_users_in_tweets(tweets_collection, users_collection, 
@@ -1896,7 +2278,8 @@ def add_status_active_users_in_tweets(tweets_collection, users_collection,
     print('Getting active users...')
     active_users = list(dbm_users.find_all(query, projection))
     print(f'Found {len(active_users)} active users')
-    add_status_users(dbm_tweets, active_users, 1)
+    dbm_tweets.create_index('user.id', 'asc')
+    add_status_users_bulk(dbm_tweets, active_users, 1)
 
 
 def process_user_updates(user_ids, dbm_users, twm):
@@ -1923,9 +2306,27 @@ def process_user_updates(user_ids, dbm_users, twm):
         add_fields(dbm_users, update_queries)
 
 
+def process_user_updates_bulk(user_ids, dbm_users, twm):
+    """
+    Same as process_user_updates but updating all the existing users and
+    all the missing users of the batch with one update each
+    """
+    existing_users = [str(user_obj['id']) for user_obj in twm.user_lookup(user_ids)]
+    miss_users = list(set(user_ids) - set(existing_users))
+    logging.info('Out of the {} users searched, {} '\
+                 'do not exist anymore'.format(len(user_ids),len(miss_users)))
+    if len(existing_users) > 0:
+        dbm_users.update_record_many({'id_str': {'$in': existing_users}}, 
+                                     {'exists': 1})
+    if len(miss_users) > 0:
+        dbm_users.update_record_many({'id_str': {'$in': miss_users}}, 
+                                     {'exists': 0})
+
+
 def update_user_status(users_collection, config_fn):
     twm = get_twm_obj()
     dbm_users = DBManager(collection=users_collection, config_fn=config_fn)
+    dbm_users.create_index('id_str', 'asc')
     query = {}
     projection = {
         '_id': 0,
@@ -1944,10 +2345,10 @@ def update_user_status(users_collection, config_fn):
                      total_users, user['screen_name']))
         user_ids.append(str(user['id']))
         if len(user_ids) == max_batch:
-            process_user_updates(user_ids, dbm_users, twm)
+            process_user_updates_bulk(user_ids, dbm_users, twm)
             user_ids = []
     if len(user_ids) > 0:
-        process_user_updates(user_ids, dbm_users, twm)
+        process_user_updates_bulk(user_ids, dbm_users, twm)
 
 
 def identify_users_from_outside_spain(collection, config_fn=None):
@@ -2010,8 +2411,14 @@ def identify_users_from_outside_spain(collection, config_fn=None):
 
 
 def add_user_lang_flag(users_collection, tweets_collection, config_fn=None):
+    """
+    Flag users with the language they use the most in their tweets. Tweets
+    are streamed sorted by author so that the tweets of each user are
+    grouped without querying them user by user
+    """
     dbm_users = DBManager(collection=users_collection, config_fn=config_fn)
     dbm_tweets = DBManager(collection=tweets_collection, config_fn=config_fn)
+    dbm_tweets.create_index('user.screen_name', 'asc')
     query = {
         'comunidad_autonoma': 'desconocido'
     }
@@ -2025,40 +2432,41 @@ def add_user_lang_flag(users_collection, tweets_collection, config_fn=None):
     users = list(dbm_users.find_all(query, projection))
     total_users = len(users)
     processing_counter = 0
-    update_queries = []
-    max_batch = BATCH_SIZE if total_users > BATCH_SIZE else total_users
-    for user in users:
-        processing_counter += 1
-        logging.info('[{}/{}] Processing user: {}'.format(processing_counter, \
-                     total_users, user['screen_name']))
-        # get tweets of user
-        query = {'user.screen_name': user['screen_name']}
-        projection = {'_id': 0, 'id_str': 1, 'complete_text': 1}
-        tweets = list(dbm_tweets.find_all(query, projection))
-        total_tweets = len(tweets)
-        logging.info('Found {} tweets of the user {}'.format(total_tweets, user['screen_name']))
-        if total_tweets > 0:
+    for i in range(0, total_users, BATCH_SIZE):
+        batch_users = {user['screen_name']: user for user in users[i:i+BATCH_SIZE]}
+        query = {'user.screen_name': {'$in': list(batch_users.keys())}}
+        projection = {'_id': 0, 'user.screen_name': 1, 'complete_text': 1}
+        sort = [{'key': 'user.screen_name', 'direction': pymongo.ASCENDING}]
+        tweets = dbm_tweets.find_all(query, projection, sort)
+        main_langs = {}
+        for screen_name, user_tweets in groupby(tweets, 
+                                                key=lambda t: t['user']['screen_name']):
+            texts = [tweet['complete_text'] for tweet in user_tweets 
+                     if 'complete_text' in tweet]
+            logging.info('Found {} tweets of the user {}'.format(len(texts), screen_name))
             lang_detection = defaultdict(int)
-            for tweet in tweets:
-                tweet_text = tweet['complete_text']
-                lang_detected = detect_language(tweet_text)
-                lang_detection[lang_detected['pref_lang']] += 1
-            lang_detection = sorted(lang_detection.items(), key=lambda x: x[1], reverse=True)
-            main_lang = lang_detection[0][0]
-        else:
-            main_lang = user['lang_description']
-        logging.info('The user {0} speaks primarily {1}'.format(user['screen_name'], main_lang))
-        update_queries.append(
-            {
-                'filter': {'id_str': user['id_str']},
-                'new_values': {'lang_detected': main_lang}
-            }
-        )
-        if len(update_queries) >= max_batch:
+            for lang_detected in detect_language_batch(texts):
+                if lang_detected:
+                    lang_detection[lang_detected['pref_lang']] += 1
+            if len(lang_detection) > 0:
+                lang_detection = sorted(lang_detection.items(), key=lambda x: x[1], 
+                                        reverse=True)
+                main_langs[screen_name] = lang_detection[0][0]
+        update_queries = []
+        for screen_name, user in batch_users.items():
+            processing_counter += 1
+            main_lang = main_langs.get(screen_name, user['lang_description'])
+            logging.info('[{0}/{1}] The user {2} speaks primarily {3}'.\
+                         format(processing_counter, total_users, screen_name, 
+                                main_lang))
+            update_queries.append(
+                {
+                    'filter': {'id_str': user['id_str']},
+                    'new_values': {'lang_detected': main_lang}
+                }
+            )
+        if len(update_queries) > 0:
             add_fields(dbm_users, update_queries)
-            update_queries = []
-    if len(update_queries) >= max_batch:
-        add_fields(dbm_users, update_queries)
 
 
 def remove_users_without_tweets(users_collection, tweets_collection, 
@@ -2069,45 +2477,57 @@ def remove_users_without_tweets(users_collection, tweets_collection,
     dbm_users = DBManager(collection=users_collection, config_fn=config_fn)
     dbm_tweets = DBManager(collection=tweets_collection, config_fn=config_fn)
     dbm_old_tweets = DBManager(collection=old_tweets_collection, config_fn=config_fn)
-    query = {}
-    projection = {
-        '_id': 0,
-        'id_str': 1,
-        'screen_name': 1,
-        'comunidad_autonoma': 1
-    }
-    logging.info('Getting users...')
-    users = list(dbm_users.find_all(query, projection))
+    dbm_tweets.create_index('user.screen_name', 'asc')
+    # anti-join users and tweets, looking up at most one tweet per user
+    pipeline = [
+        {'$project': {
+            '_id': 0,
+            'id_str': 1,
+            'screen_name': 1,
+            'comunidad_autonoma': 1
+        }},
+        {'$lookup': {
+            'from': tweets_collection,
+            'let': {'screen_name': '$screen_name'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$user.screen_name', '$$screen_name']}}},
+                {'$limit': 1},
+                {'$project': {'_id': 1}}
+            ],
+            'as': 'tweets'
+        }},
+        {'$match': {'tweets': {'$size': 0}}},
+        {'$project': {'tweets': 0}}
+    ]
+    logging.info('Getting users without tweets...')
+    users = dbm_users.aggregate(pipeline)
     total_users = len(users)
+    logging.info('Found {:,} users without tweets in the current db'.format(total_users))
     processing_counter = 0
-    removed_users = 0
+    users_to_remove = []
     for user in users:
         processing_counter += 1
         logging.info('[{}/{}] Processing user: {}'.format(processing_counter, \
                      total_users, user['screen_name']))
-        # get tweets of user
-        query = {'user.screen_name': user['screen_name']}
-        projection = {'_id': 0, 'id': 1}
-        tweets = list(dbm_tweets.find_all(query, projection))
-        total_tweets = len(tweets)
-        if total_tweets == 0:
-            logging.info('The user {} does not have tweets in the current db'.\
-                         format(user['screen_name']))
-            if user['comunidad_autonoma'] != 'desconocido':
-                logging.info('However, he/she has assigned an autonomous '\
-                            'community, so his/her tweets will be copy from '\
-                            'the old database of tweets')                    
-                old_tweets = list(dbm_old_tweets.find_all(query, {}))
+        if user['comunidad_autonoma'] != 'desconocido':
+            logging.info('The user {} has assigned an autonomous community, '\
+                         'so his/her tweets will be copy from the old '\
+                         'database of tweets'.format(user['screen_name']))
+            query = {'user.screen_name': user['screen_name']}
+            old_tweets = list(dbm_old_tweets.find_all(query, {}))
+            if len(old_tweets) > 0:
                 result = dbm_tweets.insert_many(old_tweets)
                 logging.info('It was inserted {} new tweets'.format(len(result.inserted_ids)))
-            else:
-                logging.info('The user will be removed')           
-                dbm_users.remove_record({
-                    'screen_name': user['screen_name']
-                })                
-                removed_users += 1
+        else:
+            users_to_remove.append(user['screen_name'])
+    removed_users = 0
+    for i in range(0, len(users_to_remove), BATCH_SIZE):
+        result = dbm_users.remove_records(
+            {'screen_name': {'$in': users_to_remove[i:i+BATCH_SIZE]}}
+        )
+        removed_users += result.deleted_count
     logging.info('In total {} users were removed because they dont have tweets '\
-                 'in the database')
+                 'in the database'.format(removed_users))
 
 
 def generate_word_embeddings(collection, config_fn=None):
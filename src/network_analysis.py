@@ -1,7 +1,10 @@
 from collections import defaultdict
 from datetime import datetime
 from utils.db_manager import DBManager
+from xml.sax.saxutils import escape, quoteattr
 
+import gzip
+import io
 import logging
 import networkx as net
 import pathlib
@@ -9,14 +12,19 @@ import pathlib
 logging.basicConfig(filename=str(pathlib.Path(__file__).parents[1].joinpath('tw_coronavirus.log')), level=logging.DEBUG)
 
 
+WRITE_BUFFER_SIZE = 2**20
+# number of users whose tweets are looked up in a single query
+SCREEN_NAMES_BATCH_SIZE = 1000
+
+
 class NetworkAnalyzer:
     __dbm_tweets = None
     __dbm_users = None
     __dbm_networks = None
     __network = None
     __graph = None
-    __nodes = set()
-    __unknown_users = set()
+    __nodes = None
+    __unknown_users = None
     __node_sizes = None
 
     def __init__(self, colletion=None):
@@ -25,6 +33,9 @@ class NetworkAnalyzer:
         self.__dbm_users = DBManager('users')
         self.__dbm_networks = DBManager('networks')
         self.__network = []
+        # screen_name -> attributes of the node
+        self.__nodes = {}
+        self.__unknown_users = set()
 
     def __computer_ff_ratio(self, friends, followers):
         if followers > 0 and friends > 0:
@@ -172,56 +183,74 @@ class NetworkAnalyzer:
             progress += 1
             self.__dbm_users.update_record(filter_query, db_user, create_if_doesnt_exist=True)
 
-    def generate_network(self, subnet_query={}, depth=1, file_name='network', override_net=False):
+    def __get_node_attributes(self, user):
+        if 'ff_ratio' in user.keys():
+            ff_ratio = user['ff_ratio']
+        else:
+            ff_ratio = self.__computer_ff_ratio(user['friends'], user['followers'])
+        exists = user['exists'] if 'exists' in user.keys() else ''
+        return {'ff_ratio': ff_ratio, 'exists': exists}
+
+    def __get_users_attributes(self):
+        """
+        Return a dictionary with the node attributes (ff_ratio and exists)
+        of every user in the database, which are read with a single query
+        """
+        projection = {'_id': 0, 'screen_name': 1, 'friends': 1, 'followers': 1,
+                      'ff_ratio': 1, 'exists': 1}
+        users_attrs = {}
+        for user in self.__dbm_users.find_all({}, projection):
+            users_attrs[user['screen_name']] = self.__get_node_attributes(user)
+        return users_attrs
+
+    def generate_network(self, subnet_query={}, depth=1, file_name='network', override_net=False,
+                         network_format='gexf', compress=False):
         net_query = subnet_query.copy()
         net_query.update({'depth': depth})
         ret_net = self.__dbm_networks.search(net_query)
         # the net doesn't exist yet, let's create it
         if ret_net.count() == 0 or override_net:
             logging.info('Generating the network, it can take several minutes, please wait_')
-            users = self.__dbm_users.search(subnet_query)
+            users_attrs = self.__get_users_attributes()
+            logging.info('Loaded the attributes of {0} users'.format(len(users_attrs)))
+            # edges of users that are not in the database, they are resolved
+            # at once after visiting all the users
+            pending_edges = []
+            projection = {'_id': 0, 'screen_name': 1, 'friends': 1, 'followers': 1,
+                          'ff_ratio': 1, 'exists': 1, 'interactions': 1}
+            users = self.__dbm_users.find_all(subnet_query, projection)
             # for each user generate his/her edges
             for user in users:
-                if 'ff_ratio' in user.keys():
-                    u_ff_ratio = user['ff_ratio']
-                else:
-                    u_ff_ratio = self.__computer_ff_ratio(user['friends'], user['followers'])
-                exists = user['exists'] if 'exists' in user.keys() else ''                
-                self.__nodes.add(tuple({'screen_name': user['screen_name'], 
-                                        'ff_ratio': u_ff_ratio,
-                                        'exists': exists}.items()))
+                node_a = {'screen_name': user['screen_name']}
+                node_a.update(self.__get_node_attributes(user))
+                self.__add_node(user['screen_name'], node_a)
                 for interacted_user, interactions in user['interactions'].items():
-                    iuser = self.__dbm_users.find_record({'screen_name': interacted_user})
-                    if not iuser:
-                        if depth > 1:
-                            iuser_ffratio = self.__get_ffratio(interacted_user)
-                            if not iuser_ffratio:
-                                self.__unknown_users.add(interacted_user)
-                                continue
-                        else:
-                            self.__unknown_users.add(interacted_user)
-                            continue
+                    iuser_attrs = users_attrs.get(interacted_user)
+                    if not iuser_attrs:
+                        pending_edges.append((node_a, interacted_user, 
+                                              interactions['total']))
+                        continue
+                    self.__add_edge(node_a, interacted_user, iuser_attrs,
+                                    interactions['total'])
+            if pending_edges:
+                if depth > 1:
+                    ff_ratios = self.__get_ffratios({interacted_user for _, interacted_user, _ 
+                                                     in pending_edges})
+                else:
+                    ff_ratios = {}
+                for node_a, interacted_user, weight in pending_edges:
+                    if interacted_user in ff_ratios:
+                        iuser_attrs = {'ff_ratio': ff_ratios[interacted_user], 'exists': ''}
+                        self.__add_edge(node_a, interacted_user, iuser_attrs, weight)
                     else:
-                        if 'ff_ratio' in iuser.keys():
-                            i_ff_ratio = iuser['ff_ratio']
-                        else:
-                            i_ff_ratio = self.__computer_ff_ratio(iuser['friends'], iuser['followers'])
-                    exists_iuser = iuser['exists'] if 'exists' in iuser.keys() else ''                    
-
-                    self.__nodes.add(tuple({'screen_name': iuser['screen_name'], 
-                                            'ff_ratio': i_ff_ratio}.items()))
-                    edge = {
-                        'nodeA': {'screen_name': user['screen_name'], 'ff_ratio': u_ff_ratio,
-                                  'exists': exists},
-                        'nodeB': {'screen_name': interacted_user, 'ff_ratio': i_ff_ratio,
-                                  'exists': exists_iuser},
-                        'weight': interactions['total']
-                    }
-                    self.__network.append(edge)
+                        self.__unknown_users.add(interacted_user)
             logging.info('Created a network of {0} nodes and {1} edges'.format(len(self.__nodes), len(self.__network)))
             logging.info('Unknown users {0}'.format(len(self.__unknown_users)))
-            # save the net in a gefx file for posterior usage
-            f_name = self.save_network_in_gexf_format(file_name)
+            # save the net in a gefx (or graphml) file for posterior usage
+            if network_format == 'graphml':
+                f_name = self.save_network_in_graphml_format(file_name, compress)
+            else:
+                f_name = self.save_network_in_gexf_format(file_name, compress)
             logging.info('Saved the network in the file {0}'.format(f_name))
             db_net = {'file_name': str(f_name)}
             db_net.update(net_query)
@@ -230,6 +259,22 @@ class NetworkAnalyzer:
             f_net = ret_net[0]
             logging.info('The network was already generated, please find it at {0}'.format(f_net['file_name']))
 
+    def __add_node(self, screen_name, attrs):
+        # keep the exists flag if the user was added before without it
+        if screen_name not in self.__nodes or self.__nodes[screen_name]['exists'] == '':
+            self.__nodes[screen_name] = {'ff_ratio': attrs['ff_ratio'], 
+                                         'exists': attrs['exists']}
+
+    def __add_edge(self, node_a, interacted_user, iuser_attrs, weight):
+        self.__add_node(interacted_user, iuser_attrs)
+        edge = {
+            'nodeA': node_a,
+            'nodeB': {'screen_name': interacted_user, 'ff_ratio': iuser_attrs['ff_ratio'],
+                      'exists': iuser_attrs['exists']},
+            'weight': weight
+        }
+        self.__network.append(edge)
+
     def create_graph(self):
         logging.info('Creating the graph, please wait_')
         self.__graph = net.DiGraph()
@@ -262,34 +307,70 @@ class NetworkAnalyzer:
     def get_node_sizes(self):
         return self.__node_sizes
 
-    def __get_ffratio(self, screen_name):
-        query = {
-            '$or': [
-                {'user.screen_name': screen_name},
-                {'retweeted_status.user.screen_name': screen_name},
-                {'quoted_status.user.screen_name': screen_name}
-            ]
-        }
-        tweet_obj = self.__dbm_tweets.find_record(query)
-        if tweet_obj:
-            tweet = tweet_obj['tweet_obj']
-            if 'retweeted_status' in tweet.keys():
-                return self.__computer_ff_ratio(tweet['retweeted_status']['user']['friends_count'],
-                                                tweet['retweeted_status']['user']['followers_count'])
-            elif 'quoted_status' in tweet.keys():
-                return self.__computer_ff_ratio(tweet['quoted_status']['user']['friends_count'],
-                                                tweet['quoted_status']['user']['followers_count'])
-            else:
-                return self.__computer_ff_ratio(tweet['user']['friends_count'],
-                                                tweet['user']['followers_count'])
+    def __get_ffratios(self, screen_names):
+        """
+        Compute the ff_ratio of users that are not in the database from the
+        first tweet in which they appear as authors, retweeted or quoted
+        users. Users are looked up in batches through the indexes of their
+        screen names
+        """
+        ff_ratios = {}
+        user_fields = ['user', 'retweeted_status.user', 'quoted_status.user']
+        projection = {'_id': 0}
+        for user_field in user_fields:
+            self.__dbm_tweets.create_index(user_field + '.screen_name', 'asc')
+            for attr in ['screen_name', 'friends_count', 'followers_count']:
+                projection[user_field + '.' + attr] = 1
+        screen_names = sorted(screen_names)
+        for i in range(0, len(screen_names), SCREEN_NAMES_BATCH_SIZE):
+            pending_users = set(screen_names[i:i+SCREEN_NAMES_BATCH_SIZE])
+            query = {'$or': [{user_field + '.screen_name': {'$in': list(pending_users)}}
+                             for user_field in user_fields]}
+            for tweet in self.__dbm_tweets.find_all(query, projection):
+                accounts = [
+                    tweet.get('user'),
+                    tweet.get('retweeted_status', {}).get('user'),
+                    tweet.get('quoted_status', {}).get('user')
+                ]
+                for account in accounts:
+                    if account and account.get('screen_name') in pending_users:
+                        ff_ratios[account['screen_name']] = \
+                            self.__computer_ff_ratio(account['friends_count'],
+                                                     account['followers_count'])
+                        pending_users.remove(account['screen_name'])
+                if not pending_users:
+                    break
+        return ff_ratios
+
+    def __get_network_file_name(self, file_name, extension, compress):
+        today = datetime.strftime(datetime.now(), '%m%d%y')
+        f_dir = pathlib.Path(__file__).parents[1].joinpath('sna', 'gefx')
+        f_dir.mkdir(parents=True, exist_ok=True)
+        f_name = file_name + '_' + today + '.' + extension
+        if compress:
+            f_name += '.gz'
+        return f_dir.joinpath(f_name)
+
+    def __open_network_file(self, f_name, compress):
+        # writes go through a large buffer, so writing a node or an edge
+        # doesn't reach the file (or the compressor) every time
+        if compress:
+            raw_file = gzip.open(str(f_name), 'wb', compresslevel=6)
+            return io.TextIOWrapper(io.BufferedWriter(raw_file, WRITE_BUFFER_SIZE),
+                                    encoding='utf-8')
         else:
-            return None
+            return open(str(f_name), 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
 
-    def save_network_in_gexf_format(self, file_name):
-        today = datetime.strftime(datetime.now(), '%m/%d/%y')
-        f_name = pathlib.Path(__file__).parents[1].joinpath('sna', 'gefx', file_name+'_'+today+'.gexf')
+    def save_network_in_gexf_format(self, file_name, compress=False):
+        """
+        Stream the network to a gexf file, gzip-compressed if requested.
+        Nodes are numbered as they are written, so the endpoints of edges
+        are found in a dictionary and the file is written in linear time
+        """
+        today = datetime.strftime(datetime.now(), '%Y-%m-%d')
+        f_name = self.__get_network_file_name(file_name, 'gexf', compress)
 
-        with open(str(f_name), 'w', encoding='utf-8') as f:
+        with self.__open_network_file(f_name, compress) as f:
             f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
             f.write('<gexf xmlns="http://www.gexf.net/1.2draft" xmlns:viz="http://www.gexf.net/1.1draft/viz" '
                     'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
@@ -307,34 +388,60 @@ class NetworkAnalyzer:
             f.write('</attributes>\n')
             # add nodes
             f.write('<nodes>\n')
-            node_id = 0
-            list_nodes = []
-            for node_tup in self.__nodes:
-                node = dict(node_tup)
-                f.write('<node id="{0}" label="{1}">\n'.format(node_id, node['screen_name']))
-                f.write('<attvalues>\n')
-                f.write('<attvalue for="2" value="{0}"/>\n'.format(node['ff_ratio']))                
-                f.write('</attvalues>\n')
-                #f.write('<viz:size value="{0}"/>\n'.format(node['ff_ratio']))
-                f.write('</node>\n')
-                node_id += 1
-                list_nodes.append(node['screen_name'])
+            node_ids = {}
+            for node_id, (screen_name, node) in enumerate(self.__nodes.items()):
+                node_ids[screen_name] = node_id
+                attvalues = '<attvalue for="2" value="{0}"/>\n'.format(node['ff_ratio'])
+                if node['exists'] != '':
+                    attvalues += '<attvalue for="5" value="{0}"/>\n'.format(node['exists'])
+                f.write('<node id="{0}" label={1}>\n<attvalues>\n{2}</attvalues>\n</node>\n'.\
+                        format(node_id, quoteattr(screen_name), attvalues))
             f.write('</nodes>\n')
             # add edges
             f.write('<edges>\n')
-            edge_id = 0
-            for edge in list(self.__network):
-                id_vertexA = list_nodes.index(edge['nodeA']['screen_name'])
-                id_vertexB = list_nodes.index(edge['nodeB']['screen_name'])
-                weight = edge['weight']
-                f.write('<edge id="{0}" source="{1}" target="{2}" weight="{3}"/>\n'.format(edge_id, id_vertexA,
-                                                                                           id_vertexB, weight))
-                edge_id += 1
+            for edge_id, edge in enumerate(self.__network):
+                f.write('<edge id="{0}" source="{1}" target="{2}" weight="{3}"/>\n'.\
+                        format(edge_id, node_ids[edge['nodeA']['screen_name']],
+                               node_ids[edge['nodeB']['screen_name']], edge['weight']))
             f.write('</edges>\n')
             f.write('</graph>\n')
             f.write('</gexf>\n')
         return f_name
 
+    def save_network_in_graphml_format(self, file_name, compress=False):
+        """
+        Stream the network to a graphml file, gzip-compressed if requested
+        """
+        f_name = self.__get_network_file_name(file_name, 'graphml', compress)
+
+        with self.__open_network_file(f_name, compress) as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns" '
+                    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                    'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns '
+                    'http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">\n')
+            f.write('<key id="label" for="node" attr.name="label" attr.type="string"/>\n')
+            f.write('<key id="ff_ratio" for="node" attr.name="ff_ratio" attr.type="double"/>\n')
+            f.write('<key id="exists" for="node" attr.name="exists" attr.type="double"/>\n')
+            f.write('<key id="weight" for="edge" attr.name="weight" attr.type="double"/>\n')
+            f.write('<graph id="{0}" edgedefault="directed">\n'.format(file_name))
+            node_ids = {}
+            for node_id, (screen_name, node) in enumerate(self.__nodes.items()):
+                node_ids[screen_name] = node_id
+                node_data = '<data key="label">{0}</data><data key="ff_ratio">{1}</data>'.\
+                            format(escape(screen_name), node['ff_ratio'])
+                if node['exists'] != '':
+                    node_data += '<data key="exists">{0}</data>'.format(node['exists'])
+                f.write('<node id="n{0}">{1}</node>\n'.format(node_id, node_data))
+            for edge_id, edge in enumerate(self.__network):
+                f.write('<edge id="e{0}" source="n{1}" target="n{2}">'
+                        '<data key="weight">{3}</data></edge>\n'.\
+                        format(edge_id, node_ids[edge['nodeA']['screen_name']],
+                               node_ids[edge['nodeB']['screen_name']], edge['weight']))
+            f.write('</graph>\n')
+            f.write('</graphml>\n')
+        return f_name
+
 if __name__ == "__main__":
 
     na = NetworkAnalyzer('tweets')
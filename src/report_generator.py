@@ -2,13 +2,34 @@ from palettable.colorbrewer.sequential import Blues_4_r
 from utils.db_manager import DBManager
 from utils.figure_maker import lineplot, bars_by_date, donut, hlines, heatmap, \
                                barplot
-
+from utils.hyperloglog import HyperLogLog
+from utils.tweet_expressions import THRESHOLD_SA, get_tweet_type_expression, \
+                                    get_sentiment_label_expression, \
+                                    get_hour_expression, get_sentiment_accumulators
+
+import hashlib
+import inspect
+import json
+import logging
+import matplotlib.pyplot as plt
 import os
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
+
+from functools import partial
+from multiprocessing import Pool
 
 
-THRESHOLD_SA = {'low': -0.1, 'high': 0.1}
+FIGURES_MANIFEST = 'figures_manifest.json'
+# part of the hash of every figure, increase it when the figures change in
+# ways not seen in the source of the analysis functions (e.g. figure_maker)
+FIGURES_VERSION = 1
+LANGUAGES_NO_TO_AGGREGATE = ['es', 'ca', 'eu', 'gl', 'en', 'pt', 'fr', 'it']
+# indexed by dayofweek (monday=0)
+SPANISH_WEEKDAYS = np.array(['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 
+                             'Sábado', 'Domingo'], dtype=object)
+TWEET_TYPES = {'rt': 'retweet', 'og': 'original', 'qt': 'quote', 'rp': 'reply'}
 # colors
 BLUE_HC = '#3778BF'
 LIGHT_BLUE_INT1_HC = '#539DCC'
@@ -24,9 +45,41 @@ Y_TICKS_SIZE = 13
 
 
 
-def get_data(fields_to_retrieve, collection, config_fn, dataset_filename, filter_query=None):
-    if dataset_filename and os.path.isfile(dataset_filename):
-        df = pd.read_csv(dataset_filename)    
+def read_parquet_dataset(dataset_path, columns=None, start_date=None, 
+                         end_date=None):
+    """
+    Read a Parquet dataset, or a single Parquet file, exported with 
+    export-parquet. Only the given columns are read and, in partitioned 
+    datasets, only the partitions between start_date and end_date
+    """
+    filters = []
+    if start_date:
+        filters.append(('created_at_date', '>=', start_date))
+    if end_date:
+        filters.append(('created_at_date', '<=', end_date))
+    if os.path.isdir(dataset_path):
+        table = pq.read_table(dataset_path, columns=columns, 
+                              filters=filters if filters else None)
+        df = table.to_pandas()
+        if 'date' in df.columns and 'created_at_date' in df.columns:
+            df = df.drop(columns=['created_at_date'])
+    else:
+        df = pq.read_table(dataset_path, columns=columns).to_pandas()
+        if 'date' in df.columns:
+            if start_date:
+                df = df[df['date'] >= pd.to_datetime(start_date).date()]
+            if end_date:
+                df = df[df['date'] <= pd.to_datetime(end_date).date()]
+    return df
+
+
+def get_data(fields_to_retrieve, collection, config_fn, dataset_filename, 
+             filter_query=None, columns=None, start_date=None, end_date=None):
+    if dataset_filename and (os.path.isdir(dataset_filename) or \
+       (dataset_filename.endswith('.parquet') and os.path.isfile(dataset_filename))):
+        df = read_parquet_dataset(dataset_filename, columns, start_date, end_date)
+    elif dataset_filename and os.path.isfile(dataset_filename):
+        df = pd.read_csv(dataset_filename, usecols=columns)    
     else:
         config_fn = 'config_mongo_inb.json'
         collection = 'rc_all'
@@ -41,6 +94,172 @@ def get_data(fields_to_retrieve, collection, config_fn, dataset_filename, filter
     return df
 
 
+def get_aggregated_data(collection, config_fn, filter_query=None):
+    """
+    Compute in the database the tables used by the report, so only 
+    aggregated rows are transferred:
+     - date_hour_type: number of tweets by date, hour and type
+     - date_ccaa: number of tweets by date and autonomous community
+     - date_hour_sentiment: number of tweets, sum and number of sentiment 
+       scores by date, hour and sentiment label
+     - users_date: number of unique users by date
+    and the total number of unique users
+    """
+    dbm = DBManager(collection=collection, config_fn=config_fn)
+    match = [{'$match': filter_query}] if filter_query else []
+    hour = get_hour_expression()
+    pipelines = {
+        'date_hour_type': [
+            {'$group': {
+                '_id': {'date': '$created_at_date', 'hour': hour, 
+                        'type': get_tweet_type_expression()},
+                'count': {'$sum': 1}
+            }}
+        ],
+        'date_ccaa': [
+            {'$group': {
+                '_id': {'date': '$created_at_date', 
+                        'comunidad_autonoma': {'$ifNull': ['$comunidad_autonoma', 
+                                                           'desconocido']}},
+                'count': {'$sum': 1}
+            }}
+        ],
+        'date_hour_sentiment': [
+            {'$group': dict(
+                {'_id': {'date': '$created_at_date', 'hour': hour, 
+                         'sentiment_label': get_sentiment_label_expression()}},
+                **get_sentiment_accumulators()
+            )}
+        ],
+        'users_date': [
+            {'$group': {
+                '_id': {'date': '$created_at_date', 'user': '$user.screen_name'}
+            }},
+            {'$group': {
+                '_id': {'date': '$_id.date'},
+                'unique_users': {'$sum': 1}
+            }}
+        ]
+    }
+    tables = {}
+    for table_name, pipeline in pipelines.items():
+        rows = []
+        for doc in dbm.aggregate(match + pipeline):
+            row = doc['_id']
+            del doc['_id']
+            row.update(doc)
+            rows.append(row)
+        tables[table_name] = pd.DataFrame(rows)
+    total_users = dbm.aggregate(match + [
+        {'$group': {'_id': '$user.screen_name'}},
+        {'$count': 'total'}
+    ])
+    tables['total_users'] = total_users[0]['total'] if total_users else 0
+    return tables
+
+
+def get_daily_stats_data(collection, config_fn, stats_collection='daily_stats',
+                         start_date=None, end_date=None):
+    """
+    Read the tables of get_aggregated_data from the daily rollup of the
+    collection maintained by update-daily-stats, so no tweet is counted
+    again. Unique users by date and the total of unique users are
+    estimates of the HyperLogLog sketches of the rollup
+    """
+    dbm_stats = DBManager(collection=stats_collection, config_fn=config_fn)
+    query = {'collection': collection}
+    if start_date or end_date:
+        query['date'] = {}
+        if start_date:
+            query['date']['$gte'] = start_date
+        if end_date:
+            query['date']['$lte'] = end_date
+    rows = {'date_hour_type': [], 'date_ccaa': [], 'date_hour_sentiment': [],
+            'users_date': []}
+    users_hll = HyperLogLog()
+    for stats in dbm_stats.find_all(query, {'_id': 0}):
+        if 'by_hour_type' not in stats:
+            raise Exception('The daily stats of {0} do not have hourly counts, '\
+                            'run update-daily-stats with --rebuild'.format(collection))
+        date = stats['date']
+        rows['date_hour_type'].extend([dict(row, date=date) 
+                                       for row in stats['by_hour_type']])
+        rows['date_hour_sentiment'].extend([dict(row, date=date) 
+                                            for row in stats['by_hour_sentiment']])
+        rows['date_ccaa'].extend([{'date': date, 'comunidad_autonoma': ccaa, 
+                                   'count': count}
+                                  for ccaa, count in stats['by_ccaa'].items()])
+        rows['users_date'].append({'date': date, 
+                                   'unique_users': stats['unique_users']})
+        users_hll.merge(HyperLogLog.from_bytes(stats['users_hll']))
+    if not rows['users_date']:
+        raise Exception('There are no daily stats of the collection {}, '\
+                        'run update-daily-stats first'.format(collection))
+    tables = {table_name: pd.DataFrame(table_rows) 
+              for table_name, table_rows in rows.items()}
+    tables['total_users'] = users_hll.count()
+    return tables
+
+
+def aggregate_tweets(df):
+    """
+    Compute the tables of get_aggregated_data from a table of tweets 
+    pre-processed with pre_process_data, so the figures are rendered from
+    the same small tables whatever the source of the tweets
+    """
+    scores = pd.to_numeric(df['sentiment_score'])
+    tweets = pd.DataFrame({
+        'date': df['date'],
+        'hour': df['hour'],
+        'type': df['type'].astype(object),
+        'comunidad_autonoma': df['comunidad_autonoma'].astype(object).\
+                              fillna('desconocido'),
+        'sentiment_label': np.where(scores > THRESHOLD_SA['high'], 'positivo',
+                                    np.where(scores < THRESHOLD_SA['low'], 
+                                             'negativo', 'neutral')),
+        'sentiment_score': scores
+    })
+    tables = {
+        'date_hour_type': tweets.groupby(['date', 'hour', 'type']).size().\
+                          reset_index(name='count'),
+        'date_ccaa': tweets.groupby(['date', 'comunidad_autonoma']).size().\
+                     reset_index(name='count'),
+        'date_hour_sentiment': tweets.groupby(['date', 'hour', 'sentiment_label']).\
+            agg(count=('sentiment_score', 'size'), 
+                sentiment_sum=('sentiment_score', 'sum'),
+                sentiment_count=('sentiment_score', 'count')).reset_index(),
+        'users_date': df.groupby('date')['user_screen_name'].nunique().\
+                      reset_index(name='unique_users'),
+        'total_users': df['user_screen_name'].nunique()
+    }
+    return tables
+
+
+def pre_process_aggregated_data(tables):
+    for table_name in ['date_hour_type', 'date_ccaa', 'date_hour_sentiment', 
+                       'users_date']:
+        df = tables[table_name]
+        df['date'] = pd.to_datetime(df['date']).dt.date
+        if 'hour' in df.columns:
+            days = pd.to_datetime(df['date'])
+            df['day_week'] = SPANISH_WEEKDAYS[days.dt.dayofweek] + ' ' + \
+                             days.dt.strftime('%d-%m-%Y')
+            df['hour'] = df['hour'].astype('int8')
+    return tables
+
+
+def count_tweets(df, group_by):
+    """
+    Count the tweets of every group of df, which can be a table of tweets
+    or a table of aggregated counts (column count). The number of tweets
+    is returned in the column id
+    """
+    if 'count' in df.columns:
+        return df.groupby(group_by, as_index=False, observed=True)['count'].sum().\
+            rename(columns={'count': 'id'})
+    return df.groupby(group_by, as_index=False, observed=True)['id'].count()
+
+
 def create_dirs(img_path, data_path):
     if not os.path.exists(img_path):
         os.mkdir(img_path)
@@ -80,24 +299,33 @@ def pre_process_data(df):
         df['date'] = pd.to_datetime(df['date']).dt.date
     
     if 'date_hour' not in df_columns:
-        df['date_hour'] = df['created_at'].dt.strftime('%Y-%m-%d %H')
+        # format only the distinct hours
+        codes, hours = pd.factorize(df['created_at'].dt.floor('H'))
+        df['date_hour'] = pd.Categorical.from_codes(codes, hours.strftime('%Y-%m-%d %H'))
     
-    languages_no_to_aggregate = ['es', 'ca', 'eu', 'gl', 'en', 'pt', 'fr', 'it']
-    df['lang_org'] = df['lang']
-    df.loc[~df.lang.isin(languages_no_to_aggregate),'lang'] = 'otro'
+    langs = df['lang'].astype(object)
+    df['lang_org'] = langs.astype('category')
+    df['lang'] = langs.where(langs.isin(LANGUAGES_NO_TO_AGGREGATE), 'otro').\
+                 astype('category')
+
+    if 'day_week' not in df_columns:
+        codes, days = pd.factorize(df['created_at'].dt.normalize())
+        day_names = SPANISH_WEEKDAYS[days.dayofweek] + ' ' + days.strftime('%d-%m-%Y')
+        df['day_week'] = pd.Categorical.from_codes(codes, day_names)
+    else:
+        day_weeks = df['day_week'].unique()
+        df['day_week'] = df['day_week'].map(
+            dict(zip(day_weeks, map(put_name_week_day_in_spanish, day_weeks)))
+        ).astype('category')
 
-    if 'day_week' not in list(df_columns):
-        df['day_week'] = df['created_at'].dt.strftime('%A %d-%m-%Y')
-    
-    df.loc[:,'day_week'] = df.loc[:,'day_week'].apply(put_name_week_day_in_spanish)
+    if 'hour' not in df_columns:
+        df['hour'] = df['created_at'].dt.hour.astype('int8')
 
-    if 'hour' not in list(df_columns):
-        df['hour'] = df['created_at'].dt.strftime('%H')    
+    df['type'] = df['type'].replace(TWEET_TYPES).astype('category')
 
-    df.loc[df['type']=='rt', 'type'] = 'retweet'
-    df.loc[df['type']=='og', 'type'] = 'original'
-    df.loc[df['type']=='qt', 'type'] = 'quote'
-    df.loc[df['type']=='rp', 'type'] = 'reply'
+    for column in ['comunidad_autonoma', 'provincia']:
+        if column in df_columns:
+            df[column] = df[column].astype('category')
 
     return df
 
@@ -110,21 +338,32 @@ def save_figure(fig_obj, img_path, file_name, dpi=200, quality=95,
 
 def sentiment_analysis(df, img_path, save_fig_in_file=True):
     figures = []
-    sa_df = df[['id', 'date', 'sentiment_score']].copy()
-    sa_df.loc[:, 'sentiment_score'] = pd.to_numeric(sa_df.loc[:, 'sentiment_score'])
-    # Compute category sentiment category
-    sa_df.loc[:, 'sentiment_label'] = np.where(
-        sa_df.loc[:, 'sentiment_score'] > THRESHOLD_SA['high'], 'positivo', 
-        np.where(sa_df.loc[:, 'sentiment_score'] < THRESHOLD_SA['low'], 
-        'negativo', 'neutral')
-    )
+    if 'count' in df.columns:
+        # aggregated data, the label is computed in the database
+        sa_df = df
+        scores_by_date = df.groupby('date', as_index=False)\
+            [['sentiment_sum', 'sentiment_count']].sum()
+        scores_by_date['sentiment_score'] = scores_by_date['sentiment_sum'] / \
+                                            scores_by_date['sentiment_count']
+        total_tweets = df['count'].sum()
+    else:
+        sa_df = df[['id', 'date', 'sentiment_score']].copy()
+        sa_df.loc[:, 'sentiment_score'] = pd.to_numeric(sa_df.loc[:, 'sentiment_score'])
+        # Compute category sentiment category
+        sa_df.loc[:, 'sentiment_label'] = np.where(
+            sa_df.loc[:, 'sentiment_score'] > THRESHOLD_SA['high'], 'positivo', 
+            np.where(sa_df.loc[:, 'sentiment_score'] < THRESHOLD_SA['low'], 
+            'negativo', 'neutral')
+        )
+        scores_by_date = sa_df
+        total_tweets = sa_df.shape[0]
     # 1. Evolution of sentiment scores over time
     aesthetic_params = {
         'color': BLUE_HC,
         'marker': 'o',
         'linewidth': 0.5
     }
-    fig = lineplot(sa_df, 'date', 'sentiment_score', 'Fecha', 'Score Sentimiento',
+    fig = lineplot(scores_by_date, 'date', 'sentiment_score', 'Fecha', 'Score Sentimiento',
                    X_LABELS_SIZE, Y_LABELS_SIZE, X_TICKS_SIZE, Y_TICKS_SIZE, 90, 
                    aesthetic_params)
     figures.append(fig)
@@ -132,8 +371,8 @@ def sentiment_analysis(df, img_path, save_fig_in_file=True):
         save_figure(fig.get_figure(), img_path, 'tweets_sentiment_score_evolution.png')
         
     # 2. Evolution of sentiment categories over time (line)
-    tweets_by_group = sa_df.groupby(['date', 'sentiment_label'], as_index=False)\
-        ['id'].count().sort_values('date', ascending=True)
+    tweets_by_group = count_tweets(sa_df, ['date', 'sentiment_label']).\
+        sort_values('date', ascending=True)
     tweets_by_group.rename(
         columns={'id': 'id', 'sentiment_label': 'Sentimiento'}, 
         inplace=True
@@ -177,9 +416,9 @@ def sentiment_analysis(df, img_path, save_fig_in_file=True):
         save_figure(fig, img_path, 'tweets_sentiment_category_evolution_bars.png')        
 
     # 4. Distribution of sentiment categories
-    dist_sentiments = sa_df.groupby('sentiment_label', as_index=False).size().\
-        to_frame(name='count').reset_index()
-    dist_sentiments['prop'] = dist_sentiments['count']/sa_df.shape[0]
+    dist_sentiments = count_tweets(sa_df, 'sentiment_label').\
+        rename(columns={'id': 'count'})
+    dist_sentiments['prop'] = dist_sentiments['count']/total_tweets
     neutral = round(dist_sentiments.loc[dist_sentiments['sentiment_label']=='neutral','prop'].values[0]*100,1)
     positive = round(dist_sentiments.loc[dist_sentiments['sentiment_label']=='positivo','prop'].values[0]*100,1)
     negative = round(dist_sentiments.loc[dist_sentiments['sentiment_label']=='negativo','prop'].values[0]*100,1)
@@ -203,7 +442,7 @@ def sentiment_analysis(df, img_path, save_fig_in_file=True):
 
 
 def ccaa_analysis(df, remove_unknown_locations, img_path, save_fig_in_file=True):
-    tweets_by_group = df.groupby('comunidad_autonoma', as_index=False)['id'].count().sort_values('id', ascending=True)
+    tweets_by_group = count_tweets(df, 'comunidad_autonoma').sort_values('id', ascending=True)
     if remove_unknown_locations:
         indexes_to_drop = tweets_by_group[tweets_by_group['comunidad_autonoma']=='desconocido'].index
         tweets_by_group = tweets_by_group.drop(indexes_to_drop)
@@ -218,7 +457,7 @@ def ccaa_analysis(df, remove_unknown_locations, img_path, save_fig_in_file=True)
 
 
 def tweet_types_analysis(df, img_path, save_fig_in_file=True):
-    tweets_by_type = df.groupby('type', as_index=False)['id'].count().sort_values('id', ascending=False)
+    tweets_by_type = count_tweets(df, 'type').sort_values('id', ascending=False)
     tweets_by_type.loc[tweets_by_type['type']=='retweet', 'type'] = 'Retweets'
     tweets_by_type.loc[tweets_by_type['type']=='original', 'type'] = 'Originales'
     tweets_by_type.loc[tweets_by_type['type']=='quote', 'type'] = 'Citas'
@@ -255,7 +494,7 @@ def tweet_types_analysis(df, img_path, save_fig_in_file=True):
 
 
 def tweets_over_time_analysis(df, img_path, save_fig_in_file=True):
-    tweets_by_date = df.groupby(['date', 'type'], as_index=False)['id'].count().\
+    tweets_by_date = count_tweets(df, ['date', 'type']).\
                         sort_values('date', ascending=True)
     tweets_by_date.loc[tweets_by_date['type']=='retweet', 'type'] = 'Retweet'
     tweets_by_date.loc[tweets_by_date['type']=='original', 'type'] = 'Original'
@@ -280,8 +519,8 @@ def tweets_over_time_analysis(df, img_path, save_fig_in_file=True):
 
 def tweets_by_weekday_and_time_analysis(df, weekday_order, img_path, 
                                         save_fig_in_file=True):
-    tweets_by_day_hour = df.groupby(['day_week','hour'], as_index=False)['id'].\
-        count().sort_values('day_week', ascending=True)
+    tweets_by_day_hour = count_tweets(df, ['day_week','hour']).\
+        sort_values('day_week', ascending=True)
     tweets_by_day_hour.rename(columns={'id': 'total'}, inplace=True)
     tweets_by_day_hour = tweets_by_day_hour.pivot('day_week','hour','total')
     reindex_order = [None]*7
@@ -300,8 +539,15 @@ def tweets_by_weekday_and_time_analysis(df, weekday_order, img_path,
 def tweets_sentiment_categories_by_weekday_and_time_analysis(df, weekday_order, 
                                                              img_path, 
                                                              save_fig_in_file=True):
-    sentiments_by_day_hour = df.groupby(['day_week','hour'])['sentiment_score'].\
-        mean().reset_index().sort_values('day_week', ascending=True)
+    if 'count' in df.columns:
+        sentiments_by_day_hour = df.groupby(['day_week','hour'], as_index=False)\
+            [['sentiment_sum', 'sentiment_count']].sum()
+        sentiments_by_day_hour['sentiment_score'] = \
+            sentiments_by_day_hour['sentiment_sum'] / sentiments_by_day_hour['sentiment_count']
+        sentiments_by_day_hour = sentiments_by_day_hour.sort_values('day_week', ascending=True)
+    else:
+        sentiments_by_day_hour = df.groupby(['day_week','hour'], observed=True)\
+            ['sentiment_score'].mean().reset_index().sort_values('day_week', ascending=True)
     sentiments_by_day_hour = sentiments_by_day_hour.pivot('day_week','hour',
                                                           'sentiment_score')
     reindex_order = [None]*7
@@ -314,14 +560,17 @@ def tweets_sentiment_categories_by_weekday_and_time_analysis(df, weekday_order,
                   Y_LABELS_SIZE, X_TICKS_SIZE, Y_TICKS_SIZE, 0.5, 'RdBu', 
                   {'vmin': -0.09, 'vmax': 0.01})
     if save_fig_in_file:
-        save_figure(fig.get_figure(), img_path, 'tweets_weekday_hours.png')
+        save_figure(fig.get_figure(), img_path, 'tweets_sentiment_weekday_hours.png')
     return [fig]
 
 
 def unique_users_over_time_analysis(df, img_path, save_fig_in_file=True):
-    users_by_date = df.groupby(['date'])['user_screen_name'].nunique().\
-        reset_index().sort_values('date', ascending=True)
-    users_by_date.rename(columns={'user_screen_name': 'unique_users'}, inplace=True)
+    if 'unique_users' in df.columns:
+        users_by_date = df.sort_values('date', ascending=True)
+    else:
+        users_by_date = df.groupby(['date'])['user_screen_name'].nunique().\
+            reset_index().sort_values('date', ascending=True)
+        users_by_date.rename(columns={'user_screen_name': 'unique_users'}, inplace=True)
     fig = barplot(users_by_date, 'date', 'unique_users', 'Fecha', 'Usuarios Únicos', 
                   X_LABELS_SIZE, Y_LABELS_SIZE, X_TICKS_SIZE, Y_TICKS_SIZE, 90, BLUE_HC)
     if save_fig_in_file:
@@ -329,41 +578,137 @@ def unique_users_over_time_analysis(df, img_path, save_fig_in_file=True):
     return [fig]
 
 
+def compute_retweet_impact(ri_df):
+    ri_df['retweet_impact'] = ri_df['retweeted_tweets'] * np.log(ri_df['retweeting_users'])
+    ri_df = ri_df.sort_values(by=['retweet_impact'],ascending=False)
+    ri_df['retweet_impact'] = np.log10(ri_df['retweet_impact'])
+    ri_df = ri_df.replace([np.inf, -np.inf], np.nan).dropna()
+    return ri_df
+
+
 def retweet_impact_analysis(collection, config_fn):
+    """
+    Compute the retweet impact of the retweeted users. The number of 
+    distinct retweeted tweets and retweeting users of every user is 
+    computed in the database with two $group stages: the first one finds
+    the distinct pairs (retweeted user, tweet or retweeting user) and the
+    second one counts them. Groups never hold arrays of values, so they 
+    can spill to disk
+    """
     dbm = DBManager(collection=collection, config_fn=config_fn)
     filter_query = {
         'retweeted_status': {'$exists': 1}, # it must be a retweet
         'in_reply_to_status_id_str': {'$eq': None}, # it must not be a reply
         'is_quote_status': False # it must not be a quote
     }
-    fields_to_retrieve = {
-        '_id': 0,
-        'user.screen_name': 1,
-        'retweeted_status.id': 1,
-        'retweeted_status.user.screen_name': 1
+    counts = {
+        'retweeted_tweets': '$retweeted_status.id',
+        'retweeting_users': '$user.screen_name'
     }
-    tweets = list(dbm.find_all(filter_query, fields_to_retrieve))
-    df = pd.DataFrame()
-    for tweet in tweets:
-        df = df.append({
-            'user_screen_name': tweet['user']['screen_name'],
-            'retweeted_status_id': tweet['retweeted_status']['id'],
-            'retweeted_status_user_screen_name': tweet['retweeted_status']['user']['screen_name'],
-        }, ignore_index=True)
-
-    d_retweeted_tweets = df.groupby(['retweeted_status_user_screen_name'])['retweeted_status_id'].nunique().to_dict()
-    d_retweeting_users = df.groupby(['retweeted_status_user_screen_name'])['user_screen_name'].nunique().to_dict()
-
-    ri_df = pd.DataFrame()
-    ri_df['retweeted_user_screen_name'] = df['retweeted_status_user_screen_name']
-    ri_df['retweeted_tweets'] = df.retweeted_status_user_screen_name.map(d_retweeted_tweets)
-    ri_df['retweeting_users'] = df.retweeted_status_user_screen_name.map(d_retweeting_users)
-    ri_df['retweet_impact'] = ri_df['retweeted_tweets'] * np.log(ri_df['retweeting_users'])
-    ri_df = ri_df.sort_values(by=['retweet_impact'],ascending=False).drop_duplicates()
-    ri_df['retweet_impact'] = np.log10(ri_df['retweet_impact'])
-    ri_df = ri_df.replace([np.inf, -np.inf], np.nan).dropna()
-    
-    return ri_df
+    ri_df = None
+    for count_name, value in counts.items():
+        pipeline = [
+            {'$match': filter_query},
+            {'$group': {
+                '_id': {'user': '$retweeted_status.user.screen_name', 'value': value}
+            }},
+            {'$group': {
+                '_id': '$_id.user',
+                count_name: {'$sum': 1}
+            }},
+            {'$project': {
+                '_id': 0,
+                'retweeted_user_screen_name': '$_id',
+                count_name: 1
+            }}
+        ]
+        count_df = pd.DataFrame(dbm.aggregate(pipeline), 
+                                columns=['retweeted_user_screen_name', count_name])
+        if ri_df is None:
+            ri_df = count_df
+        else:
+            ri_df = ri_df.merge(count_df, on='retweeted_user_screen_name')
+    return compute_retweet_impact(ri_df)
+
+
+def init_figure_worker():
+    # figures are only saved into files
+    plt.switch_backend('Agg')
+
+
+def render_figure(task, img_path):
+    task['fn'](*task['args'], img_path=img_path, save_fig_in_file=True)
+    plt.close('all')
+    return task['name']
+
+
+def get_frame_hash(df):
+    frame_hash = hashlib.sha256(','.join(map(str, df.columns)).encode('utf-8'))
+    frame_hash.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return frame_hash.hexdigest()
+
+
+def get_figure_hash(task, frame_hashes=None):
+    """
+    Hash of the version of the figures, the source of the function, the 
+    input data and the parameters of a figure. The hashes of the data 
+    frames are kept in frame_hashes, so a frame shared by several figures
+    is hashed once
+    """
+    if frame_hashes is None:
+        frame_hashes = {}
+    figure_hash = hashlib.sha256(str(FIGURES_VERSION).encode('utf-8'))
+    figure_hash.update(inspect.getsource(task['fn']).encode('utf-8'))
+    for arg in task['args']:
+        if isinstance(arg, pd.DataFrame):
+            if id(arg) not in frame_hashes:
+                frame_hashes[id(arg)] = get_frame_hash(arg)
+            figure_hash.update(frame_hashes[id(arg)].encode('utf-8'))
+        else:
+            figure_hash.update(repr(arg).encode('utf-8'))
+    return figure_hash.hexdigest()
+
+
+def render_figures(tasks, img_path, workers=4, use_cache=True):
+    """
+    Render the figures of the report in a pool of processes. Every task
+    is a dictionary with the name of the figure, the analysis function, 
+    its arguments (except img_path) and the files that it saves. A 
+    manifest in img_path keeps the hash of the inputs of every figure, 
+    so figures whose inputs didn't change and whose files exist are not
+    rendered again. Return the names of the rendered figures
+    """
+    manifest_fn = os.path.join(img_path, FIGURES_MANIFEST)
+    if os.path.exists(manifest_fn):
+        with open(manifest_fn, 'r') as f:
+            manifest = json.load(f)
+    else:
+        manifest = {}
+    pending_tasks, task_hashes, frame_hashes = [], {}, {}
+    for task in tasks:
+        task_hashes[task['name']] = get_figure_hash(task, frame_hashes)
+        entry = manifest.get(task['name'])
+        if use_cache and entry and entry['hash'] == task_hashes[task['name']] and \
+           all([os.path.exists(os.path.join(img_path, fn)) for fn in task['files']]):
+            logging.info('Figure {} is up to date'.format(task['name']))
+            continue
+        pending_tasks.append(task)
+    if pending_tasks:
+        with Pool(processes=min(workers, len(pending_tasks)), 
+                  initializer=init_figure_worker) as pool:
+            render_fn = partial(render_figure, img_path=img_path)
+            for task_name in pool.imap_unordered(render_fn, pending_tasks):
+                logging.info('Rendered figure {}'.format(task_name))
+        for task in pending_tasks:
+            manifest[task['name']] = {
+                'hash': task_hashes[task['name']],
+                'files': task['files']
+            }
+        tmp_fn = manifest_fn + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_fn, manifest_fn)
+    return [task['name'] for task in pending_tasks]
 
 
 def generate_html(output_filename, content):
@@ -405,6 +750,13 @@ if __name__ == "__main__":
     img_path = os.path.join(report_dir, 'figures')
     output_filename = os.path.join(report_dir, 'reporte_'+report_name+'.html')
     dataset_file_name = os.path.join(data_path,'dataset_reporte_'+report_name+'.csv')
+    use_aggregated_data = True
+    # read the aggregated tables from the daily rollup (update-daily-stats)
+    use_daily_stats = True
+    parquet_dataset_dir = os.path.join(data_path,'dataset_reporte_'+report_name)
+    if os.path.isdir(parquet_dataset_dir):
+        # dataset exported with export-parquet
+        dataset_file_name = parquet_dataset_dir
     output = {
         'title': 'Reporte Tweets sobre RadarCovid',      
         'analyses': []
@@ -431,15 +783,60 @@ if __name__ == "__main__":
         'favorite_count': 1,
         'type': 1
     }
-    df = get_data(fields_to_retrieve, collection_name, mongo_config_fn, dataset_file_name)
+    if use_aggregated_data:
+        # tables aggregated in the database instead of the tweets
+        if use_daily_stats:
+            tables = get_daily_stats_data(collection_name, mongo_config_fn)
+        else:
+            tables = get_aggregated_data(collection_name, mongo_config_fn)
+        total_tweets = tables['date_hour_type']['count'].sum()
+        total_users = tables['total_users']
+    else:
+        df = get_data(fields_to_retrieve, collection_name, mongo_config_fn, dataset_file_name)
+        total_tweets = df.shape[0]
+        total_users = df.groupby('user_screen_name').ngroups
     output['subtitle'] = 'Período: {0} - {1}<br>Total de tweets: {2:,} - Total usuarios únicos: {3:,}'\
-        .format('14-08-2020', '24-08-2020', df.shape[0], df.groupby('user_screen_name').ngroups)
+        .format('14-08-2020', '24-08-2020', total_tweets, total_users)
     
     print('[2] Pre-processing data...')
-    df = pre_process_data(df)
-
-    print('[3] Analyzing evolution of tweets over time...')
-    tweets_over_time_analysis(df, img_path)
+    if not use_aggregated_data:
+        # the figures are rendered from the tables aggregated from the tweets,
+        # which are smaller to hash and to send to the rendering processes
+        tables = aggregate_tweets(pre_process_data(df))
+        df = None # free some memory
+    tables = pre_process_aggregated_data(tables)
+    types_df = tables['date_hour_type']
+    ccaa_df = tables['date_ccaa']
+    sentiment_df = tables['date_hour_sentiment']
+    users_df = tables['users_date']
+
+    print('[3] Rendering figures...')
+    weekdays_order = ['Martes','Miércoles','Jueves','Viernes','Sábado','Domingo','Lunes']
+    figure_tasks = [
+        {'name': 'tweets_over_time', 'fn': tweets_over_time_analysis, 
+         'args': (types_df,), 'files': ['tweets_types_evolution.png']},
+        {'name': 'tweet_types', 'fn': tweet_types_analysis, 
+         'args': (types_df,), 'files': ['tweets_types_donut.png']},
+        {'name': 'ccaa', 'fn': ccaa_analysis, 
+         'args': (ccaa_df, True), 'files': ['tweets_locations.png']},
+        {'name': 'sentiment', 'fn': sentiment_analysis, 
+         'args': (sentiment_df,), 
+         'files': ['tweets_sentiment_score_evolution.png', 
+                   'tweets_sentiment_category_evolution.png',
+                   'tweets_sentiment_category_evolution_bars.png',
+                   'tweets_sentiment_categories_donut.png']},
+        {'name': 'unique_users', 'fn': unique_users_over_time_analysis, 
+         'args': (users_df,), 'files': ['users_date.png']},
+        {'name': 'weekday_hours', 'fn': tweets_by_weekday_and_time_analysis, 
+         'args': (types_df, weekdays_order), 'files': ['tweets_weekday_hours.png']},
+        {'name': 'sentiment_weekday_hours', 
+         'fn': tweets_sentiment_categories_by_weekday_and_time_analysis, 
+         'args': (sentiment_df, weekdays_order), 
+         'files': ['tweets_sentiment_weekday_hours.png']}
+    ]
+    rendered_figures = render_figures(figure_tasks, img_path)
+    print('Rendered {0} figures, {1} were up to date'.format(
+        len(rendered_figures), len(figure_tasks) - len(rendered_figures)))
     output['analyses'].append(
         {
             'title': 'Distribución de tweets por fecha',
@@ -451,9 +848,6 @@ if __name__ == "__main__":
             }
         }
     )
-
-    print('[4] Analyzing tweet types...')
-    tweet_types_analysis(df, img_path)
     output['analyses'].append(
         {
             'title': 'Distribución de tweets por tipo',
@@ -465,9 +859,6 @@ if __name__ == "__main__":
             }            
         }
     )
-
-    print('[5] Analyzing autonomous communities...')
-    ccaa_analysis(df, True, img_path)
     output['analyses'].append(
         {
             'title': 'Distribución de tweets por Comunidad Autónoma',
@@ -480,9 +871,6 @@ if __name__ == "__main__":
             'comment': 'Tweets con localidad desconocida fueron excluídos del análisis'
         }
     )
-
-    print('[6] Analyzing sentiment of tweets...')
-    sentiment_analysis(df, img_path)
     output['analyses'].append(
         {
             'title': 'Distribución de polaridad de tweets',
@@ -506,20 +894,9 @@ if __name__ == "__main__":
         }
     )    
 
-    print('[7] Analyzing distribution of unique users...')
-    unique_users_over_time_analysis(df, img_path)
-
-    print('[8] Analyzing distribution of tweets by weekday and time...')
-    weekdays_order = ['Martes','Miércoles','Jueves','Viernes','Sábado','Domingo','Lunes']
-    tweets_by_weekday_and_time_analysis(df, weekdays_order, img_path)
-
-    print('[9] Analyzing distribution of tweets sentiment categories by weekday and time...')
-    tweets_sentiment_categories_by_weekday_and_time_analysis(df, weekdays_order, 
-                                                             img_path)
-
-    print('[10] Computing retweet impact...')
+    print('[4] Computing retweet impact...')
     ri_df = retweet_impact_analysis(collection_name, mongo_config_fn)
     ri_df.to_csv(os.path.join(report_dir, 'retweet_impact.csv'), index=None)
 
-    print('[11] Generating output...')
+    print('[5] Generating output...')
     generate_html(output_filename, output)
@@ -6,7 +6,8 @@ import sys
 
 from data_exporter import export_sentiment_sample, \
       save_tweet_sentiment_scores_to_csv, export_user_sample, do_export_users, \
-      export_tweets_to_json
+      export_tweets_to_json, export_tweets_to_parquet, export_tweets_partitioned, \
+      export_dashboard_data
 from data_wrangler import infer_language, add_date_time_field_tweet_objs, \
       check_datasets_intersection, check_performance_language_detection, \
       compute_sentiment_analysis_tweets, identify_duplicates, \
@@ -16,7 +17,8 @@ from data_wrangler import infer_language, add_date_time_field_tweet_objs, \
       do_add_complete_text_flag, do_add_tweet_type_flag, do_update_users_collection, \
       do_update_user_status, do_augment_user_data, compute_user_demographics, \
       compute_user_demographics_from_file, do_create_field_created_at_date, \
-      is_the_total_tweets_above_median
+      is_the_total_tweets_above_median, preprocess_user_pictures, \
+      do_update_daily_stats
 from data_loader import upload_tweet_sentiment, do_collection_merging, \
       do_update_collection, do_tweets_replication, load_user_demographics
 from network_analysis import NetworkAnalyzer
@@ -58,7 +60,11 @@ def create_db_users(tweets_collection_name):
 
 
 @run.command()
-def create_interaction_net():
+@click.option('--network_format', help='Format of the network file', \
+              default='gexf', type=click.Choice(['gexf', 'graphml']))
+@click.option('--compress', help='Compress the network file with gzip', \
+              default=False, is_flag=True)
+def create_interaction_net(network_format, compress):
     """
     Create a network of users interactions
     """
@@ -66,7 +72,7 @@ def create_interaction_net():
     print('Process of creating the network of interactions has started, please check the ' \
           'log for updates...')
     na = NetworkAnalyzer()
-    na.generate_network()
+    na.generate_network(network_format=network_format, compress=compress)
     print('Process has finished, results were stored in the directory sna/gefx.')
 
 
@@ -225,13 +231,19 @@ def add_query_version_flag(collection_name, config_file):
               default=None, is_flag=False)
 @click.option('--date', help='Date for which the analysis should be run', \
               default=None, is_flag=False)
-def update_tweet_metrics(collection_name, source_collection, config_file, date):
+@click.option('--budget', help='Maximum number of tweets to refresh in a run', \
+              default=None, is_flag=False, type=int)
+@click.option('--backfill', help='Add to the refresh queue the tweets refreshed '\
+              'before it existed', default=False, is_flag=True)
+def update_tweet_metrics(collection_name, source_collection, config_file, date,
+                         budget, backfill):
     """
     Update retweet and favorite metrics of tweets
     """
     check_current_directory()
     print('Updating metrics of tweets')
-    update_metric_tweets(collection_name, config_file, source_collection, date)
+    update_metric_tweets(collection_name, config_file, source_collection, date,
+                         daily_budget=budget, backfill=backfill)
 
 
 @run.command()
@@ -340,13 +352,15 @@ def replicate_tweets(source_collection, target_collection, start_date,
               default=None, is_flag=False)
 @click.option('--log_file', help='Name of file to be used in logging messages', \
               default=None, is_flag=False)
-def augment_user_data(collection_name, config_file, log_file):
+@click.option('--workers', help='Number of concurrent downloads of profile pictures', \
+              default=16, is_flag=False, type=int)
+def augment_user_data(collection_name, config_file, log_file, workers):
     """
     Augment users' data
     """
     check_current_directory()
     print('Augmenting users\' data')
-    do_augment_user_data(collection_name, config_file, log_file)
+    do_augment_user_data(collection_name, config_file, log_file, workers)
 
 
 @run.command()
@@ -355,13 +369,21 @@ def augment_user_data(collection_name, config_file, log_file):
               default=None, is_flag=False)
 @click.option('--log_file', help='Name of file to be used in logging messages', \
               default=None, is_flag=False)
-def predict_user_demographics(collection_name, config_file, log_file):
+@click.option('--batch_size', help='Number of users per inference batch', \
+              default=16, is_flag=False, type=int)
+@click.option('--workers', help='Number of workers loading the data of users', \
+              default=4, is_flag=False, type=int)
+@click.option('--threads', help='Number of threads used by torch in the inference', \
+              default=None, is_flag=False, type=int)
+def predict_user_demographics(collection_name, config_file, log_file, batch_size,
+                              workers, threads):
     """
     Predict users' demographics
     """
     check_current_directory()
     print('Predict users\' demographics')
-    compute_user_demographics(collection_name, config_file)
+    compute_user_demographics(collection_name, config_file, batch_size, workers,
+                              threads)
 
 
 @run.command()
@@ -370,13 +392,28 @@ def predict_user_demographics(collection_name, config_file, log_file):
               default=None, is_flag=False)
 @click.option('--output_file', help='Name of file where to save the output', \
               default=None, is_flag=False)
-def export_users(collection_name, config_file, output_file):
+@click.option('--workers', help='Number of processes used to validate the '\
+              'profile pictures', default=4, is_flag=False, type=int)
+def export_users(collection_name, config_file, output_file, workers):
     """
     Export information of users
     """
     check_current_directory()
     print('Exporting users')
-    do_export_users(collection_name, config_file, output_file)
+    do_export_users(collection_name, config_file, output_file, workers)
+
+
+@run.command()
+@click.argument('collection_name') # Name of collections that contain users
+@click.option('--config_file', help='File with Mongo configuration', \
+              default=None, is_flag=False)
+def preprocess_pictures(collection_name, config_file):
+    """
+    Validate and store resized profile pictures of users
+    """
+    check_current_directory()
+    print('Preprocessing profile pictures of users')
+    preprocess_user_pictures(collection_name, config_file)
 
 
 @run.command()
@@ -416,15 +453,103 @@ def update_user_demographics(input_file, collection_name, config_file):
 @click.option('--lang', help='Language of tweets to be exported', default='es', 
               is_flag=False)
 @click.option('--exclude_rts', help='Exclude RTs', default=False, is_flag=True)
+@click.option('--output_format', help='Format of the output file: json or jsonl. '\
+              'By default it is taken from the extension of the file', \
+              default=None, type=click.Choice(['json', 'jsonl']))
+@click.option('--workers', help='Number of processes used to process tweets', \
+              default=1, is_flag=False, type=int)
 def export_tweets(collection_name, output_file, config_file, stemming, 
-                          lang, exclude_rts):
+                          lang, exclude_rts, output_format, workers):
     """
     Export tweets to json
     """
     check_current_directory()
     print('Exporting tweets to json')
     export_tweets_to_json(collection_name, output_file, config_fn=config_file, 
-                          stemming=stemming, lang=lang, exclude_rts=exclude_rts)
+                          stemming=stemming, lang=lang, exclude_rts=exclude_rts,
+                          output_format=output_format, workers=workers)
+
+
+@run.command()
+@click.argument('collection_name') # Name of collections that contain tweets
+@click.argument('output_path') # Directory where the files will be saved
+@click.argument('start_date') # First date to export (format: YYYY-MM-DD)
+@click.argument('end_date') # Last date to export (format: YYYY-MM-DD)
+@click.option('--config_file', help='File with Mongo configuration', \
+              default=None, is_flag=False)
+@click.option('--partition_by', help='Export a file per day or per week', \
+              default='day', type=click.Choice(['day', 'week']))
+@click.option('--workers', help='Number of partitions exported in parallel', \
+              default=4, is_flag=False, type=int)
+@click.option('--output_format', help='Format of the output files', \
+              default='csv', type=click.Choice(['csv', 'json', 'jsonl']))
+@click.option('--stemming', help='Whether stemming should be applied to the text '\
+              'of tweets before exporting them (json and jsonl)', default=False, \
+              is_flag=True)
+@click.option('--lang', help='Language of tweets to be exported (json and jsonl)', \
+              default=None, is_flag=False)
+@click.option('--exclude_rts', help='Exclude RTs (json and jsonl)', default=False, \
+              is_flag=True)
+@click.option('--no_manifest', help='Do not save the manifest of the exported '\
+              'files', default=False, is_flag=True)
+def export_partitioned(collection_name, output_path, start_date, end_date, 
+                       config_file, partition_by, workers, output_format, 
+                       stemming, lang, exclude_rts, no_manifest):
+    """
+    Export tweets to a file per day or per week in parallel
+    """
+    check_current_directory()
+    print('Exporting tweets by {}'.format(partition_by))
+    if output_format == 'csv':
+        json_kwargs = {}
+    else:
+        json_kwargs = {'stemming': stemming, 'lang': lang, 
+                       'exclude_rts': exclude_rts}
+    export_tweets_partitioned(collection_name, output_path, start_date, end_date,
+                              config_fn=config_file, partition_by=partition_by,
+                              workers=workers, output_format=output_format,
+                              save_manifest=not no_manifest, **json_kwargs)
+
+
+@run.command()
+@click.argument('collection_name') # Name of collections that contain tweets
+@click.argument('output_path') # Directory of the parquet dataset
+@click.option('--config_file', help='File with Mongo configuration', \
+              default=None, is_flag=False)
+@click.option('--start_date', help='Export tweets created from this date '\
+              '(format: YYYY-MM-DD)', default=None, is_flag=False)
+@click.option('--end_date', help='Export tweets created until this date '\
+              '(format: YYYY-MM-DD)', default=None, is_flag=False)
+@click.option('--row_group_size', help='Number of rows of the row groups of '\
+              'the parquet files', default=100000, is_flag=False, type=int)
+def export_parquet(collection_name, output_path, config_file, start_date, 
+                   end_date, row_group_size):
+    """
+    Export tweets to a parquet dataset partitioned by date
+    """
+    check_current_directory()
+    print('Exporting tweets to parquet')
+    export_tweets_to_parquet(collection_name, output_path, config_fn=config_file,
+                             start_date=start_date, end_date=end_date,
+                             row_group_size=row_group_size)
+
+
+@run.command()
+@click.argument('dataset_path') # Directory of the parquet dataset
+@click.argument('output_dir') # Directory of the cubes read by the dashboard
+@click.option('--start_date', help='Export tweets created from this date '\
+              '(format: YYYY-MM-DD)', default=None, is_flag=False)
+@click.option('--end_date', help='Export tweets created until this date '\
+              '(format: YYYY-MM-DD)', default=None, is_flag=False)
+def export_dashboard(dataset_path, output_dir, start_date, end_date):
+    """
+    Export the data of the dashboard from a parquet dataset to arrow files
+    """
+    check_current_directory()
+    print('Exporting data of the dashboard')
+    export_dashboard_data(dataset_path, output_dir, start_date=start_date,
+                          end_date=end_date)
+
 
 @run.command()
 @click.argument('collection_name') # Name of collections that contain tweets
@@ -445,8 +570,11 @@ def create_field_created_at_date(collection_name, config_file):
 @click.argument('time_window_in_days') # Number of days that should be considered for the analysis
 @click.option('--config_file', help='File with Mongo configuration', \
               default=None, is_flag=False)
+@click.option('--stats_collection', help='Collection with the daily stats', \
+              default='daily_stats', is_flag=False)
 def compute_median_and_total_tweets(collection_name, reference_date, 
-                                    time_window_in_days, config_file):
+                                    time_window_in_days, config_file, 
+                                    stats_collection):
     """
     Compute whether the total number of tweets in above the median of tweets
     of the last X (time_window_in_days) days
@@ -454,7 +582,31 @@ def compute_median_and_total_tweets(collection_name, reference_date,
     check_current_directory()
     print('Computing median and total tweets')
     is_the_total_tweets_above_median(collection_name, reference_date, 
-                                     time_window_in_days, config_file)
+                                     time_window_in_days, config_file,
+                                     stats_collection)
+
+
+@run.command()
+@click.argument('collection_name') # Name of collections that contain tweets
+@click.option('--config_file', help='File with Mongo configuration', \
+              default=None, is_flag=False)
+@click.option('--stats_collection', help='Collection with the daily stats', \
+              default='daily_stats', is_flag=False)
+@click.option('--date', help='Date to update (format: YYYY-MM-DD), it can be '\
+              'used several times', default=None, multiple=True)
+@click.option('--days_back', help='Number of days before the last day in the '\
+              'stats that are updated again', default=1, is_flag=False, type=int)
+@click.option('--rebuild', help='Compute the stats of all dates', default=False, \
+              is_flag=True)
+def update_daily_stats(collection_name, config_file, stats_collection, date, 
+                       days_back, rebuild):
+    """
+    Update the daily counts of tweets and unique users of the collection
+    """
+    check_current_directory()
+    print('Updating daily stats')
+    do_update_daily_stats(collection_name, config_file, stats_collection, 
+                          dates=list(date), days_back=days_back, rebuild=rebuild)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,25 @@
+import json
+import numpy as np
+import pandas as pd
 import unittest
 import pathlib
 import os
+import shutil
+import tempfile
+import threading
+import time
 
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from PIL import Image
+from urllib.parse import parse_qs
+from utils.dashboard_cubes import CUBE_NAMES, build_cubes, count_users, \
+                                  read_cubes, write_cubes
+from utils.hyperloglog import HyperLogLog
 from utils.location_detector import LocationDetector
+from utils.picture_downloader import ProfilePictureDownloader
+from utils.tweet_hydrator import TweetHydrator
+from utils.utils import get_date_partitions
 
 
 class testDetectorTestCase(unittest.TestCase):
@@ -115,5 +132,241 @@ class testDetectorTestCase(unittest.TestCase):
         ]
         self.__evaluate_test_cases('identify_place_from_location', test_cases)
 
+class FakeLookupHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in of statuses/lookup that returns every requested tweet with an
+    even id, answers 429 to the first request and always reports a tiny
+    quota
+    """
+    requests_by_token = {}
+    throttled = False
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        params = parse_qs(self.rfile.read(length).decode())
+        token = self.headers['Authorization'].split('oauth_token="')[1].split('"')[0]
+        if not FakeLookupHandler.throttled:
+            FakeLookupHandler.throttled = True
+            self.send_response(429)
+            self.send_header('x-rate-limit-reset', '0')
+            self.end_headers()
+            return
+        FakeLookupHandler.requests_by_token[token] = \
+            FakeLookupHandler.requests_by_token.get(token, 0) + 1
+        tweets = [{'id_str': tweet_id, 'retweet_count': 1, 'favorite_count': 2}
+                  for tweet_id in params['id'][0].split(',')
+                  if int(tweet_id) % 2 == 0]
+        time.sleep(0.05)
+        body = json.dumps(tweets).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('x-rate-limit-remaining', '100')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class testTweetHydratorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeLookupHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.lookup_url = 'http://127.0.0.1:{}/lookup.json'.\
+            format(self.server.server_port)
+        self.credentials = [
+            {
+                'consumer_key': 'key', 
+                'consumer_secret': 'secret',
+                'access_token': 'token_{}'.format(i), 
+                'access_token_secret': 'token_secret'
+            } for i in range(3)
+        ]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testhydrate_with_several_tokens(self):
+        tweet_ids = [str(i) for i in range(1, 1001)]
+        hydrated, requested = [], []
+        def process_batch(batch, tweets):
+            requested.extend(batch)
+            hydrated.extend(tweets)
+        hydrator = TweetHydrator(self.credentials, lookup_url=self.lookup_url)
+        stats = hydrator.hydrate(tweet_ids, process_batch)
+        self.assertEqual(sorted(requested), sorted(tweet_ids))
+        self.assertEqual(stats, {'hydrated': 500, 'missing': 500, 'failed': 0})
+        self.assertEqual(len(hydrated), 500)
+        self.assertEqual(sum(FakeLookupHandler.requests_by_token.values()), 10)
+        self.assertGreater(len(FakeLookupHandler.requests_by_token), 1)
+
+
+class FakePictureHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in of the server of profile pictures. Pictures named gone do not
+    exist and the ones named flaky fail the first time they are requested
+    """
+    requests_by_path = {}
+
+    def do_GET(self):
+        num_requests = FakePictureHandler.requests_by_path.get(self.path, 0) + 1
+        FakePictureHandler.requests_by_path[self.path] = num_requests
+        if 'gone' in self.path:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if 'flaky' in self.path and num_requests == 1:
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        img_bytes = BytesIO()
+        Image.new('RGB', (400, 400), (255, 0, 0)).save(img_bytes, format='PNG')
+        body = img_bytes.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class testPictureDownloaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        FakePictureHandler.requests_by_path = {}
+        self.server = HTTPServer(('127.0.0.1', 0), FakePictureHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.users = [
+            {'id_str': str(i), 'profile_image_url_https': 
+             '{}/{}_normal.png'.format(base_url, name)}
+            for i, name in enumerate(['ok', 'gone', 'flaky'])
+        ]
+        self.cache_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_dir.cleanup()
+
+    def testdownload_all(self):
+        downloader = ProfilePictureDownloader(self.cache_dir.name, num_workers=3)
+        results = downloader.download_all(self.users)
+        downloader.close()
+        self.assertEqual(results['0']['status'], 'downloaded')
+        self.assertEqual(results['1']['status'], 'missing')
+        self.assertEqual(results['2']['status'], 'downloaded')
+        self.assertEqual(Image.open(results['0']['img_path']).size, (224, 224))
+        self.assertTrue(results['0']['img_path'].endswith('0_224x224.png'))
+        # permanent errors are not retried, transient ones are
+        self.assertEqual(FakePictureHandler.requests_by_path['/gone_400x400.png'], 1)
+        self.assertEqual(FakePictureHandler.requests_by_path['/flaky_400x400.png'], 2)
+
+    def testskip_downloaded_pictures(self):
+        downloader = ProfilePictureDownloader(self.cache_dir.name)
+        downloader.download_all(self.users)
+        downloader.close()
+        FakePictureHandler.requests_by_path = {}
+        downloader = ProfilePictureDownloader(self.cache_dir.name)
+        results = downloader.download_all(self.users)
+        downloader.close()
+        self.assertEqual(results['0']['status'], 'cached')
+        self.assertEqual(results['2']['status'], 'cached')
+        self.assertNotIn('/ok_400x400.png', FakePictureHandler.requests_by_path)
+        # revalidating with the etag
+        downloader = ProfilePictureDownloader(self.cache_dir.name, revalidate=True)
+        results = downloader.download_all(self.users)
+        downloader.close()
+        self.assertEqual(results['0']['status'], 'cached')
+        self.assertEqual(FakePictureHandler.requests_by_path['/ok_400x400.png'], 1)
+
+
+
+class testDatePartitionsTestCase(unittest.TestCase):
+
+    def testpartitions_by_day(self):
+        partitions = get_date_partitions('2020-03-30', '2020-04-01', 'day')
+        self.assertEqual(partitions, [('2020-03-30', '2020-03-30'),
+                                      ('2020-03-31', '2020-03-31'),
+                                      ('2020-04-01', '2020-04-01')])
+
+    def testpartitions_by_week(self):
+        # 2020-03-25 is wednesday, weeks end on sunday
+        partitions = get_date_partitions('2020-03-25', '2020-04-07', 'week')
+        self.assertEqual(partitions, [('2020-03-25', '2020-03-29'),
+                                      ('2020-03-30', '2020-04-05'),
+                                      ('2020-04-06', '2020-04-07')])
+
+
+
+class testHyperLogLogTestCase(unittest.TestCase):
+
+    def testcount(self):
+        hll = HyperLogLog()
+        for i in range(50000):
+            hll.add('user_{}'.format(i))
+            hll.add('user_{}'.format(i))
+        self.assertAlmostEqual(hll.count(), 50000, delta=50000*0.03)
+
+    def testmerge_and_serialize(self):
+        hll_day1, hll_day2 = HyperLogLog(), HyperLogLog()
+        for i in range(3000):
+            hll_day1.add('user_{}'.format(i))
+            hll_day2.add('user_{}'.format(i+1000))
+        hll_day1.merge(HyperLogLog.from_bytes(hll_day2.to_bytes()))
+        self.assertAlmostEqual(hll_day1.count(), 4000, delta=4000*0.03)
+
+
+class testDashboardCubesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # users 0-3999 tweet on the first day and users 2000-5999 on the 
+        # second one
+        rows = []
+        for date, first_user in [('2020-03-24', 0), ('2020-03-25', 2000)]:
+            for i in range(first_user, first_user + 4000):
+                rows.append({'date': date, 
+                             'date_hour': '{} {:02d}'.format(date, i % 24),
+                             'type': 'retweet' if i % 2 else 'original',
+                             'lang': 'es', 'comunidad_autonoma': 'Madrid',
+                             'user_screen_name': 'user_{}'.format(i), 
+                             'sentiment': (i % 3 - 1) * 0.5})
+        self.data = pd.DataFrame(rows)
+        self.cubes_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cubes_dir)
+
+    def testwrite_and_read(self):
+        cubes = build_cubes(self.data)
+        write_cubes(cubes, self.cubes_dir)
+        write_cubes(cubes, self.cubes_dir)
+        read = read_cubes(self.cubes_dir)
+        for cube_name in CUBE_NAMES:
+            pd.testing.assert_frame_equal(read[cube_name], cubes[cube_name])
+        # the sketches are read from the memory-mapped file, not copied
+        self.assertFalse(read['users_sketches'].flags['OWNDATA'])
+        self.assertTrue(np.array_equal(read['users_sketches'], 
+                                       cubes['users_sketches']))
+        self.assertEqual(len(os.listdir(self.cubes_dir)), 3)
+
+    def testcount_users(self):
+        cubes = build_cubes(self.data)
+        first_day = (cubes['date_hour_users']['date'] == '2020-03-24').values
+        self.assertAlmostEqual(count_users(cubes['users_sketches'][first_day]), 
+                               4000, delta=4000*0.02)
+        self.assertAlmostEqual(count_users(cubes['users_sketches']), 6000, 
+                               delta=6000*0.02)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
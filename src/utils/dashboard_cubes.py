@@ -0,0 +1,180 @@
+import numpy as np
+import os
+import pandas as pd
+import pyarrow as pa
+import shutil
+import tempfile
+
+from .hyperloglog import HyperLogLog
+
+
+# columns of the parquet dataset used by the dashboard
+DASHBOARD_COLUMNS = ['id', 'date', 'created_at', 'type', 'lang',
+                     'user_screen_name', 'sentiment_score', 'comunidad_autonoma']
+LANGUAGES_NO_TO_AGGREGATE = ['es', 'ca', 'eu', 'gl', 'en', 'pt', 'fr', 'it']
+SENTIMENT_THRESHOLDS = {'low': -0.1, 'high': 0.1}
+SPANISH_WEEKDAYS = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes',
+                    'Sábado', 'Domingo']
+# precision of the sketches of unique users (2^12 registers, error ~1.6%)
+USERS_HLL_PRECISION = 12
+CUBE_NAMES = ['date_hour_type', 'date_lang', 'date_ccaa', 'date_sentiment',
+              'date_hour_users']
+# every export is written into a new build directory of the cubes directory
+# and published by pointing the link current to it
+BUILD_PREFIX = 'build_'
+CURRENT_LINK = 'current'
+
+
+def table_to_data(table):
+    """
+    Convert an arrow table with the dashboard columns of a parquet dataset
+    into the data frame aggregated by build_cubes
+    """
+    data = table.to_pandas()
+    for column in ['type', 'lang', 'comunidad_autonoma']:
+        data[column] = data[column].astype(object)
+    data['date'] = data['date'].astype(str)
+    data['date_hour'] = data['created_at'].dt.strftime('%Y-%m-%d %H')
+    data = data.rename(columns={'sentiment_score': 'sentiment'})
+    return data
+
+
+def build_cubes(data):
+    """
+    Aggregate the tweets into the small tables (cubes) used by the figures.
+    All of them have the column date so they can be filtered by the dates
+    ranges selected in the dashboard. Unique users can't be added up across
+    dates, so the users cube keeps a HyperLogLog sketch of the users of
+    every date and hour (the row of the sketch in users_sketches), which
+    are merged over the selected dates
+    """
+    data = data.loc[:, ['date', 'date_hour', 'type', 'lang',
+                        'comunidad_autonoma', 'user_screen_name', 'sentiment']]
+    data['date'] = data['date'].astype(str)
+    data['lang'] = data['lang'].where(data['lang'].isin(LANGUAGES_NO_TO_AGGREGATE),
+                                      'otro')
+    sentiment = pd.to_numeric(data['sentiment'])
+    data['sentiment_label'] = np.where(sentiment > SENTIMENT_THRESHOLDS['high'], 'positivo',
+                                       np.where(sentiment < SENTIMENT_THRESHOLDS['low'],
+                                                'negativo', 'neutral'))
+    data['hour'] = data['date_hour'].str[-2:]
+    cubes = {}
+    for name, columns in [('date_hour_type', ['date', 'date_hour', 'type']),
+                          ('date_lang', ['date', 'lang']),
+                          ('date_ccaa', ['date', 'comunidad_autonoma']),
+                          ('date_sentiment', ['date', 'sentiment_label'])]:
+        cubes[name] = data.groupby(columns).size().reset_index(name='count')
+    users = data.loc[:, ['date', 'hour', 'user_screen_name']].drop_duplicates()
+    date_hours, sketches = [], []
+    for date_hour, date_hour_users in users.groupby(['date', 'hour']):
+        users_hll = HyperLogLog(USERS_HLL_PRECISION)
+        for user in date_hour_users['user_screen_name']:
+            users_hll.add(user)
+        date_hours.append(date_hour)
+        sketches.append(np.frombuffer(users_hll.registers, dtype=np.uint8))
+    users = pd.DataFrame(date_hours, columns=['date', 'hour'])
+    weekdays = pd.to_datetime(users['date']).dt.weekday
+    users['day_week'] = np.array(SPANISH_WEEKDAYS, dtype=object)[weekdays.values]
+    cubes['date_hour_users'] = users
+    cubes['users_sketches'] = np.array(sketches, dtype=np.uint8).\
+                              reshape(len(sketches), 1 << USERS_HLL_PRECISION)
+    return cubes
+
+
+def count_users(sketches):
+    """
+    Estimate the unique users of the union of the sketches (rows of
+    registers) of the users cube
+    """
+    if len(sketches) == 0:
+        return 0
+    registers = sketches.max(axis=0)
+    return HyperLogLog(USERS_HLL_PRECISION, registers.tobytes()).count()
+
+
+def write_cubes(cubes, output_dir):
+    """
+    Save every cube into an uncompressed Arrow IPC file of a new build
+    directory of output_dir and then point the link current of output_dir
+    to it. Replacing the link is atomic, so a running dashboard reads either
+    all the cubes of the previous build or all the cubes of the new one.
+    Builds older than the previous one are removed
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    build_dir = tempfile.mkdtemp(prefix=BUILD_PREFIX, dir=output_dir)
+    for cube_name, cube_fn in zip(CUBE_NAMES, get_cube_fns(build_dir)):
+        table = pa.Table.from_pandas(cubes[cube_name], preserve_index=False)
+        if cube_name == 'date_hour_users':
+            sketches = [sketch.tobytes() for sketch in cubes['users_sketches']]
+            table = table.append_column('users_hll', pa.array(
+                sketches, type=pa.binary(1 << USERS_HLL_PRECISION)))
+        with pa.OSFile(cube_fn, 'wb') as sink:
+            writer = pa.ipc.new_file(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+    os.chmod(build_dir, 0o755)
+    try:
+        previous_build_dir = get_cubes_build_dir(output_dir)
+    except FileNotFoundError:
+        previous_build_dir = None
+    link_fn = os.path.join(output_dir, CURRENT_LINK)
+    tmp_link_fn = link_fn + '.tmp'
+    if os.path.lexists(tmp_link_fn):
+        os.remove(tmp_link_fn)
+    os.symlink(os.path.basename(build_dir), tmp_link_fn)
+    os.replace(tmp_link_fn, link_fn)
+    for file_name in os.listdir(output_dir):
+        old_build_dir = os.path.join(output_dir, file_name)
+        if file_name.startswith(BUILD_PREFIX) and \
+           old_build_dir not in (build_dir, previous_build_dir):
+            shutil.rmtree(old_build_dir, ignore_errors=True)
+
+
+def get_cube_fns(build_dir):
+    return [os.path.join(build_dir, cube_name + '.arrow')
+            for cube_name in CUBE_NAMES]
+
+
+def get_cubes_build_dir(cubes_dir):
+    """
+    Return the build directory that the link current of cubes_dir points
+    to. Raise FileNotFoundError if no build was published yet
+    """
+    link_fn = os.path.join(cubes_dir, CURRENT_LINK)
+    build_dir = os.path.join(cubes_dir, os.readlink(link_fn))
+    if not os.path.isdir(build_dir):
+        raise FileNotFoundError('The build {} of the cubes does not exist'.\
+                                format(build_dir))
+    return build_dir
+
+
+def read_cubes(cubes_dir):
+    """
+    Read the cubes of the current build saved by write_cubes. The files are
+    memory-mapped, so the sketches of the users cube, its largest column,
+    are read from the page cache shared by all the workers of the dashboard
+    instead of being copied into each of them
+    """
+    cubes = {}
+    build_dir = get_cubes_build_dir(cubes_dir)
+    for cube_name, cube_fn in zip(CUBE_NAMES, get_cube_fns(build_dir)):
+        source = pa.memory_map(cube_fn, 'r')
+        table = pa.ipc.open_file(source).read_all()
+        if cube_name == 'date_hour_users':
+            sketch_size = 1 << USERS_HLL_PRECISION
+            sketches = [np.frombuffer(chunk.buffers()[1], dtype=np.uint8)\
+                        [chunk.offset * sketch_size:\
+                         (chunk.offset + len(chunk)) * sketch_size]
+                        for chunk in table.column('users_hll').chunks
+                        if len(chunk) > 0]
+            if len(sketches) == 1:
+                sketches = sketches[0]
+            elif sketches:
+                sketches = np.concatenate(sketches)
+            else:
+                sketches = np.zeros(0, dtype=np.uint8)
+            cubes['users_sketches'] = sketches.reshape(-1, sketch_size)
+            table = table.drop(['users_hll'])
+        cubes[cube_name] = table.to_pandas()
+    return cubes
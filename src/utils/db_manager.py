@@ -92,6 +92,14 @@ class DBManager:
         self.__db[self.__collection].create_index([(name, direction)], 
                                                   unique=unique)
 
+    def create_compound_index(self, fields, unique=False):
+        # fields is a list of (name, sorting_type) tuples
+        index_fields = []
+        for name, sorting_type in fields:
+            direction = DESCENDING if sorting_type == 'desc' else ASCENDING
+            index_fields.append((name, direction))
+        self.__db[self.__collection].create_index(index_fields, unique=unique)
+
     def save_record(self, record_to_save):
         self.__db[self.__collection].insert(record_to_save)
 
@@ -118,6 +126,20 @@ class DBManager:
             )            
         return self.__db[self.__collection].bulk_write(update_objs)
 
+    def bulk_insert_if_not_exists(self, docs, key):
+        # insert docs whose key is not yet in the collection, leaving the
+        # existing ones untouched
+        insert_objs = []
+        for doc in docs:
+            insert_objs.append(
+                UpdateOne(
+                            {key: doc[key]},
+                            {'$setOnInsert': doc},
+                            upsert=True
+                          )
+            )
+        return self.__db[self.__collection].bulk_write(insert_objs, ordered=False)
+
     def remove_field(self, filter_query, old_values, apply_to_multiple_records=False):
         return self.__db[self.__collection].update(filter_query, {'$unset': old_values},
                                                    multi=apply_to_multiple_records)
@@ -170,6 +192,52 @@ class DBManager:
     def aggregate(self, pipeline):
         return [doc for doc in self.__db[self.__collection].aggregate(pipeline, allowDiskUse=True)]
 
+    def propagate_metrics_to_retweets(self, since_date=None):
+        """
+        Copy the metrics of original tweets updated since the given date
+        into their retweets. The join and the writes run in the server
+        """
+        match = {
+            'retweeted_status': {'$exists': 0},
+            'last_metric_update_date': {'$ne': None}
+        }
+        if since_date:
+            match['last_metric_update_date'] = {'$gte': since_date}
+        pipeline = [
+            {'$match': match},
+            {'$project': {
+                '_id': 0,
+                'id_str': 1,
+                'retweet_count': 1,
+                'favorite_count': 1,
+                'last_metric_update_date': 1,
+                'next_metric_update_date': 1
+            }},
+            {'$lookup': {
+                'from': self.__collection,
+                'localField': 'id_str',
+                'foreignField': 'retweeted_status.id_str',
+                'as': 'rt'
+            }},
+            # unwinding right after the lookup avoids building arrays with
+            # all the retweets of a tweet
+            {'$unwind': '$rt'},
+            {'$project': {
+                '_id': '$rt._id',
+                'retweet_count': 1,
+                'favorite_count': 1,
+                'last_metric_update_date': 1,
+                'next_metric_update_date': 1
+            }},
+            {'$merge': {
+                'into': self.__collection,
+                'on': '_id',
+                'whenMatched': 'merge',
+                'whenNotMatched': 'discard'
+            }}
+        ]
+        return self.aggregate(pipeline)
+
     def __add_extra_filters(self, match, **kwargs):
         match.update(kwargs)
         return match
@@ -334,6 +402,13 @@ class DBManager:
         return result_docs
     
     def get_tweets_by_date(self, **kwargs):
+        if kwargs.get('stats_collection'):
+            # daily rollup maintained by update-daily-stats
+            docs = self.__db[kwargs['stats_collection']].\
+                find({'collection': self.__collection}, 
+                     {'_id': 0, 'date': 1, 'total': 1}).sort('date', ASCENDING)
+            return [{'date': datetime.strptime(doc['date'], '%Y-%m-%d'), 
+                     'count': doc['total']} for doc in docs]
         match = {}
         group = {
             '_id': '$created_at_date',
@@ -557,41 +632,55 @@ class DBManager:
     def get_tweets_reduced(self, filters={}, projection={}):        
         results = self.find_all(filters, projection)
         reduced_tweets = []
+        for tweet in results:
+            reduced_tweets.append(self.reduce_tweet(tweet, projection))
+        return reduced_tweets
+
+    def reduce_tweet(self, tweet, projection={}):
         special_keys = ['retweeted_status', 'is_quote_status',
                         'in_reply_to_status_id_str']
-        for tweet in results:
-            reduced_tweet = {}
-            if 'type' in projection and 'type' not in tweet:
-                if 'retweeted_status' in tweet:
-                    reduced_tweet['type'] = 'rt'
-                elif 'is_quote_status' in tweet and tweet['is_quote_status']:
-                    reduced_tweet['type'] = 'qt'
-                elif 'in_reply_to_status_id_str' in tweet and tweet['in_reply_to_status_id_str']:
-                    reduced_tweet['type'] = 'rp'
+        reduced_tweet = {}
+        if 'type' in projection and 'type' not in tweet:
+            if 'retweeted_status' in tweet:
+                reduced_tweet['type'] = 'rt'
+            elif 'is_quote_status' in tweet and tweet['is_quote_status']:
+                reduced_tweet['type'] = 'qt'
+            elif 'in_reply_to_status_id_str' in tweet and tweet['in_reply_to_status_id_str']:
+                reduced_tweet['type'] = 'rp'
+            else:
+                reduced_tweet['type'] = 'og'
+        for key, value in tweet.items():
+            if key not in special_keys:
+                if isinstance(value, dict):
+                    for k, v in value.items():
+                        combined_key = key + '_' + k
+                        reduced_tweet[combined_key] = tweet[key][k]
                 else:
-                    reduced_tweet['type'] = 'og'
-            for key, value in tweet.items():
-                if key not in special_keys:
-                    if isinstance(value, dict):
-                        for k, v in value.items():
-                            combined_key = key + '_' + k
-                            reduced_tweet[combined_key] = tweet[key][k]
-                    else:
-                        reduced_tweet[key] = tweet[key]
-            reduced_tweets.append(reduced_tweet)
-        
-        return reduced_tweets
+                    reduced_tweet[key] = tweet[key]
+        return reduced_tweet
+
+    def add_random_field(self, field):
+        # give every document without the field a random number in [0, 1),
+        # computed in the database ($rand requires MongoDB 4.4.2)
+        return self.__db[self.__collection].update_many(
+            {field: {'$exists': 0}}, [{'$set': {field: {'$rand': {}}}}])
+
+    def get_distinct(self, field, query=None):
+        return self.__db[self.__collection].distinct(field, query)
 
     def get_sample(self, sample_size, query_filter=None, projection=None):
-        pipeline = [
-            {'$sample': {'size': int(sample_size)}}
-        ]
+        # filter before sampling, otherwise the sample is smaller than
+        # sample_size and the filter is applied to random documents
+        pipeline = []
         if query_filter:
             pipeline.append(
                 {
                     '$match': query_filter
                 }
             )
+        pipeline.append(
+            {'$sample': {'size': int(sample_size)}}
+        )
         if projection:
             pipeline.append(
                 {
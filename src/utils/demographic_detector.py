@@ -1,4 +1,6 @@
 from m3inference import M3Twitter
+from m3inference.dataset import M3InferenceDataset
+from torch.utils.data import DataLoader
 
 import csv
 from datetime import datetime
@@ -8,16 +10,55 @@ import os
 import pandas as pd
 import pathlib
 import pprint
+import time
+import torch
 
 
 logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('tw_coronavirus.log')),
                     level=logging.DEBUG)
 
 
+class StoredPicturesDataset(M3InferenceDataset):
+    """
+    Dataset of M3 that reads the pictures already resized in the image
+    store instead of decoding them from disk. Pictures that are not in 
+    the store are loaded by M3
+    """
+
+    def __init__(self, data, image_store):
+        super().__init__(data, use_img=True)
+        self.image_store = image_store
+        # picture file -> user whose picture is in the store
+        self.stored_pictures = {}
+        for entry in data:
+            if image_store.get_status(entry['id'], entry['img_path']) == 'ok':
+                self.stored_pictures[entry['img_path']] = entry['id']
+
+    def _image_loader(self, image_name):
+        user_id = self.stored_pictures.get(image_name)
+        if user_id is None:
+            return super()._image_loader(image_name)
+        # same values as the ToTensor transformation of M3
+        return self.image_store.get_tensor(user_id).float().div(255)
+
+
 class DemographicDetector:
 
-    def __init__(self, pic_dir):
+    def __init__(self, pic_dir, batch_size=16, num_workers=4, num_threads=None,
+                 image_store=None):
         self.m3twitter = M3Twitter(cache_dir=pic_dir)
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.image_store = image_store
+        # users are inferred in chunks so that a failure only repeats the 
+        # users of its chunk
+        self.chunk_size = batch_size * 10
+        if num_threads:
+            # intra-op threads used by torch in cpu inference
+            torch.set_num_threads(num_threads)
+        logging.info('Inference with batch size {0}, {1} data loader workers '\
+                     'and {2} torch threads'.format(batch_size, num_workers, 
+                                                    torch.get_num_threads()))
     
     def process_predictions(self, predictions):
         processed_predictions = []
@@ -39,11 +80,59 @@ class DemographicDetector:
             )
         return processed_predictions
 
+    def __infer_from_store(self, user_objs):
+        # the loop of M3Inference.infer with the dataset of the image store
+        dataset = StoredPicturesDataset(user_objs, self.image_store)
+        dataloader = DataLoader(dataset, self.batch_size, 
+                                num_workers=self.num_workers, pin_memory=True)
+        y_pred = []
+        with torch.no_grad():
+            for batch in dataloader:
+                batch = [i.to(self.m3twitter.device) for i in batch]
+                pred = self.m3twitter.model(batch)
+                y_pred.append([_pred.detach().cpu().numpy() for _pred in pred])
+        return self.m3twitter.format_json_output(user_objs, y_pred)
+
     def infer(self, user_objs):        
-        predictions = self.m3twitter.infer(user_objs)
+        if self.image_store:
+            predictions = self.__infer_from_store(user_objs)
+        else:
+            predictions = self.m3twitter.infer(user_objs, batch_size=self.batch_size,
+                                               num_workers=self.num_workers)
         processed_predictions = self.process_predictions(predictions)
         return processed_predictions
 
+    def __infer_bisecting(self, user_objs, failed_users):
+        try:
+            return self.infer(user_objs)
+        except Exception as e:
+            if len(user_objs) == 1:
+                logging.info('Could not infer the demographics of the user '\
+                             '{0} ({1})'.format(user_objs[0]['id'], e))
+                failed_users.append(user_objs[0]['id'])
+                return []
+            # split the users in halves to find the ones that fail
+            middle = len(user_objs) // 2
+            return self.__infer_bisecting(user_objs[:middle], failed_users) + \
+                   self.__infer_bisecting(user_objs[middle:], failed_users)
+
+    def infer_isolating_failures(self, user_objs):
+        """
+        Infer the demographics of the users making sure that a user whose
+        inference fails does not make the rest fail. Return the predictions
+        and the ids of the users that failed
+        """
+        predictions, failed_users = [], []
+        start_time = time.time()
+        for i in range(0, len(user_objs), self.chunk_size):
+            chunk = user_objs[i:i+self.chunk_size]
+            predictions.extend(self.__infer_bisecting(chunk, failed_users))
+        elapsed_secs = time.time() - start_time
+        logging.info('Inferred the demographics of {0} users ({1} failed) at '\
+                     '{2:.1f} users/sec'.format(len(user_objs), len(failed_users),
+                                                len(user_objs)/max(elapsed_secs, 1e-6)))
+        return predictions, failed_users
+
     def infer_from_file(self, input_file):        
         logging.info('Starting predictions...')
         predictions = self.m3twitter.infer(input_file)
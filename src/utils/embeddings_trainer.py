@@ -4,6 +4,7 @@ import preprocessor as tw_preprocessor
 import tempfile
 
 from gensim.models import Word2Vec
+from .text_normalizer import TweetTextNormalizer
 
 
 tw_preprocessor.set_options(tw_preprocessor.OPT.URL, 
@@ -19,16 +20,9 @@ class EmbeddingsTrainer:
     tokenizer = nltk.RegexpTokenizer(r"\w+")
     
     def load_corpus(self, docs):
-        stopwords = nltk.corpus.stopwords.words("spanish") + \
-                    nltk.corpus.stopwords.words("english")
+        normalizer = TweetTextNormalizer()
         for doc in docs:
-            doc = doc.lower()
-            doc = tw_preprocessor.clean(doc)
-            text = []
-            for word in self.tokenizer.tokenize(doc):
-                if word not in stopwords and not str.isdigit(word):
-                    text.append(word)
-            self.corpus.append(text)
+            self.corpus.append(normalizer.tokenize_document(doc))
 
     def save_model(self, model_fn):
         with tempfile.NamedTemporaryFile(prefix='embeddings-model-', 
@@ -0,0 +1,67 @@
+import hashlib
+import math
+
+
+class HyperLogLog:
+    """
+    Sketch that estimates the number of distinct values added to it
+    using 2^precision registers of one byte (16KB with the default
+    precision, standard error around 0.8%). Sketches with the same
+    precision can be merged, so the distinct values of several days can
+    be estimated from the sketches of every day
+    """
+
+    def __init__(self, precision=14, registers=None):
+        if precision < 4 or precision > 16:
+            raise Exception('The precision should be between 4 and 16')
+        self.precision = precision
+        self.num_registers = 1 << precision
+        if registers:
+            if len(registers) != self.num_registers:
+                raise Exception('Expected {0} registers, got {1}'.\
+                                format(self.num_registers, len(registers)))
+            self.registers = bytearray(registers)
+        else:
+            self.registers = bytearray(self.num_registers)
+
+    def __get_alpha(self):
+        if self.num_registers == 16:
+            return 0.673
+        elif self.num_registers == 32:
+            return 0.697
+        elif self.num_registers == 64:
+            return 0.709
+        else:
+            return 0.7213 / (1 + 1.079 / self.num_registers)
+
+    def add(self, value):
+        hash_value = int.from_bytes(
+            hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(),
+            'big')
+        index = hash_value >> (64 - self.precision)
+        remaining_bits = hash_value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining_bits.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise Exception('Sketches with different precision cannot be merged')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        estimate = self.__get_alpha() * self.num_registers ** 2 / \
+                   sum([2.0 ** -register for register in self.registers])
+        empty_registers = self.registers.count(0)
+        if estimate <= 2.5 * self.num_registers and empty_registers > 0:
+            # small range correction
+            estimate = self.num_registers * \
+                       math.log(self.num_registers / empty_registers)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data[0], data[1:])
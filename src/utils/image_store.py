@@ -0,0 +1,178 @@
+import json
+import logging
+import numpy as np
+import os
+import pathlib
+import torch
+
+from .utils import validate_profile_image
+
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[1].joinpath('tw_coronavirus.log')),
+                    level=logging.DEBUG)
+
+
+class ProfileImageStore:
+    """
+    Store of validated profile pictures. Pictures are decoded and resized
+    to 224x224 RGB once and kept in a memory-mapped uint8 array, one slot
+    per user. A small index holds the slot, the validation status and the
+    signature (size and modification time) of the source file of every
+    user, so validating a picture that has not changed is a dictionary
+    lookup and its pixels can be read without copying them. Stores can
+    be passed to other processes (e.g. the workers of a data loader), 
+    which map the same file instead of receiving a copy of the pictures
+    """
+    IMG_SHAPE = (224, 224, 3)
+    MIN_SIZE_SUM = 400
+    DATA_FILENAME = 'images.dat'
+    INDEX_FILENAME = 'index.json'
+
+    def __init__(self, store_dir, initial_capacity=1024):
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.__data_fn = os.path.join(store_dir, self.DATA_FILENAME)
+        self.__index_fn = os.path.join(store_dir, self.INDEX_FILENAME)
+        if os.path.exists(self.__index_fn) and os.path.exists(self.__data_fn):
+            with open(self.__index_fn, 'r') as f:
+                self.__index = json.load(f)
+            mode = 'r+'
+        else:
+            self.__index = {
+                'capacity': initial_capacity,
+                'num_images': 0,
+                'users': {}
+            }
+            mode = 'w+'
+        self.__images = np.memmap(self.__data_fn, dtype=np.uint8, mode=mode,
+                                  shape=(self.__index['capacity'],) + self.IMG_SHAPE)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_ProfileImageStore__images']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # copy-on-write mapping, readers share the pages of the file
+        self.__images = np.memmap(self.__data_fn, dtype=np.uint8, mode='c',
+                                  shape=(self.__index['capacity'],) + self.IMG_SHAPE)
+
+    def __grow(self):
+        new_capacity = self.__index['capacity'] * 2
+        logging.info('Growing the image store to {:,} images'.format(new_capacity))
+        self.__images.flush()
+        del self.__images
+        with open(self.__data_fn, 'r+b') as f:
+            f.truncate(new_capacity * int(np.prod(self.IMG_SHAPE)))
+        self.__index['capacity'] = new_capacity
+        self.__images = np.memmap(self.__data_fn, dtype=np.uint8, mode='r+',
+                                  shape=(new_capacity,) + self.IMG_SHAPE)
+
+    def __file_signature(self, img_path):
+        stat = os.stat(img_path)
+        return [stat.st_size, int(stat.st_mtime)]
+
+    def get_status(self, user_id, img_path=None):
+        """
+        Return the validation status of the picture of the user (ok,
+        too_small, invalid or missing) or None if the picture is not in
+        the store or its file changed since it was stored
+        """
+        entry = self.__index['users'].get(str(user_id))
+        if not entry:
+            return None
+        if img_path:
+            if not os.path.exists(img_path):
+                return 'missing'
+            if entry['file'] != self.__file_signature(img_path):
+                return None
+        return entry['status']
+
+    def get_original_size(self, user_id):
+        entry = self.__index['users'].get(str(user_id))
+        if entry and entry['orig_size']:
+            return tuple(entry['orig_size'])
+        return None
+
+    def add(self, user_id, img_path):
+        """
+        Validate the picture of the user and store it if it is valid.
+        Return the validation status
+        """
+        if not os.path.exists(img_path):
+            return 'missing'
+        status, orig_size, img_array = validate_profile_image(img_path, 
+                                                              self.MIN_SIZE_SUM,
+                                                              self.IMG_SHAPE[:2])
+        return self.put(user_id, img_path, status, orig_size, img_array)
+
+    def put(self, user_id, img_path, status, orig_size=None, img_array=None):
+        """
+        Store the result of validating the picture of the user with
+        validate_profile_image, which can run in other processes. Return
+        the validation status
+        """
+        if status == 'missing':
+            return status
+        user_id = str(user_id)
+        entry = self.__index['users'].get(user_id, {'slot': None})
+        entry.update({
+            'file': self.__file_signature(img_path),
+            'orig_size': orig_size,
+            'status': status
+        })
+        if status == 'ok':
+            if entry['slot'] is None:
+                if self.__index['num_images'] == self.__index['capacity']:
+                    self.__grow()
+                entry['slot'] = self.__index['num_images']
+                self.__index['num_images'] += 1
+            self.__images[entry['slot']] = img_array
+        self.__index['users'][user_id] = entry
+        return status
+
+    def validate(self, user_id, img_path):
+        """
+        Return the validation status of the picture, processing it only if
+        it is not in the store yet or its file changed
+        """
+        status = self.get_status(user_id, img_path)
+        if status is None:
+            status = self.add(user_id, img_path)
+        return status
+
+    def __get_slot(self, user_id):
+        entry = self.__index['users'].get(str(user_id))
+        if not entry or entry['status'] != 'ok':
+            return None
+        return entry['slot']
+
+    def get_array(self, user_id):
+        """
+        Return a read-only view (224x224x3, uint8) of the picture of the
+        user in the memory-mapped store
+        """
+        slot = self.__get_slot(user_id)
+        if slot is None:
+            return None
+        img_array = self.__images[slot]
+        img_array.flags.writeable = False
+        return img_array
+
+    def get_tensor(self, user_id):
+        """
+        Return the picture of the user as a 3x224x224 uint8 tensor that
+        shares memory with the store
+        """
+        slot = self.__get_slot(user_id)
+        if slot is None:
+            return None
+        return torch.from_numpy(self.__images[slot]).permute(2, 0, 1)
+
+    def save(self):
+        self.__images.flush()
+        tmp_fn = self.__index_fn + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(self.__index, f)
+        os.replace(tmp_fn, self.__index_fn)
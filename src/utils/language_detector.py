@@ -116,6 +116,12 @@ def detect_language(text):
     lang_dict['polyglot'] = lang_polyglot
     lang_detected[lang_polyglot] += 1    
 
+    lang_dict['pref_lang'] = choose_preferred_language(lang_detected)
+    
+    return lang_dict
+
+
+def choose_preferred_language(lang_detected):
     # choose language with the highest counter
     max_counter, pref_lang = -1, ''
     for lang, counter in lang_detected.items():
@@ -127,6 +133,48 @@ def detect_language(text):
         elif counter == max_counter:
             pref_lang += '_' + lang
     
-    lang_dict['pref_lang'] = pref_lang if pref_lang != '' else 'undefined'
-    
-    return lang_dict
+    return pref_lang if pref_lang != '' else 'undefined'
+
+
+def detect_language_fasttext_batch(texts):
+    """
+    Detect the language of a list of texts with a single call to the
+    fasttext model
+    """
+    threshold_confidence = 0.75
+    # fasttext predicts one text per line
+    clean_texts = [text.replace('\n', ' ') for text in texts]
+    try:
+        labels, probs = ft_model.predict(clean_texts, k=1)
+    except:
+        return [do_detect_language(text, 'fasttext') for text in texts]
+    langs = []
+    for label, prob in zip(labels, probs):
+        if len(prob) > 0 and prob[0] >= threshold_confidence:
+            langs.append(label[0].replace('__label__',''))
+        else:
+            langs.append('undefined')
+    return langs
+
+
+def detect_language_batch(texts):
+    """
+    Same as detect_language but for a list of texts, fasttext processes
+    all the texts at once. Empty texts get None
+    """
+    lang_dicts = [None] * len(texts)
+    idx_texts = [idx for idx, text in enumerate(texts) if text]
+    if len(idx_texts) == 0:
+        return lang_dicts
+    langs_fasttext = detect_language_fasttext_batch([texts[idx] for idx in idx_texts])
+    for idx, lang_fasttext in zip(idx_texts, langs_fasttext):
+        text = texts[idx]
+        lang_dict = {'fasttext': lang_fasttext}
+        for detector in ['langid', 'langdetect', 'polyglot']:
+            lang_dict[detector] = do_detect_language(text, detector)
+        lang_detected = defaultdict(int)
+        for detector in ['fasttext', 'langid', 'langdetect', 'polyglot']:
+            lang_detected[lang_dict[detector]] += 1
+        lang_dict['pref_lang'] = choose_preferred_language(lang_detected)
+        lang_dicts[idx] = lang_dict
+    return lang_dicts
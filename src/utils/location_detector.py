@@ -8,8 +8,8 @@ import preprocessor as tw_preprocessor
 
 from collections import defaultdict
 from .language_detector import do_detect_language
-from .utils import remove_non_ascii, to_lowercase, remove_punctuation, \
-                   remove_extra_spaces, tokenize_text
+from .text_normalizer import normalize_location
+from .utils import tokenize_text
 
 
 tw_preprocessor.set_options(tw_preprocessor.OPT.URL, 
@@ -188,12 +188,7 @@ class LocationDetector:
             f.write(json.dumps(countries, ensure_ascii=False))
 
     def __normalize_text(self, text):
-        text = text.replace('#','')
-        words = remove_non_ascii(text)
-        words = to_lowercase(words)
-        words = remove_punctuation(words)
-        words = remove_extra_spaces(words)
-        return ' '.join(words)
+        return normalize_location(text)
 
     def __match_location(self, places, locations):
         matchings = []
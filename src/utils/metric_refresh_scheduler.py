@@ -0,0 +1,185 @@
+import logging
+import pathlib
+
+from datetime import datetime, timedelta
+from .db_manager import DBManager
+
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[1].joinpath('tw_coronavirus.log')),
+                    level=logging.DEBUG)
+
+
+class MetricRefreshScheduler:
+    """
+    Decide which tweets get their metrics refreshed every day. Tweets are
+    kept in a queue collection indexed by the date they are due. Every
+    tweet has its own refresh interval that doubles each time its counts
+    don't change and halves when they do. The daily budget goes to the
+    due tweets whose counts changed the fastest in the last refresh, new
+    tweets going first.
+    """
+    NEW_TWEET_PRIORITY = 1e9
+
+    def __init__(self, config_fn=None, collection='metric_refresh_queue',
+                 daily_budget=None, min_interval_days=1, max_interval_days=64):
+        self.daily_budget = daily_budget
+        self.min_interval_days = min_interval_days
+        self.max_interval_days = max_interval_days
+        self.__dbm = DBManager(collection=collection, config_fn=config_fn)
+        self.__dbm.create_index('id_str', 'asc', unique=True)
+        self.__dbm.create_index('due_date', 'asc')
+
+    def enqueue(self, tweets, now=None):
+        """
+        Add to the queue tweets that are not in it yet, they are due
+        immediately
+        """
+        if not now:
+            now = datetime.today()
+        docs = []
+        for tweet in tweets:
+            docs.append({
+                'id_str': tweet['id_str'],
+                'created_at_date': tweet['created_at_date'],
+                'due_date': now,
+                'interval_days': self.min_interval_days,
+                'priority': self.NEW_TWEET_PRIORITY,
+                'retweet_count': None,
+                'favorite_count': None,
+                'last_refresh_date': None
+            })
+        if len(docs) > 0:
+            ret = self.__dbm.bulk_insert_if_not_exists(docs, 'id_str')
+            logging.info('Enqueued {0:,} new tweets'.format(ret.upserted_count))
+
+    def enqueue_refreshed(self, tweets, now=None):
+        """
+        Add to the queue tweets whose metrics were refreshed before the
+        queue existed. They are due on their next_metric_update_date and
+        their interval is their age on the last refresh, which is the
+        interval they were refreshed with
+        """
+        if not now:
+            now = datetime.today()
+        docs = []
+        for tweet in tweets:
+            created_at = datetime.strptime(tweet['created_at_date'], '%Y-%m-%d')
+            last_refresh_date = datetime.strptime(tweet['last_metric_update_date'], 
+                                                  '%Y-%m-%d')
+            if tweet.get('next_metric_update_date'):
+                due_date = datetime.strptime(tweet['next_metric_update_date'], 
+                                             '%Y-%m-%d')
+            else:
+                due_date = now
+            age_days = max((last_refresh_date - created_at).days, 1)
+            retweet_count = tweet.get('retweet_count', 0)
+            favorite_count = tweet.get('favorite_count', 0)
+            docs.append({
+                'id_str': tweet['id_str'],
+                'created_at_date': tweet['created_at_date'],
+                'due_date': due_date,
+                'interval_days': min(self.max_interval_days, 
+                                     max(self.min_interval_days, age_days)),
+                'priority': (retweet_count + favorite_count) / age_days,
+                'retweet_count': retweet_count,
+                'favorite_count': favorite_count,
+                'last_refresh_date': last_refresh_date
+            })
+        if len(docs) > 0:
+            ret = self.__dbm.bulk_insert_if_not_exists(docs, 'id_str')
+            logging.info('Enqueued {0:,} refreshed tweets'.format(ret.upserted_count))
+
+    def get_due_tweets(self, now=None, budget=None):
+        """
+        Return the ids of the due tweets that fit into the budget. Tweets
+        that are overdue gain priority so that none of them starves
+        """
+        if not now:
+            now = datetime.today()
+        if not budget:
+            budget = self.daily_budget
+        pipeline = [
+            {'$match': {'due_date': {'$lte': now}}},
+            {'$addFields': {
+                'score': {
+                    '$multiply': [
+                        {'$add': ['$priority', 1]},
+                        {'$add': [1, {'$divide': [
+                            {'$subtract': [now, '$due_date']},
+                            86400000]}]}
+                    ]
+                }
+            }},
+            {'$sort': {'score': -1, 'due_date': 1}}
+        ]
+        if budget:
+            pipeline.append({'$limit': int(budget)})
+        pipeline.append({'$project': {'_id': 0, 'id_str': 1}})
+        return [doc['id_str'] for doc in self.__dbm.aggregate(pipeline)]
+
+    def get_queued_tweets(self, tweet_ids):
+        projection = {'_id': 0}
+        queued_tweets = self.__dbm.find_all({'id_str': {'$in': tweet_ids}},
+                                            projection)
+        return {queued_tweet['id_str']: queued_tweet
+                for queued_tweet in queued_tweets}
+
+    def __count_change(self, queued_tweet, hydrated_tweet):
+        if queued_tweet['retweet_count'] is None:
+            return None
+        return abs(hydrated_tweet['retweet_count'] - queued_tweet['retweet_count']) + \
+               abs(hydrated_tweet['favorite_count'] - queued_tweet['favorite_count'])
+
+    def reschedule(self, tweet_ids, hydrated_tweets, now=None):
+        """
+        Compute the next due date of the requested tweets. Tweets that were
+        not hydrated do not exist anymore and leave the queue. Return a
+        dictionary with the next due date of every hydrated tweet
+        """
+        if not now:
+            now = datetime.today()
+        queued_tweets = self.get_queued_tweets(tweet_ids)
+        update_queries, next_due_dates = [], {}
+        for hydrated_tweet in hydrated_tweets:
+            tweet_id = hydrated_tweet['id_str']
+            queued_tweet = queued_tweets.get(tweet_id)
+            if not queued_tweet:
+                continue
+            change = self.__count_change(queued_tweet, hydrated_tweet)
+            interval_days = queued_tweet['interval_days']
+            if change is None:
+                # first refresh, the counts gathered since the tweet was
+                # created give the initial change rate
+                created_at = datetime.strptime(queued_tweet['created_at_date'], '%Y-%m-%d')
+                age_days = (now - created_at).total_seconds()/86400
+                change_rate = (hydrated_tweet['retweet_count'] + \
+                               hydrated_tweet['favorite_count']) / max(age_days, 1)
+            else:
+                if queued_tweet['last_refresh_date']:
+                    elapsed_days = (now - queued_tweet['last_refresh_date']).total_seconds()/86400
+                else:
+                    elapsed_days = interval_days
+                change_rate = change / max(elapsed_days, 1)
+                if change > 0:
+                    interval_days = max(self.min_interval_days, interval_days/2)
+                else:
+                    interval_days = min(self.max_interval_days, interval_days*2)
+            due_date = now + timedelta(days=interval_days)
+            next_due_dates[tweet_id] = due_date
+            update_queries.append({
+                'filter': {'id_str': tweet_id},
+                'new_values': {
+                    'due_date': due_date,
+                    'interval_days': interval_days,
+                    'priority': change_rate,
+                    'retweet_count': hydrated_tweet['retweet_count'],
+                    'favorite_count': hydrated_tweet['favorite_count'],
+                    'last_refresh_date': now
+                }
+            })
+        if len(update_queries) > 0:
+            self.__dbm.bulk_update(update_queries)
+        miss_ids = set(tweet_ids) - set(next_due_dates.keys())
+        if len(miss_ids) > 0:
+            self.__dbm.remove_records({'id_str': {'$in': list(miss_ids)}})
+        return next_due_dates
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[1].joinpath('tw_coronavirus.log')),
+                    level=logging.DEBUG)
+
+
+class ProfilePictureDownloader:
+    """
+    Download the profile pictures of users concurrently, reusing HTTP
+    connections. Pictures are resized and stored with the name that
+    M3Twitter expects ({id_str}_224x224.{ext}), so it doesn't download them
+    again. An index with the url, ETag and size of every stored picture
+    allows skipping the pictures that are already in the cache directory
+    """
+    INDEX_FILENAME = 'pictures_index.json'
+    IMG_SIZE = (224, 224)
+    PERMANENT_ERRORS = (400, 401, 403, 404, 410)
+
+    def __init__(self, cache_dir, num_workers=16, max_retries=3, timeout=20,
+                 revalidate=False):
+        self.cache_dir = cache_dir
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.revalidate = revalidate
+        if not os.path.exists(cache_dir):
+            os.mkdir(cache_dir)
+        self.__index_fn = os.path.join(cache_dir, self.INDEX_FILENAME)
+        self.__index = self.__load_index()
+        self.__lock = threading.Lock()
+        self.__session = Session()
+        adapter = HTTPAdapter(pool_connections=num_workers,
+                              pool_maxsize=num_workers)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+
+    def __load_index(self):
+        if os.path.exists(self.__index_fn):
+            with open(self.__index_fn, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def __save_index(self):
+        tmp_fn = self.__index_fn + '.tmp'
+        with self.__lock:
+            with open(tmp_fn, 'w') as f:
+                json.dump(self.__index, f)
+        os.replace(tmp_fn, self.__index_fn)
+
+    def get_img_url(self, user):
+        return user['profile_image_url_https'].replace('_normal', '_400x400')
+
+    def get_img_path(self, user):
+        img_url = self.get_img_url(user)
+        ext = img_url[img_url.rfind('.')+1:]
+        return os.path.join(self.cache_dir, '{}_224x224.{}'.format(user['id_str'], ext))
+
+    def __is_cached(self, user_id, img_url, img_path):
+        if not os.path.exists(img_path):
+            return False
+        entry = self.__index.get(user_id)
+        if not entry:
+            # stored before the index existed
+            return True
+        return entry['url'] == img_url and \
+               entry['size'] == os.path.getsize(img_path)
+
+    def __save_picture(self, content, img_path):
+        img = Image.open(BytesIO(content))
+        img = img.resize(self.IMG_SIZE, Image.BILINEAR).convert('RGB')
+        ext = os.path.splitext(img_path)[1].lower()
+        img_format = Image.registered_extensions().get(ext, 'JPEG')
+        tmp_path = img_path + '.tmp'
+        img.save(tmp_path, format=img_format)
+        os.replace(tmp_path, img_path)
+
+    def download(self, user):
+        """
+        Download the profile picture of the user. Return a tuple with the
+        status (downloaded, cached, missing or failed) and the path of
+        the picture. Missing pictures do not exist anymore, failed ones
+        could not be downloaded because of transient errors
+        """
+        user_id = user['id_str']
+        img_url = self.get_img_url(user)
+        img_path = self.get_img_path(user)
+        entry = self.__index.get(user_id)
+        if self.__is_cached(user_id, img_url, img_path) and \
+           (not self.revalidate or not entry or not entry.get('etag')):
+            return 'cached', img_path
+        headers = {}
+        if entry and entry['url'] == img_url and entry.get('etag') and \
+           os.path.exists(img_path):
+            headers['If-None-Match'] = entry['etag']
+        attempts = 0
+        while attempts < self.max_retries:
+            attempts += 1
+            try:
+                response = self.__session.get(img_url, headers=headers,
+                                              timeout=self.timeout)
+            except RequestException as e:
+                logging.warning('Error downloading {0} ({1}), attempt {2}'.\
+                                format(img_url, e, attempts))
+                time.sleep(2 ** (attempts - 1))
+                continue
+            if response.status_code == 304:
+                return 'cached', img_path
+            if response.status_code in self.PERMANENT_ERRORS:
+                logging.info('The picture {0} does not exist anymore ({1})'.\
+                             format(img_url, response.status_code))
+                return 'missing', None
+            if response.status_code != 200:
+                logging.warning('Downloading {0} returned status {1}, attempt {2}'.\
+                                format(img_url, response.status_code, attempts))
+                time.sleep(2 ** (attempts - 1))
+                continue
+            try:
+                self.__save_picture(response.content, img_path)
+            except Exception as e:
+                logging.info('The picture {0} could not be processed ({1})'.\
+                             format(img_url, e))
+                return 'missing', None
+            with self.__lock:
+                self.__index[user_id] = {
+                    'url': img_url,
+                    'etag': response.headers.get('ETag'),
+                    'size': os.path.getsize(img_path)
+                }
+            return 'downloaded', img_path
+        return 'failed', None
+
+    def download_all(self, users):
+        """
+        Download the profile pictures of the given users. Return a
+        dictionary with the status and the path of the picture of every
+        user, indexed by id_str
+        """
+        results = {}
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            downloads = executor.map(self.download, users)
+            for user, (status, img_path) in zip(users, downloads):
+                results[user['id_str']] = {'status': status, 'img_path': img_path}
+        self.__save_index()
+        elapsed_secs = time.time() - start_time
+        logging.info('Processed the pictures of {0:,} users in {1:.1f} seconds'.\
+                     format(len(users), elapsed_secs))
+        return results
+
+    def close(self):
+        self.__session.close()
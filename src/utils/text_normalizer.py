@@ -0,0 +1,89 @@
+import demoji
+import emoji
+import nltk
+import preprocessor as tw_preprocessor
+
+from functools import lru_cache
+from nltk import wordpunct_tokenize
+from nltk.corpus import stopwords
+from .utils import remove_non_ascii, to_lowercase, remove_punctuation, \
+                   remove_extra_spaces
+
+
+class TweetTextNormalizer:
+    """
+    Normalize the text of tweets reusing everything that doesn't depend on
+    the text: stopwords are loaded once into frozen sets, regular
+    expressions are compiled once and the results of the stemmer are
+    memoised. Note that the cleaning of urls, mentions, etc. follows the
+    options set in tweet-preprocessor by the module that uses the
+    normalizer
+    """
+    PUNCT_SIGNS = frozenset(['.', '[', ']', ',', ';', ')', '),', '('])
+
+    def __init__(self, stemmer=None, cache_size=2**16):
+        self.stemmer = stemmer
+        self.cache_size = cache_size
+        self.es_stop_words = frozenset(stopwords.words('spanish')) | \
+                             self.PUNCT_SIGNS
+        self.corpus_stop_words = frozenset(stopwords.words('spanish')) | \
+                                 frozenset(stopwords.words('english'))
+        self.emoji_regexp = emoji.get_emoji_regexp()
+        self.corpus_tokenizer = nltk.RegexpTokenizer(r'\w+')
+        if stemmer:
+            self.stem = lru_cache(maxsize=cache_size)(stemmer.stem)
+        else:
+            self.stem = None
+
+    def __getstate__(self):
+        # caches can't be pickled, they are rebuilt in the new process
+        return {'stemmer': self.stemmer, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['stemmer'], state['cache_size'])
+
+    def clean(self, text):
+        """
+        Remove urls, mentions, emojis, etc.
+        """
+        clean_text = tw_preprocessor.clean(text)
+        clean_text = demoji.replace(clean_text).replace('\u200d️','').strip()
+        return self.emoji_regexp.sub(u'', clean_text)
+
+    def normalize_tweet(self, text, lang, stemming=False):
+        """
+        Return the clean text of the tweet in lower case. Stopwords are
+        removed from tweets in Spanish and, if requested, words are stemmed
+        """
+        tokens = [token.lower() for token in wordpunct_tokenize(self.clean(text))]
+        if lang != 'es':
+            return ' '.join(tokens)
+        words = [token for token in tokens if token not in self.es_stop_words]
+        if stemming:
+            stems = [self.stem(word) for word in words]
+            return ' '.join([stem for stem in stems if stem.isalpha() and len(stem) > 1])
+        return ' '.join(words)
+
+    def tokenize_document(self, doc):
+        """
+        Return the words of the document without Spanish and English
+        stopwords nor numbers
+        """
+        doc = tw_preprocessor.clean(doc.lower())
+        return [word for word in self.corpus_tokenizer.tokenize(doc)
+                if word not in self.corpus_stop_words and not str.isdigit(word)]
+
+
+@lru_cache(maxsize=2**16)
+def normalize_location(text):
+    """
+    Return the location in lower case without hashtags, non-ascii
+    characters, punctuation and extra spaces. Results are memoised, so
+    the places and demonyms repeated across users are normalized once
+    """
+    text = text.replace('#','')
+    words = remove_non_ascii(text)
+    words = to_lowercase(words)
+    words = remove_punctuation(words)
+    words = remove_extra_spaces(words)
+    return ' '.join(words)
@@ -0,0 +1,54 @@
+# sentiment scores above high are positive and below low are negative
+THRESHOLD_SA = {'low': -0.1, 'high': 0.1}
+
+
+def get_tweet_type_expression():
+    # same rules as get_tweet_type, for tweets without the field type
+    return {
+        '$ifNull': ['$type', {
+            '$switch': {
+                'branches': [
+                    {'case': {'$gt': ['$retweeted_status', None]}, 
+                     'then': 'retweet'},
+                    {'case': {'$eq': ['$is_quote_status', True]}, 
+                     'then': 'quote'},
+                    {'case': {'$gt': ['$in_reply_to_status_id_str', None]}, 
+                     'then': 'reply'}
+                ],
+                'default': 'original'
+            }
+        }]
+    }
+
+
+def get_sentiment_label_expression():
+    # tweets without score are neutral, as in sentiment_analysis
+    has_score = {'$ne': [{'$ifNull': ['$sentiment.score', None]}, None]}
+    return {
+        '$switch': {
+            'branches': [
+                {'case': {'$and': [has_score, 
+                                   {'$gt': ['$sentiment.score', THRESHOLD_SA['high']]}]},
+                 'then': 'positivo'},
+                {'case': {'$and': [has_score, 
+                                   {'$lt': ['$sentiment.score', THRESHOLD_SA['low']]}]},
+                 'then': 'negativo'}
+            ],
+            'default': 'neutral'
+        }
+    }
+
+
+def get_hour_expression():
+    # hour of created_at (e.g. Tue Mar 24 10:05:00 +0000 2020)
+    return {'$substrCP': ['$created_at', 11, 2]}
+
+
+def get_sentiment_accumulators():
+    # number of tweets, sum and number of sentiment scores of a group
+    return {
+        'count': {'$sum': 1},
+        'sentiment_sum': {'$sum': '$sentiment.score'},
+        'sentiment_count': {'$sum': {'$cond': [
+            {'$eq': [{'$ifNull': ['$sentiment.score', None]}, None]}, 0, 1]}}
+    }
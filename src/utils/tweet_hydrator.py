@@ -0,0 +1,186 @@
+import logging
+import pathlib
+import queue
+import threading
+import time
+
+from requests.exceptions import RequestException
+from requests_oauthlib import OAuth1Session
+
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[1].joinpath('tw_coronavirus.log')),
+                    level=logging.DEBUG)
+
+
+class TokenQuota:
+    """
+    Keep track of the requests that remain available for a set of
+    credentials in the current rate-limit window
+    """
+
+    def __init__(self, name, requests_per_window, window_secs):
+        self.name = name
+        self.requests_per_window = requests_per_window
+        self.window_secs = window_secs
+        self.remaining = requests_per_window
+        self.reset_time = time.time() + window_secs
+
+    def wait_if_exhausted(self):
+        now = time.time()
+        if now >= self.reset_time:
+            # a new window has started
+            self.remaining = self.requests_per_window
+            self.reset_time = now + self.window_secs
+        if self.remaining <= 0:
+            secs_to_wait = self.reset_time - now + 1
+            logging.info('Token {0} ran out of requests, waiting {1:.0f} '\
+                         'seconds'.format(self.name, secs_to_wait))
+            time.sleep(secs_to_wait)
+            self.remaining = self.requests_per_window
+            self.reset_time = time.time() + self.window_secs
+
+    def update(self, headers):
+        # prefer the numbers reported by the api, otherwise keep counting
+        # locally
+        if 'x-rate-limit-remaining' in headers:
+            self.remaining = int(headers['x-rate-limit-remaining'])
+        else:
+            self.remaining -= 1
+        if 'x-rate-limit-reset' in headers:
+            self.reset_time = float(headers['x-rate-limit-reset'])
+
+    def exhaust(self, headers):
+        self.remaining = 0
+        if 'x-rate-limit-reset' in headers:
+            self.reset_time = float(headers['x-rate-limit-reset'])
+        else:
+            self.reset_time = time.time() + self.window_secs
+
+
+class TweetHydrator:
+    """
+    Hydrate tweets through the endpoint statuses/lookup using several sets
+    of credentials concurrently. Each set of credentials runs in its own
+    thread and keeps track of its quota, while hydrated batches are handed
+    to the caller as soon as they arrive so that database writes overlap
+    with network requests
+    """
+    LOOKUP_URL = 'https://api.twitter.com/1.1/statuses/lookup.json'
+    MAX_IDS_PER_REQUEST = 100
+    REQUESTS_PER_WINDOW = 900
+    WINDOW_SECS = 15 * 60
+
+    def __init__(self, credentials, lookup_url=None, max_retries=3,
+                 timeout=30):
+        if isinstance(credentials, dict):
+            credentials = [credentials]
+        if len(credentials) == 0:
+            raise Exception('At least one set of credentials is required')
+        self.credentials = credentials
+        self.lookup_url = lookup_url if lookup_url else self.LOOKUP_URL
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.quotas = [TokenQuota(str(idx), self.REQUESTS_PER_WINDOW,
+                                  self.WINDOW_SECS)
+                       for idx in range(len(credentials))]
+
+    def __get_session(self, credential):
+        return OAuth1Session(credential['consumer_key'],
+                             client_secret=credential['consumer_secret'],
+                             resource_owner_key=credential['access_token'],
+                             resource_owner_secret=credential['access_token_secret'])
+
+    def __lookup(self, session, quota, tweet_ids):
+        """
+        Return the list of hydrated tweets or None if the batch could not
+        be hydrated after max_retries attempts
+        """
+        attempts = 0
+        while attempts < self.max_retries:
+            quota.wait_if_exhausted()
+            try:
+                response = session.post(self.lookup_url,
+                                        data={'id': ','.join(tweet_ids),
+                                              'include_entities': 'false',
+                                              'trim_user': 'true'},
+                                        timeout=self.timeout)
+            except RequestException as e:
+                attempts += 1
+                logging.warning('Token {0}: error requesting tweets ({1}), '\
+                                'attempt {2}'.format(quota.name, e, attempts))
+                time.sleep(2 ** attempts)
+                continue
+            if response.status_code == 429:
+                # the rate-limit window is over, it doesn't count as attempt
+                quota.exhaust(response.headers)
+                continue
+            quota.update(response.headers)
+            if response.status_code == 200:
+                return response.json()
+            attempts += 1
+            logging.warning('Token {0}: lookup returned status {1}, attempt '\
+                            '{2}'.format(quota.name, response.status_code,
+                                         attempts))
+            time.sleep(2 ** attempts)
+        return None
+
+    def __worker(self, credential, quota, batches, results):
+        session = self.__get_session(credential)
+        try:
+            while True:
+                try:
+                    batch = batches.get_nowait()
+                except queue.Empty:
+                    break
+                tweets = self.__lookup(session, quota, batch)
+                results.put((batch, tweets))
+        finally:
+            session.close()
+            results.put(None)
+
+    def hydrate(self, tweet_ids, process_batch):
+        """
+        Hydrate the given tweet ids calling process_batch(requested_ids,
+        hydrated_tweets) for every batch. hydrated_tweets is None when the
+        batch could not be hydrated, in which case the ids should not be
+        considered as deleted tweets
+        """
+        batches = queue.Queue()
+        tweet_ids = [str(tweet_id) for tweet_id in tweet_ids]
+        for i in range(0, len(tweet_ids), self.MAX_IDS_PER_REQUEST):
+            batches.put(tweet_ids[i:i+self.MAX_IDS_PER_REQUEST])
+        total_batches = batches.qsize()
+        results = queue.Queue()
+        workers = []
+        for credential, quota in zip(self.credentials, self.quotas):
+            worker = threading.Thread(target=self.__worker,
+                                      args=(credential, quota, batches, results),
+                                      daemon=True)
+            worker.start()
+            workers.append(worker)
+        logging.info('Hydrating {0:,} tweets in {1:,} batches using {2} '\
+                     'tokens'.format(len(tweet_ids), total_batches, len(workers)))
+        stats = {'hydrated': 0, 'missing': 0, 'failed': 0}
+        finished_workers = processed_batches = 0
+        start_time = time.time()
+        # consume results in the calling thread while workers keep requesting
+        while finished_workers < len(workers):
+            result = results.get()
+            if result is None:
+                finished_workers += 1
+                continue
+            batch, tweets = result
+            processed_batches += 1
+            if tweets is None:
+                stats['failed'] += len(batch)
+            else:
+                stats['hydrated'] += len(tweets)
+                stats['missing'] += len(batch) - len(tweets)
+            process_batch(batch, tweets)
+            elapsed_secs = time.time() - start_time
+            logging.info('[{0}/{1}] Hydrated batch, {2:.1f} tweets/sec'.\
+                         format(processed_batches, total_batches,
+                                stats['hydrated']/max(elapsed_secs, 1e-6)))
+        for worker in workers:
+            worker.join()
+        return stats
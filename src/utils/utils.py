@@ -1,6 +1,8 @@
 import csv
+import hashlib
 import json
 import logging
+import numpy as np
 import os
 import pathlib
 import re
@@ -177,6 +179,39 @@ def check_user_profile_image(img_path):
         raise Exception('Tensor with incorrect size {}'.format(img_size))
 
 
+def validate_profile_image(img_path, min_size_sum=400, img_size=(224, 224)):
+    """
+    Validate the picture using only PIL. Return a tuple with the status
+    (ok, too_small or invalid), the original size and the picture resized
+    to img_size as a RGB uint8 array (None if the picture is not valid)
+    """
+    try:
+        img = Image.open(img_path).convert('RGB')
+        orig_size = list(img.size)
+        if img.size[0] + img.size[1] < min_size_sum:
+            return 'too_small', orig_size, None
+        img = img.resize(img_size, Image.BILINEAR)
+        return 'ok', orig_size, np.asarray(img, dtype=np.uint8)
+    except Exception as e:
+        logging.info('Could not process the picture {0} ({1})'.format(img_path, e))
+        return 'invalid', None, None
+
+
+def get_user_fingerprint(user, img_path):
+    """
+    Return a hash of the profile picture and the profile fields used to 
+    infer the demographics of the user
+    """
+    fingerprint = hashlib.sha1()
+    with open(img_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            fingerprint.update(chunk)
+    for field in ['name', 'screen_name', 'description', 'lang']:
+        value = user.get(field) or ''
+        fingerprint.update(b'\x00' + str(value).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
 def week_of_month(dt):
     """ Returns the week of the month for the specified date.
         Taken from 
@@ -187,4 +222,39 @@ def week_of_month(dt):
     dom = dt.day
     adjusted_dom = dom + first_day.weekday()
 
-    return int(ceil(adjusted_dom/7.0))
\ No newline at end of file
+    return int(ceil(adjusted_dom/7.0))
+
+
+def get_date_partitions(start_date, end_date, partition_by='day'):
+    """
+    Split the range of dates (format: YYYY-MM-DD) in partitions of one
+    day or one week (monday to sunday). Return a list of tuples with the
+    first and the last date of every partition
+    """
+    start_dt = datetime.strptime(start_date, '%Y-%m-%d')
+    end_dt = datetime.strptime(end_date, '%Y-%m-%d')
+    if start_dt > end_dt:
+        raise Exception('The start date {0} is after the end date {1}'.\
+                        format(start_date, end_date))
+    if partition_by not in ['day', 'week']:
+        raise Exception('Unknown partition {}, it should be day or week'.\
+                        format(partition_by))
+    partitions = []
+    current_dt = start_dt
+    while current_dt <= end_dt:
+        if partition_by == 'day':
+            last_dt = current_dt
+        else:
+            last_dt = min(current_dt + timedelta(days=6-current_dt.weekday()), end_dt)
+        partitions.append((current_dt.strftime('%Y-%m-%d'), 
+                           last_dt.strftime('%Y-%m-%d')))
+        current_dt = last_dt + timedelta(days=1)
+    return partitions
+
+
+def get_file_sha256(file_name):
+    file_hash = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
@@ -35,7 +35,7 @@ EVENT_LOG=${LOG_DIR}/process_events_log.csv
 ENV_DIR="${PROJECT_DIR}/env"
 CONFIG_FILE_NAME='config_mongo_inb.json'
 CONDA_ENV='twcovid'
-NUM_TASKS=7
+NUM_TASKS=8
 error=0
 
 ####
@@ -178,6 +178,21 @@ else
     error=1
 fi
 
+####
+# Update daily stats
+####
+if [[ $? -eq 0 ]] && [[ $error -eq 0 ]]
+then
+    end_time=`date '+%Y-%m-%d %H:%M:%S'`
+    echo "tweets_processor,${running_date},${COLLECTION_NAME},'updating_metrics',,${end_time}" >> $EVENT_LOG
+    echo "[8/${NUM_TASKS}] Updating daily stats..."
+    start_time=`date '+%Y-%m-%d %H:%M:%S'`
+    echo "tweets_processor,${running_date},${COLLECTION_NAME},'updating_daily_stats',${start_time}," >> $EVENT_LOG
+    python run.py update-daily-stats $COLLECTION_NAME --config_file $CONFIG_FILE_NAME >> $LOGFILE 2>> $ERRORFILE
+else
+    error=1
+fi
+
 ####
 # Add query version flag
 ####
@@ -197,7 +212,7 @@ fi
 if [[ $? -eq 0 ]] && [[ $error -eq 0 ]]
 then
     end_time=`date '+%Y-%m-%d %H:%M:%S'`
-    echo "tweets_processor,${running_date},'updating_metrics',,${end_time}" >> $EVENT_LOG
+    echo "tweets_processor,${running_date},'updating_daily_stats',,${end_time}" >> $EVENT_LOG
     end_time=`date '+%Y-%m-%d %H:%M:%S'`
     echo "tweets_processor,${running_date},'finished_processor',,${end_time}" >> $EVENT_LOG
 else